@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+#
+# Audits the plasma membrane part restrictions of every class in the Cell Ontology against those
+# that it inherits from its ancestors, and reports:
+#
+# - contradictions: a class that has (or inherits) a protein at one level and also at an
+#   incompatible level, e.g. both 'has plasma membrane part' and 'lacks plasma membrane part', or
+#   both high and low amounts; or that lacks a protein while having one of its forms (according to
+#   the PR hierarchy);
+# - redundant restrictions: a restriction asserted on a class that it already inherits, at the same
+#   level or a more specific one (e.g. 'has plasma membrane part' under an ancestor with a high
+#   amount);
+# - duplicate restrictions: the same restriction asserted more than once on a class.
+#
+# Run it on cl.owl rather than cl-plus.owl, since the latter asserts every inherited restriction on
+# every class. The restrictions that each class inherits are computed once, for every class, from
+# those of its parents, so that the whole ontology is audited without walking up from each class.
+
+import argparse
+import csv
+import xml.etree.ElementTree as ET
+from collections import Counter, defaultdict
+
+from common import HierarchyIndex, extract_iri_label_maps, extract_iri_parent_maps, \
+  get_level_iris, update_iri_maps_from_owl
+
+ABSENT = get_level_iris()['-']
+PRESENT = get_level_iris()['+']
+AMOUNTS = {get_level_iris()['++'], get_level_iris()['+-']}
+
+
+def levels_conflict(level, other_level):
+  """
+  Return True if a protein cannot be at both of the given levels: absent and present, or in both a
+  high and a low amount.
+  """
+  if (level == ABSENT) != (other_level == ABSENT):
+    return True
+  return level != other_level and level in AMOUNTS and other_level in AMOUNTS
+
+
+def merge_gates(gate_maps):
+  """
+  Merge the given maps from (kind, level) pairs to tuples of the classes that assert them. A single
+  map is returned as it is, rather than copied.
+  """
+  if len(gate_maps) == 1:
+    return gate_maps[0]
+  merged = {}
+  for gate_map in gate_maps:
+    for gate, sources in gate_map.items():
+      merged[gate] = tuple(sorted(set(merged.get(gate, ()) + sources)))
+  return merged
+
+
+def get_effective_gates(iri_gates, iri_all_parents):
+  """
+  For every class in the given map of classes to their gates, return a map from each (kind, level)
+  pair that the class asserts or inherits to a tuple of the classes asserting it: the class itself,
+  or else its nearest ancestors that do. Each class's map is built from those of its parents, which
+  are built first, and classes that add nothing to their only parent share its map.
+  """
+  effective = {}
+  for iri in sorted(iri_gates):
+    stack = [iri]
+    while stack:
+      current = stack[-1]
+      parents = [parent for parent in iri_all_parents.get(current, []) if parent in iri_gates]
+      pending = [parent for parent in parents if parent not in effective and parent not in stack]
+      if pending:
+        stack.extend(pending)
+        continue
+      stack.pop()
+      if current in effective:
+        continue
+      # A parent that is still on the stack closes a cycle, so it is skipped:
+      gates = merge_gates([effective[parent] for parent in parents if parent in effective])
+      if iri_gates[current]:
+        gates = dict(gates)
+        for gate in iri_gates[current]:
+          gates[(gate['kind'], gate['level'])] = (current,)
+      effective[current] = gates
+  return effective
+
+
+def find_contradictions(gates, new_pairs, pr_hierarchy):
+  """
+  Generate the contradictory pairs of gates among the given (kind, level) pairs, i.e. pairs of
+  gates of the same kind at conflicting levels, or of related kinds. Only the pairs for which
+  new_pairs(gate, other) is True are reported.
+  """
+  kind_levels = defaultdict(list)
+  for kind, level in sorted(gates):
+    kind_levels[kind].append(level)
+  kinds = sorted(kind_levels)
+
+  for i, kind in enumerate(kinds):
+    levels = kind_levels[kind]
+    for j, level in enumerate(levels):
+      for other_level in levels[j + 1:]:
+        if levels_conflict(level, other_level) and new_pairs((kind, level), (kind, other_level)):
+          yield (kind, level), (kind, other_level)
+
+    if not len(pr_hierarchy):
+      continue
+    for other_kind in kinds[i + 1:]:
+      if not pr_hierarchy.related(kind, other_kind):
+        continue
+      for level in levels:
+        for other_level in kind_levels[other_kind]:
+          gate, other = (kind, level), (other_kind, other_level)
+          if pr_hierarchy.contradicts(kind, level != ABSENT, other_kind, other_level != ABSENT) \
+             and new_pairs(gate, other):
+            yield gate, other
+
+
+def audit(iri_gates, iri_all_parents, pr_hierarchy=None):
+  """
+  Audit every class in the given map of classes to their gates, and generate a row for each
+  problem: the class, the kind of problem, the protein and level concerned, the other protein and
+  level involved, and the classes that assert the other restriction.
+  """
+  if pr_hierarchy is None:
+    pr_hierarchy = HierarchyIndex()
+  effective = get_effective_gates(iri_gates, iri_all_parents)
+
+  for iri in sorted(iri_gates):
+    own = [(gate['kind'], gate['level']) for gate in iri_gates[iri]]
+    for (kind, level), count in sorted(Counter(own).items()):
+      if count > 1:
+        yield [iri, 'duplicate', kind, level, kind, level, iri]
+
+    # Pairs of gates that are both inherited from the same parent have already been reported for an
+    # ancestor, so only pairs involving one of the class's own gates, or coming together for the
+    # first time in this class from different parents, are compared:
+    own = set(own)
+    parents_gates = [effective[parent] for parent in iri_all_parents.get(iri, [])
+                     if parent in effective]
+    inherited = merge_gates(parents_gates) if parents_gates else {}
+
+    def new_pairs(gate, other):
+      if gate in own or other in own:
+        return True
+      return len(parents_gates) > 1 and not any(
+        [gate in parent_gates and other in parent_gates for parent_gates in parents_gates])
+
+    gates = set(inherited) | own
+    for gate, other in find_contradictions(gates, new_pairs, pr_hierarchy):
+      # Report the class's own gate first, if there is one:
+      if gate not in own:
+        gate, other = other, gate
+      sources = [iri] if other in own else inherited[other]
+      yield [iri, 'contradiction', gate[0], gate[1], other[0], other[1], ' '.join(sources)]
+
+    for kind, level in sorted(own):
+      for other_level in [level] + (sorted(AMOUNTS) if level == PRESENT else []):
+        sources = inherited.get((kind, other_level))
+        if sources:
+          yield [iri, 'redundant', kind, level, kind, other_level, ' '.join(sources)]
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='Audit the plasma membrane part restrictions of every CL class')
+  parser.add_argument('cells', type=argparse.FileType('r'),
+                      help='an OWL file for the Cell Ontology (without inferred restrictions)')
+  parser.add_argument('parents', type=argparse.FileType('r'),
+                      help='a TSV file which maps PR ontology ids to their parents')
+  parser.add_argument('labels', type=argparse.FileType('r'),
+                      help='a TSV file which maps PR ontology ids to their labels')
+  parser.add_argument('output', type=str, help='the output TSV file')
+  args = parser.parse_args()
+
+  tree = ET.parse(args.cells)
+  iri_all_parents = {}
+  iri_gates, iri_parents, iri_labels, synonym_iris = update_iri_maps_from_owl(
+    tree, {}, {}, {}, {}, iri_all_parents)
+
+  rows = csv.reader(args.parents, delimiter='\t')
+  pr_hierarchy = HierarchyIndex(extract_iri_parent_maps(rows))
+  # cl.owl only has the labels of CL classes and of the levels, so PR labels are read separately:
+  pr_labels = extract_iri_label_maps(csv.reader(args.labels, delimiter='\t'))[1]
+
+  problems = Counter()
+  with open(args.output, 'w') as output:
+    w = csv.writer(output, delimiter='\t', lineterminator='\n')
+    w.writerow(['CL ID', 'CL label', 'Problem', 'PR ID', 'PR label', 'Level', 'Other PR ID',
+                'Other PR label', 'Other level', 'Other sources'])
+    rows = audit(iri_gates, iri_all_parents, pr_hierarchy)
+    for iri, problem, kind, level, other_kind, other_level, sources in rows:
+      problems[problem] += 1
+      w.writerow([iri, iri_labels.get(iri, ''), problem, kind, pr_labels.get(kind, ''),
+                  iri_labels[level], other_kind, pr_labels.get(other_kind, ''),
+                  iri_labels[other_level], sources])
+
+  print('Audited {} classes: {} contradictions, {} redundant and {} duplicate restrictions'.format(
+    len(iri_gates), problems['contradiction'], problems['redundant'], problems['duplicate']))
+
+
+if __name__ == "__main__":
+  main()
+
+
+def test_audit():
+  high, low, absent = get_level_iris()['++'], get_level_iris()['+-'], ABSENT
+
+  def gates(*pairs):
+    return [{'kind': kind, 'level': level} for kind, level in pairs]
+
+  iri_gates = {
+    'cell': [],
+    'T cell': gates(('CD3', PRESENT)),
+    'CD4 T cell': gates(('CD4', PRESENT), ('CD3', PRESENT), ('CD8', absent)),
+    'CD4 CD8 T cell': gates(('CD8', PRESENT)),
+    'bright T cell': gates(('CD3', high)),
+    'dim bright T cell': gates(('CD3', low)),
+    'CD45- T cell': gates(('CD45', absent), ('CD45', absent)),
+    'CD45RA CD45- T cell': gates(('CD45RA', PRESENT))
+  }
+  iri_all_parents = {
+    'T cell': ['cell'],
+    'CD4 T cell': ['T cell'],
+    'CD4 CD8 T cell': ['CD4 T cell'],
+    'bright T cell': ['T cell'],
+    'dim bright T cell': ['bright T cell'],
+    'CD45- T cell': ['T cell'],
+    'CD45RA CD45- T cell': ['CD45- T cell', 'CD4 T cell']
+  }
+  effective = get_effective_gates(iri_gates, iri_all_parents)
+  assert effective['cell'] == {}
+  assert effective['CD4 CD8 T cell'] == {
+    ('CD3', PRESENT): ('CD4 T cell',), ('CD4', PRESENT): ('CD4 T cell',),
+    ('CD8', absent): ('CD4 T cell',), ('CD8', PRESENT): ('CD4 CD8 T cell',)}
+  assert effective['CD45RA CD45- T cell'][('CD3', PRESENT)] == ('CD4 T cell', 'T cell')
+
+  pr_hierarchy = HierarchyIndex({'CD45RA': ['CD45']})
+  assert list(audit(iri_gates, iri_all_parents, pr_hierarchy)) == [
+    ['CD4 CD8 T cell', 'contradiction', 'CD8', PRESENT, 'CD8', absent, 'CD4 T cell'],
+    ['CD4 T cell', 'redundant', 'CD3', PRESENT, 'CD3', PRESENT, 'T cell'],
+    ['CD45- T cell', 'duplicate', 'CD45', absent, 'CD45', absent, 'CD45- T cell'],
+    ['CD45RA CD45- T cell', 'contradiction', 'CD45RA', PRESENT, 'CD45', absent, 'CD45- T cell'],
+    ['dim bright T cell', 'contradiction', 'CD3', low, 'CD3', high, 'bright T cell']]
+
+  # Levels that are compatible with each other:
+  assert not levels_conflict(PRESENT, high) and not levels_conflict(low, low)
+  assert levels_conflict(absent, low) and levels_conflict(high, low)
@@ -10,7 +10,11 @@ import requests
 import sys
 import time
 
+from checkpoint import Checkpoint
 from common import extract_suffix_syns_symbs_maps, split_gate, tokenize
+from scheduler import estimate_run, estimate_study_sizes, get_seconds_per_record, largest_first, \
+  read_study_sizes, schedule, study_hash, update_study_sizes
+from writers import WRITERS
 
 
 def get_study_ids(studiesinfo, technique):
@@ -42,6 +46,52 @@ def filter_study_ids(all_ids, requested_ids):
   return requested_ids
 
 
+def study_sort_key(sid):
+  """
+  Returns a key for sorting study ids 'naturally', i.e. with SDY9 before SDY10.
+  """
+  return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', sid)]
+
+
+def parse_shard(shard):
+  """
+  Parse a shard specification of the form 'i/N', where 1 <= i <= N, returning the pair (i, N).
+  """
+  match = re.match(r'^(\d+)/(\d+)$', shard.strip())
+  if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+    raise argparse.ArgumentTypeError("'{}' is not of the form i/N, with 1 <= i <= N".format(shard))
+  return int(match.group(1)), int(match.group(2))
+
+
+def partition_studies(sids, nshards, weights=None):
+  """
+  Deterministically partition the given study ids into `nshards` lists. If no weights (i.e. record
+  counts) are given, each study is assigned to a shard by hashing its id. Otherwise the studies are
+  bin-packed, largest first, across the shards (see scheduler.schedule()). Since the result depends
+  only on the arguments, every node of a sharded run computes the same partition as long as it is
+  given the same weights.
+  """
+  if weights:
+    return schedule(sids, weights, nshards)
+
+  shards = [[] for i in range(nshards)]
+  for sid in sids:
+    shards[study_hash(sid) % nshards].append(sid)
+  return shards
+
+
+def get_study_projects(studiesinfo):
+  """
+  Given a list of records containing study information, return a map from study ids to the
+  projects ('Pis') that the studies belong to.
+  """
+  projects = {}
+  for row in studiesinfo:
+    # If a study is listed more than once, the last listing wins:
+    projects[row['Supporting Data'].strip()] = row['Pis']
+  return projects
+
+
 def get_gate_mappings(mappings_file):
   """
   Given a mappings file, return a map which contains, for each row in the file, a mapping from its
@@ -114,6 +164,41 @@ def fetch_immport_data(auth_token, sid, jsonpath):
   return data
 
 
+def load_study(sid, cache_dir, get_auth_token):
+  """
+  Returns the data for the given study from the cache directory if it is there, otherwise fetches it
+  from ImmPort using the token returned by get_auth_token() (and caches it).
+  """
+  cachedir = '{}/fcsAnalyzed/'.format(cache_dir)
+  os.makedirs(cachedir, exist_ok=True)
+  jsonpath = os.path.normpath('{}/{}.json'.format(cachedir, sid))
+  # Check to see if there is an existing file for this study id. If so, reuse it, otherwise
+  # send an API call to ImmPort to retrieve the data:
+  try:
+    with open(jsonpath) as f:
+      data = json.load(f)
+      print("Retrieved JSON data for {} from cached file {}".format(sid, jsonpath))
+      return data
+  except FileNotFoundError:
+    print("No cached data for {} found ({} does not exist)".format(sid, jsonpath))
+    return fetch_immport_data(get_auth_token(), sid, jsonpath)
+
+
+def reconcile_headers(sid, records, headers):
+  """
+  Check the fields of the given records for the given study against the headers of the output,
+  which were determined from the first study, and report any differences. Missing fields are output
+  as empty values, and extra fields are ignored.
+  """
+  fields = set().union(*records)
+  missing = [header for header in headers if header not in fields]
+  extra = sorted(fields.difference(headers))
+  if missing:
+    print("Warning: records for {} are missing the fields {}".format(sid, missing))
+  if extra:
+    print("Warning: ignoring the extra fields {} in the records for {}".format(extra, sid))
+
+
 def preferize(gates, gate_mappings, special_gates, preferred, symbols):
   """
   'Preferize' a tokenised list of gates by replacing gate labels with preferred labels
@@ -170,19 +255,30 @@ def validate(reported, project, suffixsymbs, suffixsyns, gate_mappings, special_
   return ', '.join(preferized_gates)
 
 
-def write_records(records, headers, outfile, project, suffixsymbs, suffixsyns,
-                  gate_mappings, special_gates, preferred, symbols):
+# The extra columns that are added to the output for every record:
+VALIDATION_HEADERS = [
+  'Validated populationNameReported',
+  'Validated populationNamePreferred',
+  'Population name validations match',
+  'Validated populationDefinitionReported',
+  'Validated populationDefinitionPreferred',
+  'Population definition validations match'
+]
+
+
+def validate_records(records, headers, project, suffixsymbs, suffixsyns,
+                     gate_mappings, special_gates, preferred, symbols):
   """
-  Writes the given records, for which their keys are given in `headers`, to the given outfile.
-  In addition, validate the population name and definition for each record and write the validation
-  comments to the row corresponding to the record in the file.
+  Returns a list of output rows for the given records, for which their keys are given in `headers`.
+  In addition, validate the population name and definition for each record and add the validation
+  comments to the row corresponding to the record.
   """
   validated = {}
+  rows = []
 
   for record in records:
-    # First write all the headers for data not generated by us:
-    for header in headers:
-      print('"{}"'.format(record[header]), end='\t', file=outfile)
+    # First add the data not generated by us:
+    row = [record.get(header) for header in headers]
 
     # Now generate the validation fields for populationNameReported, populationNamePreferred,
     # populationDefnitionReported, and populationDefnitionPreferred. Note the misspelling of
@@ -191,24 +287,20 @@ def write_records(records, headers, outfile, project, suffixsymbs, suffixsyns,
       key = (record[prefix + 'Reported'], record[prefix + 'Preferred'])
       # Only validate a given reported-preferred combination if it hasn't already been validated:
       if key not in validated:
-        validated[key] = {
-          'Reported': validate(record[prefix + 'Reported'] or '',
-                               project, suffixsymbs, suffixsyns, gate_mappings,
-                               special_gates, preferred, symbols),
-          'Preferred': validate(record[prefix + 'Preferred'] or '',
-                                project, suffixsymbs, suffixsyns, gate_mappings,
-                                special_gates, preferred, symbols)}
+        valid_reported = validate(record[prefix + 'Reported'] or '',
+                                  project, suffixsymbs, suffixsyns, gate_mappings,
+                                  special_gates, preferred, symbols)
+        valid_preferred = validate(record[prefix + 'Preferred'] or '',
+                                   project, suffixsymbs, suffixsyns, gate_mappings,
+                                   special_gates, preferred, symbols)
+        validated[key] = [valid_reported, valid_preferred,
+                          'Y' if valid_reported == valid_preferred else 'N']
 
-      print('"{}"\t"{}"'.format(validated[key]['Reported'], validated[key]['Preferred']),
-            end='\t', file=outfile)
+      row.extend(validated[key])
 
-      if validated[key]['Reported'] == validated[key]['Preferred']:
-        print('"Y"', end='\t', file=outfile)
-      else:
-        print('"N"', end='\t', file=outfile)
+    rows.append(row)
 
-    # Write a new line to end off the record:
-    print(file=outfile)
+  return rows
 
 
 def main():
@@ -236,9 +328,23 @@ def main():
   parser.add_argument('preferred', type=argparse.FileType('r'),
                       help='a TSV file which maps ontology ids to preferred labels')
   parser.add_argument('output_dir', type=str,
-                      help='directory for output TSV files')
+                      help='directory for output files')
   parser.add_argument('cache_dir', type=str,
                       help='directory containing cached JSON files')
+  parser.add_argument('--format', choices=sorted(WRITERS), default='tsv',
+                      help='the output format: quoted TSV (the default), JSON Lines, or a compact '
+                      'dictionary-encoded binary format (see writers.py)')
+  parser.add_argument('--resume', action='store_true',
+                      help='resume an interrupted run, skipping the studies whose output has '
+                      'already been written to the checkpoint directory')
+  parser.add_argument('--shard', metavar='i/N', type=parse_shard,
+                      help='validate only the i-th of N deterministic partitions of the studies, '
+                      'writing a partial output directory that can be combined with those of the '
+                      'other shards using merge_shards.py')
+  parser.add_argument('--shard-weights', metavar='TSV', type=argparse.FileType('r'),
+                      help='a TSV file with Study and Records columns, such as the study-sizes.tsv '
+                      'written by earlier runs, used to balance the shards by record count (every '
+                      'shard must be given the same file)')
   # It is arguably silly to have a mutually exclusive group with only one member, but we do this
   # in case we want to add other validation tasks in the future:
   required = parser.add_argument_group('required arguments')
@@ -259,7 +365,8 @@ def main():
   # Get the start time of the execution for later logging the total elapsed time:
   start = time.time()
 
-  outpath = os.path.normpath(args['output_dir'] + '/fcsAnalyzed.tsv')
+  writer_class = WRITERS[args['format']]
+  outpath = os.path.normpath(args['output_dir'] + '/fcsAnalyzed.' + writer_class.extension)
 
   # Read in the information from the file containing general info on studies.
   studiesinfo = list(csv.DictReader(args['studiesinfo'], delimiter='\t'))
@@ -267,9 +374,25 @@ def main():
   # Find all of the Flow Cytometry studies to validate:
   print("Validating Flow Cytometry studies")
   fcsAnalyzed = get_study_ids(studiesinfo, 'Flow Cytometry')
-  # But validate only those that the user has requested (if none are specified, validate them all):
+  # But validate only those that the user has requested (if none are specified, validate them all).
+  # The order of the studies determines the order of the output, so make sure that it is the same
+  # every time:
   if len(args['fcsAnalyzed']) > 0:
     fcsAnalyzed = filter_study_ids(fcsAnalyzed, args['fcsAnalyzed'])
+  else:
+    fcsAnalyzed = sorted(fcsAnalyzed, key=study_sort_key)
+
+  # If this is one shard of a sharded run, then we only validate the studies in our partition:
+  assigned = fcsAnalyzed
+  if args['shard']:
+    shard, nshards = args['shard']
+    weights = None
+    if args['shard_weights']:
+      # Only the given file is used, since the cache directories of different nodes may differ:
+      weights = estimate_study_sizes(fcsAnalyzed, read_study_sizes(args['shard_weights']), None)
+    assigned = partition_studies(fcsAnalyzed, nshards, weights)[shard - 1]
+    print("Shard {} of {}: validating {} of {} studies: {}"
+          .format(shard, nshards, len(assigned), len(fcsAnalyzed), assigned))
 
   # Extract the suffix synonyms and symbols from the scale TSV file:
   rows = csv.DictReader(args['scale'], delimiter='\t')
@@ -289,60 +412,98 @@ def main():
   # This file associates ontology ids with preferred gate labels (i.e. pr#PRO-short-label).
   preferred = get_preferred(args['preferred'])
 
-  # Get the study data from the local filesystem if it is present, otherwise fetch it from ImmPort:
-  data = {}
+  # The output for each study is first written to a segment file of its own in a checkpoint
+  # directory. If we are resuming an interrupted run, then the studies that have already been
+  # written are skipped, otherwise we start with an empty checkpoint directory. The checkpoint
+  # directory of a shard is the partial output of a sharded run.
+  checkpoint_path = outpath + '.segments'
+  if args['shard']:
+    checkpoint_path = '{}.shard-{}-of-{}'.format(outpath, shard, nshards)
+  checkpoint = Checkpoint(checkpoint_path, args['format'])
+  if args['resume']:
+    checkpoint.load()
+    print("Resuming: {} studies already completed".format(len(checkpoint.completed_studies())))
+  else:
+    checkpoint.clear()
+  if args['shard']:
+    # Record enough about the shard for merge_shards.py to check and combine the partial outputs:
+    checkpoint.set_info('shard', [shard, nshards])
+    checkpoint.set_info('order', fcsAnalyzed)
+    checkpoint.set_info('assigned', assigned)
+  pending = [sid for sid in assigned if not checkpoint.completed(sid)]
+
+  # Process the largest studies first, using the number of records in each study that were recorded
+  # by earlier runs, or else estimated from the size of its cache file, and estimate how long this
+  # will take. Note that the order in which the studies are processed does not affect the output.
+  sizes_path = os.path.join(args['output_dir'], 'study-sizes.tsv')
+  known_sizes = {}
+  if os.path.exists(sizes_path):
+    with open(sizes_path) as f:
+      known_sizes = read_study_sizes(f)
+  sizes = estimate_study_sizes(pending, known_sizes, args['cache_dir'])
+  pending = largest_first(pending, sizes)
+  estimate = estimate_run([pending], sizes, get_seconds_per_record(known_sizes))
+  print("Estimated {} records in {} studies: about {:.0f} seconds and {:.0f} MB of memory"
+        .format(estimate['records'], len(pending), estimate['seconds'],
+                estimate['peak_bytes'] / 1e6))
+
+  # Look up the project of each study in an index rather than searching through studiesinfo:
+  projects = get_study_projects(studiesinfo)
+
+  # The auth token is only needed if some study has not been cached, and is then reused:
   auth_token = None
-  for sid in fcsAnalyzed:
-    cachedir = '{}/fcsAnalyzed/'.format(args['cache_dir'])
-    os.makedirs(cachedir, exist_ok=True)
-    jsonpath = os.path.normpath('{}/{}.json'.format(cachedir, sid))
-    # Check to see if there is an existing file for this study id. If so, reuse it, otherwise
-    # send an API call to ImmPort to retrieve the data:
-    try:
-      with open(jsonpath) as f:
-        data[sid] = json.load(f)
-        print("Retrieved JSON data for {} from cached file {}".format(sid, jsonpath))
-    except FileNotFoundError:
-      print("No cached data for {} found ({} does not exist)".format(sid, jsonpath))
-      # Reuse the existing auth token if it has already been generated:
-      if not auth_token:
-        auth_token = fetch_auth_token(username, password)
-      data[sid] = fetch_immport_data(auth_token, sid, jsonpath)
-
-  if not any([data[sid] for sid in data]):
+
+  def get_auth_token():
+    nonlocal auth_token
+    if not auth_token:
+      auth_token = fetch_auth_token(username, password)
+    return auth_token
+
+  # Now validate the studies one at a time: get the data for a study from the local filesystem if it
+  # is present, otherwise fetch it from ImmPort, validate it, write it to its segment, and then let
+  # it go before moving on to the next one. So only one study needs to be held in memory at once.
+  for sid in pending:
+    study_start = time.time()
+    records = load_study(sid, args['cache_dir'], get_auth_token)
+    if not records:
+      print("No data found for " + sid)
+      checkpoint.write_segment(sid, writer_class, [])
+      continue
+    project = projects.get(sid)
+    if project is None:
+      print("Could not find project corresponding to {}; skipping".format(sid))
+      checkpoint.write_segment(sid, writer_class, [])
+      continue
+
+    # The header of the output file consists of the fields of the data returned plus extra fields
+    # determined on its basis. Every study should have the same fields, so we take them from the
+    # first one (that has data), and check the others against them. When resuming, the header is
+    # the one recorded in the checkpoint.
+    if not checkpoint.fieldnames():
+      checkpoint.set_fieldnames(sorted([key for key in records[0]]) + VALIDATION_HEADERS)
+    headers = checkpoint.fieldnames()[:-len(VALIDATION_HEADERS)]
+    reconcile_headers(sid, records, headers)
+
+    print("Processing {} records for fcsAnalyzed ID: {} ...".format(len(records), sid))
+    rows = validate_records(records, headers, project, suffixsymbs, suffixsyns,
+                            gate_mappings, special_gates, preferred, symbols)
+    checkpoint.write_segment(sid, writer_class, rows, time.time() - study_start)
+    del records, rows
+
+  # A shard may legitimately have no data, but a complete run should not:
+  if not checkpoint.fieldnames() and not args['shard']:
     print("No data found")
     sys.exit(1)
 
-  # Write the header of the output TSV file by using the data returned plus extra fields
-  # determined on its basis. Every sid in the data set should have the same fields, so we can just
-  # use the first one (that has data) to get the header fields from. We can assume that there will
-  # be at least one of these since we checked for this above.
-  first_sid_with_data = [sid for sid in data if data[sid]].pop()
-  headers = sorted([key for key in data[first_sid_with_data][0]])
-  with open(outpath, 'w') as outfile:
-    for header in headers:
-      print('"{}"'.format(header), end='\t', file=outfile)
-    print('"Validated populationNameReported"', end='\t', file=outfile)
-    print('"Validated populationNamePreferred"', end='\t', file=outfile)
-    print('"Population name validations match"', end='\t', file=outfile)
-    print('"Validated populationDefinitionReported"', end='\t', file=outfile)
-    print('"Validated populationDefinitionPreferred"', end='\t', file=outfile)
-    print('"Population definition validations match"', file=outfile)
-
-    # Now write the actual data:
-    for sid in fcsAnalyzed:
-      records = data.get(sid)
-      if not records:
-        print("No data found for " + sid)
-        continue
-      try:
-        project = [s['Pis'] for s in studiesinfo if s['Supporting Data'].strip() == sid].pop()
-      except IndexError:
-        print("Could not find project corresponding to {}; skipping".format(sid))
-        continue
-      print("Processing {} records for fcsAnalyzed ID: {} ...".format(len(records), sid))
-      write_records(records, headers, outfile, project, suffixsymbs, suffixsyns,
-                    gate_mappings, special_gates, preferred, symbols)
+  # Finally, concatenate the segments into the output file and remove the checkpoint directory.
+  # The partial output of a shard is left in place to be merged with the output of the others.
+  if args['shard']:
+    checkpoint.save()
+    print("Partial output for shard {} of {} written to {}".format(shard, nshards, checkpoint.path))
+  else:
+    checkpoint.finalize(outpath, writer_class, fcsAnalyzed)
+    update_study_sizes(sizes_path, checkpoint.completed_studies())
+    checkpoint.clear()
 
   end = time.time()
   print("Processing completed. Total execution time: {0:.2f} seconds.".format(end - start))
@@ -488,3 +649,20 @@ def test_validate():
   preferized = validate(reported, 'LaJolla', suffixsymbs, suffixsyns, gate_mappings, special_gates,
                         preferred, symbols)
   assert preferized == 'CD14-, CD56-, CD3+, CD4+, CD8-, CD45RA+, CCR7+'
+
+
+def test_partition_studies():
+  sids = ['SDY{}'.format(i) for i in range(1, 21)]
+  assert sorted(['SDY10', 'SDY9', 'SDY100'], key=study_sort_key) == ['SDY9', 'SDY10', 'SDY100']
+
+  # Every study is assigned to exactly one shard, and the assignment doesn't depend on the order in
+  # which the studies are given:
+  shards = partition_studies(sids, 3)
+  assert sorted(sum(shards, []), key=study_sort_key) == sids
+  assert partition_studies(list(reversed(sids)), 3) == [list(reversed(s)) for s in shards]
+
+  # With weights, the heaviest studies are spread across the shards:
+  weights = {'SDY1': 1000, 'SDY2': 900, 'SDY3': 800, 'SDY4': 10}
+  shards = partition_studies(sids, 3, weights)
+  assert sorted(sum(shards, []), key=study_sort_key) == sids
+  assert [shard[0] for shard in shards] == ['SDY1', 'SDY2', 'SDY3']
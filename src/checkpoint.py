@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+#
+# Checkpointing for long batch_validate runs. The output for every study is written to a segment
+# file of its own, and a manifest records which studies have been completed. An interrupted run can
+# then be resumed, skipping the completed studies, and once every study has been processed the
+# segments are concatenated into the final output file.
+
+import io
+import json
+import os
+import shutil
+
+from writers import TsvWriter
+
+
+def atomic_write(path, data):
+  """
+  Write the given bytes to the file at `path` such that readers will see either the old contents
+  of the file or the new contents, but never a partially written file.
+  """
+  tmppath = path + '.tmp'
+  with open(tmppath, 'wb') as f:
+    f.write(data)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(tmppath, path)
+
+
+class Checkpoint:
+  """
+  A directory of per-study output segments together with a manifest (manifest.json) describing
+  them. The manifest records the output format, the field names, and for every completed study the
+  name of its segment file, its number of records, and the time it took to process.
+  """
+  def __init__(self, path, format_name=None, fieldnames=None):
+    self.path = path
+    self.manifest = {'format': format_name, 'fieldnames': fieldnames, 'studies': {}}
+
+  def manifest_path(self):
+    return os.path.join(self.path, 'manifest.json')
+
+  def load(self):
+    """
+    Load the manifest of an existing checkpoint directory, if there is one. Raises an exception if
+    that checkpoint was written in a different format than the one requested (if any).
+    """
+    try:
+      with open(self.manifest_path()) as f:
+        manifest = json.load(f)
+    except FileNotFoundError:
+      return
+    if self.manifest['format'] and manifest['format'] != self.manifest['format']:
+      raise Exception("The checkpoint in {} was written in the '{}' format, not '{}'"
+                      .format(self.path, manifest['format'], self.manifest['format']))
+    self.manifest = manifest
+
+  def clear(self):
+    """
+    Remove every segment and the manifest, and start over.
+    """
+    shutil.rmtree(self.path, ignore_errors=True)
+    self.manifest['studies'] = {}
+
+  def save(self):
+    os.makedirs(self.path, exist_ok=True)
+    atomic_write(self.manifest_path(),
+                 json.dumps(self.manifest, indent=2, sort_keys=True).encode('utf-8'))
+
+  def format_name(self):
+    return self.manifest['format']
+
+  def fieldnames(self):
+    return self.manifest['fieldnames']
+
+  def set_fieldnames(self, fieldnames):
+    self.manifest['fieldnames'] = fieldnames
+
+  def completed(self, sid):
+    return sid in self.manifest['studies']
+
+  def completed_studies(self):
+    return self.manifest['studies']
+
+  def write_segment(self, sid, writer_class, rows, seconds=0):
+    """
+    Write the given rows for the given study to a segment using an instance of writer_class, and
+    then record the study as completed in the manifest.
+    """
+    segment = None
+    if rows:
+      buf = io.BytesIO()
+      writer_class(buf, self.fieldnames()).write_rows(rows)
+      segment = '{}.{}'.format(sid, writer_class.extension)
+      os.makedirs(self.path, exist_ok=True)
+      atomic_write(os.path.join(self.path, segment), buf.getvalue())
+    self.record(sid, segment, len(rows), seconds)
+
+  def record(self, sid, segment, records, seconds=0):
+    self.manifest['studies'][sid] = {
+      'segment': segment,
+      'records': records,
+      'seconds': round(seconds, 3)
+    }
+    self.save()
+
+  def segment_path(self, sid):
+    segment = self.manifest['studies'][sid]['segment']
+    return os.path.join(self.path, segment) if segment else None
+
+  def get_info(self, key):
+    return self.manifest.get(key)
+
+  def set_info(self, key, value):
+    """
+    Record some additional information about this checkpoint in its manifest (e.g. which shard of
+    a sharded run it belongs to).
+    """
+    self.manifest[key] = value
+
+  def finalize(self, outpath, writer_class, sids):
+    """
+    Write the header followed by the segments for the given studies, in order, to the file at
+    `outpath`.
+    """
+    concatenate_segments([self], outpath, writer_class, sids)
+
+
+def concatenate_segments(checkpoints, outpath, writer_class, sids):
+  """
+  Write the header followed by the segments for the given studies, in order, to the file at
+  `outpath`, taking the segment for each study from whichever of the given checkpoints contains it.
+  All of the checkpoints must have the same field names. The file is first written to a temporary
+  path which then replaces `outpath`.
+  """
+  tmppath = outpath + '.tmp'
+  with open(tmppath, 'wb') as outfile:
+    writer_class(outfile, checkpoints[0].fieldnames()).write_header()
+    for sid in sids:
+      for checkpoint in checkpoints:
+        path = checkpoint.segment_path(sid) if checkpoint.completed(sid) else None
+        if path:
+          with open(path, 'rb') as segment:
+            shutil.copyfileobj(segment, outfile)
+    outfile.flush()
+    os.fsync(outfile.fileno())
+  os.replace(tmppath, outpath)
+
+
+def test_checkpoint(tmpdir):
+  path = str(tmpdir.join('fcsAnalyzed.tsv.segments'))
+  outpath = str(tmpdir.join('fcsAnalyzed.tsv'))
+  fieldnames = ['study', 'name']
+
+  checkpoint = Checkpoint(path, 'tsv', fieldnames)
+  checkpoint.write_segment('SDY2', TsvWriter, [['SDY2', 'B cells']], 0.5)
+  checkpoint.write_segment('SDY3', TsvWriter, [])
+
+  # Simulate a restart by loading the checkpoint anew:
+  checkpoint = Checkpoint(path, 'tsv')
+  checkpoint.load()
+  assert checkpoint.fieldnames() == fieldnames
+  assert checkpoint.completed('SDY2') and checkpoint.completed('SDY3')
+  assert not checkpoint.completed('SDY1')
+  checkpoint.write_segment('SDY1', TsvWriter, [['SDY1', 'T cells'], ['SDY1', 'NK cells']])
+
+  checkpoint.finalize(outpath, TsvWriter, ['SDY1', 'SDY2', 'SDY3'])
+  with open(outpath) as f:
+    assert f.read() == ('"study"\t"name"\n"SDY1"\t"T cells"\n"SDY1"\t"NK cells"\n'
+                        '"SDY2"\t"B cells"\n')
+
+  # Resuming in a different format should fail:
+  error = None
+  try:
+    Checkpoint(path, 'jsonl').load()
+  except Exception as e:
+    error = e
+  assert error and "'tsv' format" in str(error)
@@ -1,4 +1,6 @@
 import re
+from array import array
+from bisect import bisect_left, bisect_right
 from collections import defaultdict, OrderedDict
 
 
@@ -140,6 +142,35 @@ def split_gate(gate, symbols):
   return [gate, '']
 
 
+def get_gate_kinds(ontologized_gates, symbols):
+  """
+  Return the ontology ids, as IRIs, of the given ontologized gates (see normalize.py), which use the
+  short form 'PR:<id>' for PR terms.
+  """
+  return [re.sub('^PR:', 'http://purl.obolibrary.org/obo/PR_', split_gate(gate, symbols)[0])
+          for gate in ontologized_gates]
+
+
+def parse_ontologized_gates(ontologized, symbols, gate_cache=None):
+  """
+  Split the given 'Gating mapped to ontologies' field of a row of normalized.tsv into a list of
+  (kind, suffix) pairs, where each kind is an IRI, or a label prefixed with '!' for a gate that was
+  not recognized. If a gate_cache dictionary is given, each distinct gate is only split once.
+  """
+  if not ontologized:
+    return []
+  gates = []
+  for gate in re.split(r',\s+', ontologized):
+    pair = gate_cache.get(gate) if gate_cache is not None else None
+    if pair is None:
+      kind, suffix = split_gate(gate, symbols)
+      pair = (re.sub('^PR:', 'http://purl.obolibrary.org/obo/PR_', kind), suffix)
+      if gate_cache is not None:
+        gate_cache[gate] = pair
+    gates.append(pair)
+  return gates
+
+
 def get_level_names():
   """
   Returns a map from level symbols (marker suffixes) to level names
@@ -282,11 +313,26 @@ def extract_iri_short_label_maps(short_rows):
   return ishort_iris, iri_shorts
 
 
-def update_iri_maps_from_owl(root, iri_gates={}, iri_parents={}, iri_labels={}, synonym_iris={}):
+def extract_iri_parent_maps(parent_rows):
+  """
+  From the given data rows of child and parent IRIs, extract a map from IRIs to lists of their
+  parents.
+  """
+  iri_parents = defaultdict(list)
+  for row in parent_rows:
+    (iri, parent) = row
+    iri_parents[iri].append(parent)
+
+  return iri_parents
+
+
+def update_iri_maps_from_owl(root, iri_gates={}, iri_parents={}, iri_labels={}, synonym_iris={},
+                             iri_all_parents=None):
   """
   Given an XML tree root extracted from cl.owl, add mappings to the given IRI maps.
   If not all of the initial maps are provided, these are initialised empty, and the new maps are
-  then returned to the caller.
+  then returned to the caller. Since iri_parents only keeps one parent for each class, every parent
+  of each class is also added to iri_all_parents, if it is given.
   """
   if not iri_labels:
     iri_labels = get_basic_iri_labels()
@@ -327,6 +373,8 @@ def update_iri_maps_from_owl(root, iri_gates={}, iri_parents={}, iri_labels={},
           parent = part.get(rdf_about)
           if parent:
             iri_parents[iri] = parent
+            if iri_all_parents is not None:
+              iri_all_parents.setdefault(iri, []).append(parent)
         elif part.tag == owl_restriction:
           relation = part.find('owl:onProperty', ns)
           if relation is not None:
@@ -348,6 +396,246 @@ def update_iri_maps_from_owl(root, iri_gates={}, iri_parents={}, iri_labels={},
   return iri_gates, iri_parents, iri_labels, synonym_iris
 
 
+class PrefixIndex:
+  """
+  An index of names, each associated with an IRI, that can be searched by (case-insensitive)
+  prefix. The casefolded names are kept in a sorted list, so a search is a binary search followed
+  by a scan of the matches.
+  """
+  def __init__(self, names_iris=()):
+    entries = sorted(set([(name.casefold(), name, iri) for name, iri in names_iris]))
+    self.keys = [key for key, name, iri in entries]
+    self.entries = [(name, iri) for key, name, iri in entries]
+
+  def __len__(self):
+    return len(self.keys)
+
+  def complete(self, prefix, limit=10):
+    """
+    Return up to `limit` (name, IRI) pairs, for distinct IRIs, whose names start with the given
+    prefix, in alphabetical order of their names.
+    """
+    prefix = prefix.casefold()
+    matches = []
+    seen = set()
+    i = bisect_left(self.keys, prefix)
+    while i < len(self.keys) and len(matches) < limit and self.keys[i].startswith(prefix):
+      name, iri = self.entries[i]
+      if iri not in seen:
+        seen.add(iri)
+        matches.append((name, iri))
+      i += 1
+    return matches
+
+
+def iterate_bits(bits):
+  """
+  Generate the positions of the bits that are set in the given integer, from the lowest.
+  """
+  while bits:
+    lowest = bits & -bits
+    yield lowest.bit_length() - 1
+    bits ^= lowest
+
+
+class GateIndex:
+  """
+  An inverted index from gates, i.e. (kind, level) pairs, to the cells whose definitions include
+  them, built from a map of cell IRIs to their gates (see update_iri_maps_from_owl()). Every cell is
+  numbered, and each posting list is a Python integer used as a bitset of cell numbers, so that
+  intersections and exclusions are single integer operations over every cell at once.
+  """
+  def __init__(self, iri_gates={}):
+    self.cells = sorted(iri_gates)
+    self.sizes = [len(iri_gates[iri]) for iri in self.cells]
+    # From (kind, level) pairs to the cells whose definitions include them:
+    self.postings = defaultdict(int)
+    # From kinds to the cells whose definitions include them at any level:
+    self.kind_postings = defaultdict(int)
+    for i, iri in enumerate(self.cells):
+      bit = 1 << i
+      for gate in iri_gates[iri]:
+        self.postings[(gate['kind'], gate['level'])] |= bit
+        self.kind_postings[gate['kind']] |= bit
+    self.postings = dict(self.postings)
+    self.kind_postings = dict(self.kind_postings)
+
+  def __len__(self):
+    return len(self.cells)
+
+  def match(self, gates, minimum=1):
+    """
+    Find the cells whose definitions are consistent with the given (kind, level) pairs, i.e. that do
+    not include any of the given kinds at a different level, and that include at least `minimum` of
+    the given pairs. Returns a list of (cell IRI, number of pairs included, number of gates in the
+    definition) triples, from the most pairs included to the least, and then by IRI.
+    """
+    consistent = (1 << len(self.cells)) - 1
+    included = []
+    for kind, level in gates:
+      same = self.postings.get((kind, level), 0)
+      consistent &= ~(self.kind_postings.get(kind, 0) & ~same)
+      included.append(same)
+
+    # A cell that includes none of the pairs can only match if no pairs need to be included:
+    candidates = consistent
+    if minimum >= 1:
+      union = 0
+      for bits in included:
+        union |= bits
+      candidates &= union
+
+    # Count the pairs included by each candidate by visiting only the bits that are set, rather than
+    # shifting every posting list once for each candidate:
+    counts = defaultdict(int)
+    for bits in included:
+      for i in iterate_bits(bits & candidates):
+        counts[i] += 1
+    matches = []
+    for i in iterate_bits(candidates):
+      count = counts.get(i, 0)
+      if count >= minimum:
+        matches.append((self.cells[i], count, self.sizes[i]))
+    return sorted(matches, key=lambda match: (-match[1], match[0]))
+
+
+class HierarchyIndex:
+  """
+  A compiled class hierarchy, built from a map of IRIs to lists of their parents, that answers
+  subsumption queries without walking the graph. The classes are numbered in the post-order of a
+  depth-first search from the roots, so that the descendants of a class in the search tree are
+  numbered from some lower number up to the class's own number. A class with more than one parent
+  is a descendant of some classes outside of that interval, which therefore also keep a sorted list
+  of the other intervals of their descendants. Cycles are broken at the first edge that closes them.
+  """
+  def __init__(self, iri_parents={}):
+    children = defaultdict(list)
+    for iri, parents in iri_parents.items():
+      for parent in parents:
+        children[parent].append(iri)
+    iris = set(iri_parents) | set(children)
+    roots = sorted([iri for iri in iris if not iri_parents.get(iri)])
+
+    self.numbers = {}
+    # The lowest number in each class's interval, by the class's number:
+    self.lows = array('l')
+    # The other intervals of the descendants of classes with descendants outside of their interval,
+    # as parallel lists of the starts and the ends of the intervals:
+    self.extra = {}
+    intervals = {}
+    started = set()
+    # Start with the roots, then break into any cycles that cannot be reached from them:
+    for root in roots + sorted(iris):
+      if root in started:
+        continue
+      started.add(root)
+      # Each class on the stack is kept with its remaining children and the first number that its
+      # descendants in the search tree will be given:
+      stack = [(root, iter(sorted(children.get(root, []))), len(self.lows))]
+      while stack:
+        iri, remaining, low = stack[-1]
+        child = next(remaining, None)
+        if child is not None:
+          if child not in started:
+            started.add(child)
+            stack.append((child, iter(sorted(children.get(child, []))), len(self.lows)))
+          continue
+        stack.pop()
+        number = len(self.lows)
+        self.numbers[iri] = number
+        self.lows.append(low)
+        # Every child is finished before its parent, except along an edge that closes a cycle:
+        merged = merge_intervals([(low, number)] + [interval for child in children.get(iri, [])
+                                                    for interval in intervals.get(child, [])])
+        intervals[iri] = merged
+        if len(merged) > 1:
+          self.extra[iri] = ([start for start, end in merged], [end for start, end in merged])
+
+    # The classes by their numbers, and the numbers of the parents of each class (those of the
+    # class numbered n are parent_numbers[parent_offsets[n]:parent_offsets[n + 1]]), leaving out the
+    # edges that close cycles, so that the ancestors of a class agree with is_a():
+    self.iris = [None] * len(self.lows)
+    for iri, number in self.numbers.items():
+      self.iris[number] = iri
+    self.parent_offsets = array('l', [0])
+    self.parent_numbers = array('l')
+    for iri in self.iris:
+      self.parent_numbers.extend([self.numbers[parent] for parent in iri_parents.get(iri, [])
+                                  if self.is_a(iri, parent)])
+      self.parent_offsets.append(len(self.parent_numbers))
+
+  def __len__(self):
+    return len(self.numbers)
+
+  def is_a(self, iri, ancestor):
+    """
+    Return True if the class `iri` is the class `ancestor` or one of its descendants.
+    """
+    if iri == ancestor:
+      return True
+    number = self.numbers.get(iri)
+    ancestor_number = self.numbers.get(ancestor)
+    if number is None or ancestor_number is None:
+      return False
+    if self.lows[ancestor_number] <= number <= ancestor_number:
+      return True
+    if ancestor in self.extra:
+      starts, ends = self.extra[ancestor]
+      i = bisect_right(starts, number) - 1
+      return i >= 0 and number <= ends[i]
+    return False
+
+  def ancestors(self, iri):
+    """
+    Return the set of the given class and all of its ancestors.
+    """
+    number = self.numbers.get(iri)
+    if number is None:
+      return {iri}
+    seen = {number}
+    stack = [number]
+    while stack:
+      number = stack.pop()
+      for parent in self.parent_numbers[self.parent_offsets[number]:
+                                        self.parent_offsets[number + 1]]:
+        if parent not in seen:
+          seen.add(parent)
+          stack.append(parent)
+    return {self.iris[number] for number in seen}
+
+  def related(self, iri, other):
+    """
+    Return True if either of the given classes is the other or one of its descendants.
+    """
+    return self.is_a(iri, other) or self.is_a(other, iri)
+
+  def contradicts(self, kind, present, other_kind, other_present):
+    """
+    Return True if a gate on `kind` (present or absent) contradicts a gate on `other_kind` because
+    one kind is a subtype of the other: nothing that lacks a protein can have a form of it.
+    """
+    if present and not other_present:
+      return self.is_a(kind, other_kind)
+    if other_present and not present:
+      return self.is_a(other_kind, kind)
+    return False
+
+
+def merge_intervals(intervals):
+  """
+  Merge the given (start, end) pairs of integers into a sorted list of disjoint, non-adjacent
+  intervals covering the same integers.
+  """
+  merged = []
+  for start, end in sorted(intervals):
+    if merged and start <= merged[-1][1] + 1:
+      if end > merged[-1][1]:
+        merged[-1] = (merged[-1][0], end)
+    else:
+      merged.append((start, end))
+  return merged
+
+
 class IriMaps:
   """
   Container for shared IRI maps. Useful when an instance of these maps needs to be shared by
@@ -375,6 +663,28 @@ class IriMaps:
     # From IRIs to gates
     self.iri_gates = {}
 
+    # The hierarchy of PR terms (e.g. the isoforms and modified forms of a protein are subtypes of
+    # it):
+    self.pr_hierarchy = HierarchyIndex()
+
+    # From cell IRIs to the decorated information about them that the server precomputes when it
+    # loads the maps:
+    self.iri_cells = {}
+
+    # From gates to the cells whose definitions include them:
+    self.gate_cells = GateIndex()
+
+    # The levels of the markers in every cell definition, for ranking cells by how close they are to
+    # a gating definition (see ranking.py):
+    self.cell_ranking = None
+
+    # Prefix indexes of the names of cells and of gates, for autocompletion:
+    self.cell_index = PrefixIndex()
+    self.gate_index = PrefixIndex()
+
+    # Identifies the versions of the files that the maps were loaded from, if any:
+    self.version = None
+
     # From suffix names to their corresponding symbols:
     self.suffixsymbs = {}
 
@@ -398,3 +708,75 @@ class IriMaps:
 
     # From IRIs to shorts:
     self.iri_shorts = {}
+
+
+def test_parse_ontologized_gates():
+  symbols = get_level_iris().keys()
+  assert parse_ontologized_gates('PR:000001004++, !foo-, http://example.com/singlets', symbols) == [
+    ('http://purl.obolibrary.org/obo/PR_000001004', '++'), ('!foo', '-'),
+    ('http://example.com/singlets', '')]
+  assert parse_ontologized_gates('', symbols) == []
+
+
+def test_gate_index():
+  pos = 'http://purl.obolibrary.org/obo/RO_0002104'
+  neg = 'http://purl.obolibrary.org/obo/cl#lacks_plasma_membrane_part'
+  iri_gates = {
+    'T cell': [{'kind': 'CD3', 'level': pos}],
+    'CD4 T cell': [{'kind': 'CD3', 'level': pos}, {'kind': 'CD4', 'level': pos},
+                   {'kind': 'CD8', 'level': neg}],
+    'CD8 T cell': [{'kind': 'CD3', 'level': pos}, {'kind': 'CD8', 'level': pos}],
+    'B cell': [{'kind': 'CD3', 'level': neg}, {'kind': 'CD19', 'level': pos}],
+    'cell': []}
+  index = GateIndex(iri_gates)
+  assert len(index) == 5
+  assert list(iterate_bits(0b10110)) == [1, 2, 4]
+
+  assert index.match([('CD3', pos), ('CD4', pos)]) == [
+    ('CD4 T cell', 2, 3), ('CD8 T cell', 1, 2), ('T cell', 1, 1)]
+  assert index.match([('CD3', pos), ('CD8', neg)], minimum=2) == [('CD4 T cell', 2, 3)]
+  assert index.match([('CD3', pos), ('CCR7', neg)], minimum=0) == [
+    ('CD4 T cell', 1, 3), ('CD8 T cell', 1, 2), ('T cell', 1, 1), ('cell', 0, 0)]
+  assert index.match([('CD19', pos), ('CD3', pos)]) == [
+    ('CD4 T cell', 1, 3), ('CD8 T cell', 1, 2), ('T cell', 1, 1)]
+
+
+def test_hierarchy_index():
+  hierarchy = HierarchyIndex({
+    'CD4 isoform 1': ['CD4'],
+    'CD4 isoform 2': ['CD4'],
+    'phosphorylated CD4 isoform 1': ['CD4 isoform 1', 'phosphorylated CD4'],
+    'phosphorylated CD4': ['CD4'],
+    'CD4': ['protein'],
+    'CD8': ['protein'],
+    'loop 1': ['loop 2'],
+    'loop 2': ['loop 1']
+  })
+  assert len(hierarchy) == 9
+  assert hierarchy.is_a('CD4 isoform 1', 'CD4')
+  assert hierarchy.is_a('phosphorylated CD4 isoform 1', 'CD4 isoform 1')
+  assert hierarchy.is_a('phosphorylated CD4 isoform 1', 'phosphorylated CD4')
+  assert hierarchy.is_a('phosphorylated CD4 isoform 1', 'protein')
+  assert hierarchy.is_a('CD8', 'CD8') and hierarchy.is_a('unknown', 'unknown')
+  assert not hierarchy.is_a('CD4', 'CD4 isoform 1')
+  assert not hierarchy.is_a('CD4 isoform 2', 'CD4 isoform 1')
+  assert not hierarchy.is_a('phosphorylated CD4 isoform 1', 'CD4 isoform 2')
+  assert not hierarchy.is_a('CD8', 'CD4') and not hierarchy.is_a('unknown', 'protein')
+  # The cycle is broken at the edge from loop 2 back to loop 1:
+  assert hierarchy.is_a('loop 2', 'loop 1') and not hierarchy.is_a('loop 1', 'loop 2')
+  assert hierarchy.related('CD4', 'CD4 isoform 2') and not hierarchy.related('CD4', 'CD8')
+  assert hierarchy.ancestors('phosphorylated CD4 isoform 1') == {
+    'phosphorylated CD4 isoform 1', 'CD4 isoform 1', 'phosphorylated CD4', 'CD4', 'protein'}
+  assert hierarchy.ancestors('CD8') == {'CD8', 'protein'}
+  assert hierarchy.ancestors('unknown') == {'unknown'}
+  assert hierarchy.ancestors('loop 1') == {'loop 1'} and hierarchy.ancestors('loop 2') == {
+    'loop 1', 'loop 2'}
+
+  # A protein that is absent cannot have a form that is present, but the converse is possible:
+  assert hierarchy.contradicts('CD4 isoform 1', True, 'CD4', False)
+  assert hierarchy.contradicts('CD4', False, 'CD4 isoform 1', True)
+  assert not hierarchy.contradicts('CD4 isoform 1', False, 'CD4', True)
+  assert not hierarchy.contradicts('CD4 isoform 1', True, 'CD4', True)
+  assert not hierarchy.contradicts('CD8', True, 'CD4', False)
+
+  assert merge_intervals([(5, 6), (0, 2), (3, 4), (1, 2), (8, 9)]) == [(0, 6), (8, 9)]
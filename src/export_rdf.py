@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+#
+# Exports the cell populations in normalized.tsv (see normalize.py) as linked data, in N-Triples or
+# Turtle, ready to be loaded into a triple store. Every population becomes an OWL individual, typed
+# with its CL cell type (if it has one) and with a restriction for each recognized gate of its
+# reported definition, like those of the CL logical definitions: e.g. CD4+ becomes 'has plasma
+# membrane part' some CD4 molecule, and CD19- becomes 'lacks plasma membrane part' some CD19
+# molecule. Rows are read and written one at a time, so a corpus of any size is exported in constant
+# memory. In Turtle, IRIs are abbreviated using the prefixes declared at the top of the file.
+
+import argparse
+import csv
+import hashlib
+import io
+import re
+from collections import OrderedDict
+from itertools import count
+
+from common import get_level_iris, parse_ontologized_gates
+
+OBO = 'http://purl.obolibrary.org/obo/'
+RDF_TYPE = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#type'
+RDFS_LABEL = 'http://www.w3.org/2000/01/rdf-schema#label'
+RDFS_COMMENT = 'http://www.w3.org/2000/01/rdf-schema#comment'
+OWL_NAMED_INDIVIDUAL = 'http://www.w3.org/2002/07/owl#NamedIndividual'
+OWL_RESTRICTION = 'http://www.w3.org/2002/07/owl#Restriction'
+OWL_ON_PROPERTY = 'http://www.w3.org/2002/07/owl#onProperty'
+OWL_SOME_VALUES_FROM = 'http://www.w3.org/2002/07/owl#someValuesFrom'
+DCTERMS_SOURCE = 'http://purl.org/dc/terms/source'
+
+# The namespace of the IRIs of the populations, unless another is given:
+DEFAULT_BASE = 'urn:hipc-gates:population:'
+
+# The prefixes declared in Turtle output, along with 'pop' for the populations' namespace:
+NAMESPACES = OrderedDict([
+  ('rdf', 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'),
+  ('rdfs', 'http://www.w3.org/2000/01/rdf-schema#'),
+  ('owl', 'http://www.w3.org/2002/07/owl#'),
+  ('dcterms', 'http://purl.org/dc/terms/'),
+  ('obo', OBO),
+  ('cl', OBO + 'cl#')
+])
+
+# The local part of an IRI can only be abbreviated if it matches this (a subset of what Turtle
+# allows, which is enough for the IRIs that we write):
+LOCAL_NAME = re.compile(r'^[A-Za-z0-9_]([A-Za-z0-9_.-]*[A-Za-z0-9_-])?$')
+
+
+class Literal(str):
+  """
+  A plain string literal, as opposed to an IRI or a blank node label.
+  """
+  pass
+
+
+def escape_literal(value):
+  """
+  Return the given string as a quoted N-Triples (and Turtle) string literal.
+  """
+  value = value.replace('\\', '\\\\').replace('"', '\\"')
+  return '"' + value.replace('\n', '\\n').replace('\r', '\\r') + '"'
+
+
+def get_population_iri(row, base=DEFAULT_BASE):
+  """
+  Return the IRI of the population in the given row of normalized.tsv, which is based on a hash of
+  its study and experiment and its reported name and definition, so that it stays the same from one
+  export to the next.
+  """
+  key = '\t'.join([row['STUDY_ACCESSION'], row['EXPERIMENT_ACCESSION'],
+                   row['POPULATION_NAME_REPORTED'], row['POPULATION_DEFNITION_REPORTED']])
+  return base + hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+def get_population_triples(row, base=DEFAULT_BASE, blank_ids=None):
+  """
+  Generate the (subject, predicate, object) triples describing the population in the given row of
+  normalized.tsv. Objects are IRIs, blank node labels (from the given counter), or Literals. Gates
+  that were not recognized, or that have no level (e.g. 'singlets'), are left out.
+  """
+  blank_ids = blank_ids or count(1)
+  level_iris = get_level_iris()
+  population = get_population_iri(row, base)
+  yield population, RDF_TYPE, OWL_NAMED_INDIVIDUAL
+  cell_type = re.sub('^CL:', OBO + 'CL_', row['CL ID'])
+  if cell_type:
+    yield population, RDF_TYPE, cell_type
+  yield population, RDFS_LABEL, Literal(row['POPULATION_NAME_REPORTED'])
+  if row['POPULATION_DEFNITION_REPORTED']:
+    yield population, RDFS_COMMENT, Literal(row['POPULATION_DEFNITION_REPORTED'])
+  for accession in [row['STUDY_ACCESSION'], row['EXPERIMENT_ACCESSION']]:
+    if accession:
+      yield population, DCTERMS_SOURCE, Literal(accession)
+
+  restrictions = []
+  gates = parse_ontologized_gates(row['Gating mapped to ontologies'], level_iris.keys())
+  for kind, suffix in gates:
+    level = level_iris.get(suffix)
+    if level and not kind.startswith('!') and (level, kind) not in restrictions:
+      restrictions.append((level, kind))
+  # The population's own triples come first, so that they can be grouped together in Turtle:
+  nodes = ['_:r{}'.format(next(blank_ids)) for restriction in restrictions]
+  for node in nodes:
+    yield population, RDF_TYPE, node
+  for node, (level, kind) in zip(nodes, restrictions):
+    yield node, RDF_TYPE, OWL_RESTRICTION
+    yield node, OWL_ON_PROPERTY, level
+    yield node, OWL_SOME_VALUES_FROM, kind
+
+
+class NTriplesWriter:
+  """
+  Writes triples as N-Triples, one per line.
+  """
+  extension = 'nt'
+
+  def __init__(self, outfile, base=DEFAULT_BASE):
+    self.outfile = outfile
+    self.base = base
+
+  def format_term(self, term):
+    if isinstance(term, Literal):
+      return escape_literal(term)
+    if term.startswith('_:'):
+      return term
+    return '<' + term + '>'
+
+  def write_header(self):
+    pass
+
+  def write_triples(self, triples):
+    self.outfile.write(''.join(['{} {} {} .\n'.format(*map(self.format_term, triple))
+                                for triple in triples]))
+
+
+class TurtleWriter(NTriplesWriter):
+  """
+  Writes triples as Turtle, abbreviating IRIs with the prefixes in NAMESPACES (and 'pop' for the
+  populations) and grouping consecutive triples about the same subject.
+  """
+  extension = 'ttl'
+
+  def __init__(self, outfile, base=DEFAULT_BASE):
+    super().__init__(outfile, base)
+    self.namespaces = OrderedDict(NAMESPACES)
+    self.namespaces['pop'] = base
+    # Longer namespaces are tried first, so that e.g. 'cl:' is preferred over 'obo:':
+    self.prefixes = sorted(self.namespaces.items(), key=lambda item: -len(item[1]))
+
+  def format_term(self, term):
+    if isinstance(term, Literal) or term.startswith('_:'):
+      return super().format_term(term)
+    if term == RDF_TYPE:
+      return 'a'
+    for prefix, namespace in self.prefixes:
+      if term.startswith(namespace) and LOCAL_NAME.match(term[len(namespace):]):
+        return prefix + ':' + term[len(namespace):]
+    return '<' + term + '>'
+
+  def write_header(self):
+    self.outfile.write(''.join(['@prefix {}: <{}> .\n'.format(prefix, namespace)
+                                for prefix, namespace in self.namespaces.items()]) + '\n')
+
+  def write_triples(self, triples):
+    lines = []
+    subject = None
+    for triple in triples:
+      s, p, o = map(self.format_term, triple)
+      if s == subject:
+        lines[-1] += ' ;'
+        lines.append('    {} {}'.format(p, o))
+      else:
+        if subject:
+          lines[-1] += ' .'
+        lines.append('{} {} {}'.format(s, p, o))
+        subject = s
+    if lines:
+      self.outfile.write('\n'.join(lines) + ' .\n\n')
+
+
+# Map from the names accepted on the command line to writer classes:
+WRITERS = {
+  'ntriples': NTriplesWriter,
+  'turtle': TurtleWriter
+}
+
+
+def export(rows, writer):
+  """
+  Write every population in the given rows of normalized.tsv with the given writer, and return the
+  number of populations and of the restrictions on them that were written.
+  """
+  blank_ids = count(1)
+  writer.write_header()
+  populations = 0
+  for row in rows:
+    writer.write_triples(get_population_triples(row, writer.base, blank_ids))
+    populations += 1
+  return populations, next(blank_ids) - 1
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='Export the populations in normalized.tsv as N-Triples or Turtle')
+  parser.add_argument('normalized', type=argparse.FileType('r'),
+                      help='a normalized TSV file, generated by normalize.py')
+  parser.add_argument('output', type=str,
+                      help='the output file, in Turtle if its name ends in .ttl, or else N-Triples')
+  parser.add_argument('--format', choices=sorted(WRITERS),
+                      help='the output format, overriding the name of the output file')
+  parser.add_argument('--base', type=str, default=DEFAULT_BASE,
+                      help='the namespace of the IRIs of the populations (default: {})'
+                      .format(DEFAULT_BASE))
+  args = parser.parse_args()
+
+  format_name = args.format or ('turtle' if args.output.endswith('.ttl') else 'ntriples')
+  rows = csv.DictReader(args.normalized, delimiter='\t')
+  with open(args.output, 'w') as output:
+    populations, restrictions = export(rows, WRITERS[format_name](output, args.base))
+  print('Exported {} populations with {} restrictions'.format(populations, restrictions))
+
+
+if __name__ == "__main__":
+  main()
+
+
+# Unit tests for use with the tool `pytest` are defined below. To run these, run
+# `pytest export_rdf.py` from the command line.
+
+def test_export():
+  rows = [{
+    'STUDY_ACCESSION': 'SDY1',
+    'EXPERIMENT_ACCESSION': 'EXP1',
+    'POPULATION_NAME_REPORTED': 'CD4 "T" cells',
+    'POPULATION_DEFNITION_REPORTED': 'CD4+\nCD19-',
+    'CL ID': 'CL:0000624',
+    'Gating mapped to ontologies': 'PR:000001004+, PR:000001002-, !foo++, PR:000001004+'
+  }, {
+    'STUDY_ACCESSION': 'SDY1',
+    'EXPERIMENT_ACCESSION': '',
+    'POPULATION_NAME_REPORTED': 'singlets',
+    'POPULATION_DEFNITION_REPORTED': '',
+    'CL ID': '',
+    'Gating mapped to ontologies': 'http://example.com/singlets'
+  }]
+  first = get_population_iri(rows[0], 'http://example.com/')
+  assert re.match('^http://example.com/[0-9a-f]{16}$', first)
+  assert first != get_population_iri(rows[1], 'http://example.com/')
+
+  output = io.StringIO()
+  assert export(rows, NTriplesWriter(output, 'http://example.com/')) == (2, 2)
+  lines = output.getvalue().splitlines()
+  assert len(lines) == 17 and all([line.endswith(' .') for line in lines])
+  assert lines[0] == '<{}> <{}> <{}> .'.format(first, RDF_TYPE, OWL_NAMED_INDIVIDUAL)
+  assert lines[2] == '<{}> <{}> "CD4 \\"T\\" cells" .'.format(first, RDFS_LABEL)
+  assert lines[3] == '<{}> <{}> "CD4+\\nCD19-" .'.format(first, RDFS_COMMENT)
+  assert lines[8:12] == [
+    '_:r1 <{}> <{}> .'.format(RDF_TYPE, OWL_RESTRICTION),
+    '_:r1 <{}> <{}RO_0002104> .'.format(OWL_ON_PROPERTY, OBO),
+    '_:r1 <{}> <{}PR_000001004> .'.format(OWL_SOME_VALUES_FROM, OBO),
+    '_:r2 <{}> <{}> .'.format(RDF_TYPE, OWL_RESTRICTION)]
+
+  output = io.StringIO()
+  export(rows, TurtleWriter(output))
+  turtle = output.getvalue()
+  assert turtle.startswith('@prefix rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#> .\n')
+  assert '@prefix pop: <{}> .\n'.format(DEFAULT_BASE) in turtle
+  assert '''
+pop:{} a owl:NamedIndividual ;
+    a obo:CL_0000624 ;
+    rdfs:label "CD4 \\"T\\" cells" ;
+    rdfs:comment "CD4+\\nCD19-" ;
+    dcterms:source "SDY1" ;
+    dcterms:source "EXP1" ;
+    a _:r1 ;
+    a _:r2 .
+_:r1 a owl:Restriction ;
+    owl:onProperty obo:RO_0002104 ;
+    owl:someValuesFrom obo:PR_000001004 .
+_:r2 a owl:Restriction ;
+    owl:onProperty cl:lacks_plasma_membrane_part ;
+    owl:someValuesFrom obo:PR_000001002 .
+'''.format(get_population_iri(rows[0])[len(DEFAULT_BASE):]) in turtle
+
+  # IRIs that cannot be abbreviated are written in full:
+  writer = TurtleWriter(io.StringIO())
+  assert writer.format_term('http://example.com/singlets') == '<http://example.com/singlets>'
+  high = get_level_iris()['++']
+  assert writer.format_term(high) == 'cl:has_high_plasma_membrane_amount'
+  assert writer.format_term(OBO + 'UBERON_0000178/x') == '<{}UBERON_0000178/x>'.format(OBO)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+#
+# Selects the Protein Ontology terms worth keeping in the PR lookup tables, from the N-triples
+# version of pr.owl (the output of the `rapper` utility). Obsolete terms are dropped, and if one or
+# more taxa are given, so are the organism-specific terms that are not in any of those taxa or in
+# one of their ancestors (e.g. human terms are kept for Homo sapiens, and so are mammalian terms,
+# but not mouse terms). Organism-agnostic terms, such as gene-level terms, are always kept. The IRIs
+# of the terms that are kept are written to standard output, one per line, and the dropped terms can
+# be logged to a TSV file along with the reason for dropping them.
+
+import argparse
+import csv
+import re
+import sys
+
+from common import HierarchyIndex
+
+PR = '<http://purl.obolibrary.org/obo/PR_0'
+TAXON = 'http://purl.obolibrary.org/obo/NCBITaxon_'
+# The relations used by PR to restrict terms to taxa (only in taxon, and in taxon):
+TAXON_RELATIONS = ['<http://purl.obolibrary.org/obo/RO_0002160>',
+                   '<http://purl.obolibrary.org/obo/RO_0002162>']
+
+RDFS_LABEL = '<http://www.w3.org/2000/01/rdf-schema#label>'
+RDFS_SUBCLASS_OF = '<http://www.w3.org/2000/01/rdf-schema#subClassOf>'
+OWL_DEPRECATED = '<http://www.w3.org/2002/07/owl#deprecated>'
+OWL_ON_PROPERTY = '<http://www.w3.org/2002/07/owl#onProperty>'
+OWL_SOME_VALUES_FROM = '<http://www.w3.org/2002/07/owl#someValuesFrom>'
+
+
+def get_taxon_iri(taxon):
+  """
+  Return the IRI of the given taxon, which can be given as an IRI, a CURIE (NCBITaxon:9606), or
+  just the NCBI taxonomy id.
+  """
+  if taxon.startswith('http'):
+    return taxon
+  return TAXON + re.sub('^NCBITaxon[:_]', '', taxon)
+
+
+def read_terms(lines):
+  """
+  Read the given N-triples lines and return a map from the IRIs of the PR terms to their labels,
+  whether they are obsolete, and the taxa they are restricted to, along with a map from taxa to
+  their parents. The restrictions of a term may come before or after the triples that describe
+  them, so they are only resolved once every line has been read.
+  """
+  terms = {}
+  # From PR terms to the blank nodes of their superclasses:
+  term_restrictions = {}
+  # From blank nodes to the taxa in their someValuesFrom, and the blank nodes with taxon relations:
+  restriction_taxa = {}
+  taxon_restrictions = set()
+  taxon_parents = {}
+
+  for line in lines:
+    parts = line.rstrip('\n').split(' ', 2)
+    if len(parts) < 3:
+      continue
+    subject, predicate, rest = parts
+    value = rest[:-2] if rest.endswith(' .') else rest
+
+    if subject.startswith(PR):
+      iri = subject.strip('<>')
+      term = terms.setdefault(iri, {'label': '', 'obsolete': False, 'taxa': set()})
+      if predicate == RDFS_LABEL:
+        term['label'] = value.split('"')[1] if '"' in value else value
+      elif predicate == OWL_DEPRECATED:
+        term['obsolete'] = value.startswith('"true"')
+      elif predicate == RDFS_SUBCLASS_OF and value.startswith('_:'):
+        term_restrictions.setdefault(iri, []).append(value)
+    elif subject.startswith('_:'):
+      if predicate == OWL_ON_PROPERTY and value in TAXON_RELATIONS:
+        taxon_restrictions.add(subject)
+      elif predicate == OWL_SOME_VALUES_FROM and value.startswith('<' + TAXON):
+        restriction_taxa[subject] = value.strip('<>')
+    elif subject.startswith('<' + TAXON) and predicate == RDFS_SUBCLASS_OF:
+      taxon_parents.setdefault(subject.strip('<>'), []).append(value.strip('<>'))
+
+  for iri, restrictions in term_restrictions.items():
+    for restriction in restrictions:
+      if restriction in taxon_restrictions and restriction in restriction_taxa:
+        terms[iri]['taxa'].add(restriction_taxa[restriction])
+
+  return terms, taxon_parents
+
+
+def filter_terms(terms, taxa=[], taxon_parents={}, keep_obsolete=False):
+  """
+  Split the given terms (see read_terms()) into the sorted list of the IRIs of the terms to keep,
+  and a sorted list of [IRI, label, reason] rows for the terms to drop. Terms restricted to taxa are
+  only kept, if any taxa are given, when one of the given taxa is one of their taxa or a descendant
+  of one of them.
+  """
+  taxa = [get_taxon_iri(taxon) for taxon in taxa]
+  taxon_hierarchy = HierarchyIndex(taxon_parents)
+  kept = []
+  dropped = []
+  for iri in sorted(terms):
+    term = terms[iri]
+    if term['obsolete'] and not keep_obsolete:
+      dropped.append([iri, term['label'], 'obsolete'])
+      continue
+    in_taxa = any([taxon_hierarchy.is_a(taxon, term_taxon)
+                   for taxon in taxa for term_taxon in term['taxa']])
+    if taxa and term['taxa'] and not in_taxa:
+      dropped.append([iri, term['label'], 'taxon ' + ' '.join(sorted(term['taxa']))])
+    else:
+      kept.append(iri)
+  return kept, dropped
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='Select the PR terms to keep, from a file of N-triples generated by rapper')
+  parser.add_argument('infile', type=argparse.FileType('r'),
+                      help='a file generated by rapper consisting of N-triples')
+  parser.add_argument('--taxon', action='append', default=[],
+                      help='keep only organism-specific terms in this taxon (e.g. NCBITaxon:9606) '
+                      'or one of its ancestors; can be given more than once')
+  parser.add_argument('--keep-obsolete', action='store_true', help='keep obsolete terms')
+  parser.add_argument('--log', type=argparse.FileType('w'),
+                      help='a TSV file to log the dropped terms to')
+  args = parser.parse_args()
+
+  terms, taxon_parents = read_terms(args.infile)
+  kept, dropped = filter_terms(terms, args.taxon, taxon_parents, args.keep_obsolete)
+  for iri in kept:
+    print(iri)
+
+  if args.log:
+    w = csv.writer(args.log, delimiter='\t', lineterminator='\n')
+    w.writerow(['Ontology ID', 'Label', 'Reason'])
+    for row in dropped:
+      w.writerow(row)
+  print('Kept {} of {} PR terms'.format(len(kept), len(terms)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+  main()
+
+
+# Unit tests for use with the tool `pytest` are defined below. To run these, run
+# `pytest <this script name>.py` from the command line.
+
+def test_filter_terms():
+  obo = 'http://purl.obolibrary.org/obo/'
+  ntriples = (
+    '<{0}PR_000001004> <{1}> "CD4 molecule"^^<http://www.w3.org/2001/XMLSchema#string> .\n'
+    '<{0}PR_P01730> <{1}> "T-cell surface glycoprotein CD4 (human)" .\n'
+    '<{0}PR_000001004> <{1}> "CD4 molecule" .\n'
+    '<{0}PR_000001005> <{1}> "CD4 molecule (human)" .\n'
+    '_:genid1 <http://www.w3.org/2002/07/owl#onProperty> <{0}RO_0002160> .\n'
+    '_:genid1 <http://www.w3.org/2002/07/owl#someValuesFrom> <{0}NCBITaxon_9606> .\n'
+    '<{0}PR_000001005> <{2}> _:genid1 .\n'
+    '<{0}PR_000001006> <{1}> "CD4 molecule (mouse)" .\n'
+    '<{0}PR_000001006> <{2}> _:genid2 .\n'
+    '_:genid2 <http://www.w3.org/2002/07/owl#onProperty> <{0}RO_0002160> .\n'
+    '_:genid2 <http://www.w3.org/2002/07/owl#someValuesFrom> <{0}NCBITaxon_10090> .\n'
+    '<{0}PR_000001007> <{1}> "CD4 molecule (mammal)" .\n'
+    '<{0}PR_000001007> <{2}> _:genid3 .\n'
+    '_:genid3 <http://www.w3.org/2002/07/owl#onProperty> <{0}RO_0002160> .\n'
+    '_:genid3 <http://www.w3.org/2002/07/owl#someValuesFrom> <{0}NCBITaxon_40674> .\n'
+    '<{0}PR_000001008> <{1}> "obsolete CD4" .\n'
+    '<{0}PR_000001008> <http://www.w3.org/2002/07/owl#deprecated> '
+    '"true"^^<http://www.w3.org/2001/XMLSchema#boolean> .\n'
+    '<{0}NCBITaxon_9606> <{2}> <{0}NCBITaxon_40674> .\n'
+    '<{0}NCBITaxon_10090> <{2}> <{0}NCBITaxon_40674> .\n'
+  ).format(obo, 'http://www.w3.org/2000/01/rdf-schema#label',
+           'http://www.w3.org/2000/01/rdf-schema#subClassOf')
+
+  terms, taxon_parents = read_terms(ntriples.splitlines())
+  assert sorted(terms) == [obo + 'PR_000001004', obo + 'PR_000001005', obo + 'PR_000001006',
+                           obo + 'PR_000001007', obo + 'PR_000001008']
+  assert terms[obo + 'PR_000001005'] == {
+    'label': 'CD4 molecule (human)', 'obsolete': False, 'taxa': {obo + 'NCBITaxon_9606'}}
+
+  kept, dropped = filter_terms(terms)
+  assert len(kept) == 4 and dropped == [[obo + 'PR_000001008', 'obsolete CD4', 'obsolete']]
+
+  kept, dropped = filter_terms(terms, ['NCBITaxon:9606'], taxon_parents)
+  assert kept == [obo + 'PR_000001004', obo + 'PR_000001005', obo + 'PR_000001007']
+  assert dropped == [
+    [obo + 'PR_000001006', 'CD4 molecule (mouse)', 'taxon ' + obo + 'NCBITaxon_10090'],
+    [obo + 'PR_000001008', 'obsolete CD4', 'obsolete']]
+
+  kept, dropped = filter_terms(terms, ['10090'], taxon_parents, keep_obsolete=True)
+  assert obo + 'PR_000001008' in kept and obo + 'PR_000001005' not in kept
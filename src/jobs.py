@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+#
+# A local queue of background jobs for the server, used to validate tables that are too large to
+# validate within a single request. Jobs are run by a pool of worker threads, and every job has a
+# directory of its own in the store's directory, holding its status (status.json) and its results so
+# far (results.jsonl, one JSON object per line). Since the state of every job is kept on disk, any
+# process sharing the directory (e.g. every worker of the pre-forking server) can report on any job.
+# Only the most recent finished jobs are kept.
+
+import json
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from checkpoint import atomic_write
+
+# How often, in seconds, the status of a running job is written out:
+PROGRESS_INTERVAL = 0.5
+
+
+def is_alive(pid):
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    pass
+  return True
+
+
+class JobStore:
+  """
+  Runs jobs, each of which processes a list of items, using `workers` threads, and keeps the status
+  and the results of up to `max_jobs` jobs in `directory`.
+  """
+  def __init__(self, directory, workers=2, max_jobs=100):
+    self.directory = directory
+    self.workers = workers
+    self.max_jobs = max_jobs
+    self.executor = None
+    self.lock = Lock()
+
+  def job_path(self, job_id, name=''):
+    return os.path.join(self.directory, job_id, name)
+
+  def write_status(self, status):
+    atomic_write(self.job_path(status['id'], 'status.json'),
+                 json.dumps(status, sort_keys=True).encode('utf-8'))
+
+  def submit(self, items, process):
+    """
+    Queue a job that calls `process(items)`, which should generate a result (a JSON-serializable
+    object) for each of the items, in order. Returns the id of the job.
+    """
+    with self.lock:
+      # The threads are only started when they are first needed, i.e. after any forking:
+      if self.executor is None:
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+    self.evict(self.max_jobs - 1)
+
+    job_id = uuid.uuid4().hex
+    os.makedirs(self.job_path(job_id))
+    status = {
+      'id': job_id,
+      'state': 'queued',
+      'total': len(items),
+      'processed': 0,
+      'created': time.time(),
+      'started': None,
+      'finished': None,
+      'error': None,
+      'pid': os.getpid()
+    }
+    self.write_status(status)
+    self.executor.submit(self.run, status, items, process)
+    return job_id
+
+  def run(self, status, items, process):
+    status.update(state='running', started=time.time())
+    self.write_status(status)
+    last_write = time.time()
+    try:
+      with open(self.job_path(status['id'], 'results.jsonl'), 'w') as f:
+        for result in process(items):
+          f.write(json.dumps(result, separators=(',', ':')) + '\n')
+          status['processed'] += 1
+          if time.time() - last_write > PROGRESS_INTERVAL:
+            f.flush()
+            self.write_status(status)
+            last_write = time.time()
+      status['state'] = 'done'
+    except Exception as e:
+      status.update(state='failed', error=str(e))
+    status['finished'] = time.time()
+    self.write_status(status)
+
+  def wait(self):
+    """
+    Wait for the jobs submitted to this store by this process to finish. No more jobs can be
+    submitted afterwards.
+    """
+    with self.lock:
+      executor = self.executor
+    if executor:
+      executor.shutdown(wait=True)
+
+  def status(self, job_id):
+    """
+    Return the status of the given job, or None if there is no such job.
+    """
+    # Job ids are generated by submit(), so anything else is not a job:
+    if not job_id.isalnum():
+      return None
+    try:
+      with open(self.job_path(job_id, 'status.json')) as f:
+        status = json.load(f)
+    except (FileNotFoundError, ValueError):
+      return None
+    if status['state'] in ['queued', 'running'] and not is_alive(status['pid']):
+      status.update(state='failed', error='The process running the job has exited')
+    return status
+
+  def results(self, job_id, offset=0, limit=None):
+    """
+    Generate the results of the given job that have been written so far, from `offset`, and up to
+    `limit` of them if that is given.
+    """
+    try:
+      f = open(self.job_path(job_id, 'results.jsonl'))
+    except FileNotFoundError:
+      return
+    with f:
+      for i, line in enumerate(f):
+        if limit is not None and i >= offset + limit:
+          return
+        # Skip any partially written last line:
+        if i >= offset and line.endswith('\n'):
+          yield json.loads(line)
+
+  def evict(self, keep):
+    """
+    Remove the oldest finished jobs until at most `keep` jobs are left.
+    """
+    try:
+      job_ids = os.listdir(self.directory)
+    except FileNotFoundError:
+      return
+    statuses = [status for status in map(self.status, job_ids) if status]
+    finished = sorted([status for status in statuses if status['state'] in ['done', 'failed']],
+                      key=lambda status: status['created'])
+    for status in finished[:max(0, len(statuses) - keep)]:
+      shutil.rmtree(self.job_path(status['id']), ignore_errors=True)
+
+
+def test_jobs(tmpdir):
+  store = JobStore(str(tmpdir), workers=1, max_jobs=2)
+
+  def double(items):
+    for item in items:
+      if item is None:
+        raise Exception("No item")
+      yield {'item': item, 'double': item * 2}
+
+  def wait(job_id):
+    for i in range(200):
+      if store.status(job_id)['state'] in ['done', 'failed']:
+        return store.status(job_id)
+      time.sleep(0.01)
+
+  first = store.submit([1, 2, 3], double)
+  status = wait(first)
+  assert status['state'] == 'done' and status['processed'] == status['total'] == 3
+  assert list(store.results(first)) == [{'item': i, 'double': i * 2} for i in [1, 2, 3]]
+  assert list(store.results(first, 1, 1)) == [{'item': 2, 'double': 4}]
+
+  failed = store.submit([1, None], double)
+  status = wait(failed)
+  assert status['state'] == 'failed' and status['error'] == 'No item'
+  assert status['processed'] == 1
+
+  # Only the two most recent jobs are kept:
+  third = store.submit([4], double)
+  wait(third)
+  assert store.status(first) is None
+  assert store.status(failed) and store.status(third)
+  assert store.status('../' + third) is None
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+#
+# Named versions of the server's maps (e.g. the current CL and PR releases, and an older release
+# pinned for a publication), served side by side by a single process. Each version is loaded from
+# its source (a build directory or a snapshot) the first time that it is asked for, and the least
+# recently used versions are unloaded again once the estimated memory used by all of the loaded
+# versions goes over a budget. The pre-forking server instead preloads the versions in the master,
+# where they are pinned, so that its workers share them copy-on-write rather than each loading (and
+# unloading) copies of their own.
+
+import sys
+from collections import OrderedDict
+from itertools import islice
+from threading import Lock
+
+# Containers with more items than this have their size estimated from this many of their items:
+SAMPLE_SIZE = 100
+
+
+def estimate_size(value, sample_size=SAMPLE_SIZE, seen=None):
+  """
+  Estimate the number of bytes of memory used by the given value and everything that it refers to.
+  Objects that are referred to more than once are only counted once, and the items of large
+  containers are estimated from a sample of them, so that estimating the size of a set of maps takes
+  a fraction of the time that loading them does. NumPy arrays and arrays from the array module
+  report the size of their buffers themselves.
+  """
+  if seen is None:
+    seen = set()
+  if id(value) in seen:
+    return 0
+  seen.add(id(value))
+  size = sys.getsizeof(value)
+  if isinstance(value, (str, bytes, int, float, bool)) or value is None:
+    return size
+
+  if isinstance(value, dict):
+    items = value.items()
+  elif isinstance(value, (list, tuple, set, frozenset)):
+    items = value
+  else:
+    # Any other object is sized by its attributes:
+    items = []
+    if hasattr(value, '__dict__'):
+      items.append(value.__dict__)
+    for cls in type(value).__mro__:
+      slots = getattr(cls, '__slots__', ())
+      for slot in [slots] if isinstance(slots, str) else slots:
+        if hasattr(value, slot):
+          items.append(getattr(value, slot))
+
+  sample = list(islice(items, sample_size))
+  if not sample:
+    return size
+  items_size = 0
+  for item in sample:
+    if isinstance(value, dict):
+      items_size += estimate_size(item[0], sample_size, seen)
+      items_size += estimate_size(item[1], sample_size, seen)
+    else:
+      items_size += estimate_size(item, sample_size, seen)
+  return size + int(items_size * len(items) / len(sample))
+
+
+class MapVersions:
+  """
+  A set of named versions of the maps, each registered with a source that is passed to `load()` to
+  load that version the first time it is asked for. The least recently used versions are unloaded
+  when the estimated size of the loaded versions goes over `max_bytes`, except for the version that
+  has just been asked for, which is kept even if it is over the budget on its own, and for pinned
+  versions (see preload()), which are never unloaded.
+  """
+  def __init__(self, load, max_bytes=4 * 1024 * 1024 * 1024):
+    self.load = load
+    self.max_bytes = max_bytes
+    self.sources = OrderedDict()
+    # From the names of the loaded versions to their maps and sizes, least recently used first:
+    self.loaded = OrderedDict()
+    self.pinned = set()
+    self.size = 0
+    self.loads = 0
+    self.evictions = 0
+    self.lock = Lock()
+    # Held while a version is being loaded, so that it is only loaded once:
+    self.loading_locks = {}
+
+  def __contains__(self, name):
+    return name in self.sources
+
+  def __len__(self):
+    return len(self.sources)
+
+  def register(self, name, source):
+    """
+    Add a version with the given name, to be loaded from the given source.
+    """
+    with self.lock:
+      self.sources[name] = source
+      self.loading_locks[name] = Lock()
+
+  def get(self, name):
+    """
+    Return the maps of the version with the given name, loading them if they have not been loaded
+    yet, or have been unloaded since. Raises a KeyError if there is no such version, and passes on
+    any exception raised while loading it.
+    """
+    with self.lock:
+      if name in self.loaded:
+        self.loaded.move_to_end(name)
+        return self.loaded[name][0]
+      loading_lock = self.loading_locks[name]
+
+    with loading_lock:
+      # Another request may have loaded this version while we were waiting for it:
+      with self.lock:
+        if name in self.loaded:
+          self.loaded.move_to_end(name)
+          return self.loaded[name][0]
+      maps = self.load(self.sources[name])
+      size = estimate_size(maps)
+      with self.lock:
+        self.loaded[name] = (maps, size)
+        self.size += size
+        self.loads += 1
+        self.evict(keep=name)
+    return maps
+
+  def evict(self, keep=None):
+    """
+    Unload the least recently used versions, other than `keep` and the pinned versions, until the
+    loaded versions fit within the budget. Must be called with the lock held.
+    """
+    for name in list(self.loaded):
+      if self.size <= self.max_bytes:
+        return
+      if name != keep and name not in self.pinned:
+        self.size -= self.loaded.pop(name)[1]
+        self.evictions += 1
+
+  def preload(self):
+    """
+    Load every registered version that fits within the budget along with those loaded before it,
+    and pin them, so that they are never unloaded. A version that does not fit is unloaded again,
+    and is left to be loaded when it is asked for, as is a version that fails to load. Returns the
+    names of the pinned versions.
+    """
+    for name in list(self.sources):
+      try:
+        self.get(name)
+      except Exception:
+        continue
+      with self.lock:
+        if name in self.loaded:
+          self.pinned.add(name)
+        if self.size > self.max_bytes:
+          self.pinned.discard(name)
+          self.evict()
+    return [name for name in self.sources if name in self.pinned]
+
+  def stats(self):
+    """
+    Return a dictionary with the memory budget, the estimated size of the loaded versions, the
+    numbers of loads and evictions, and the source of every version along with whether it is loaded
+    and its size if it is.
+    """
+    with self.lock:
+      return {
+        'max_bytes': self.max_bytes,
+        'bytes': self.size,
+        'loads': self.loads,
+        'evictions': self.evictions,
+        'versions': [{
+          'name': name,
+          'source': source,
+          'loaded': name in self.loaded,
+          'pinned': name in self.pinned,
+          'bytes': self.loaded[name][1] if name in self.loaded else None,
+          'version': getattr(self.loaded[name][0], 'version', None) if name in self.loaded else None
+        } for name, source in self.sources.items()]
+      }
+
+
+def test_estimate_size():
+  assert estimate_size('abc') == sys.getsizeof('abc')
+  small = estimate_size({'a': 'b' * 100})
+  assert small > 200
+  # Large containers are estimated from a sample, which is exact when the items are alike:
+  items = [str(i).zfill(10) for i in range(10000)]
+  assert abs(estimate_size(items) - sum(map(sys.getsizeof, items)) - sys.getsizeof(items)) < 100
+  # Shared objects are counted once:
+  shared = 'x' * 1000
+  assert estimate_size([shared, shared]) < estimate_size([shared, 'y' * 1000])
+
+  class Record:
+    __slots__ = ('name',)
+
+  record = Record()
+  record.name = 'z' * 1000
+  assert estimate_size(record) > 1000
+
+
+def test_map_versions():
+  loaded = []
+
+  def load(source):
+    loaded.append(source)
+    return {'source': source, 'data': source.ljust(1000)}
+
+  versions = MapVersions(load, max_bytes=estimate_size(load('size')) * 5 // 2)
+  for name in ['one', 'two', 'three']:
+    versions.register(name, name)
+  assert 'two' in versions and 'four' not in versions and len(versions) == 3
+  loaded.clear()
+
+  # Versions are loaded when they are first used, and only once:
+  assert versions.get('one')['source'] == 'one'
+  assert versions.get('one') is versions.get('one')
+  assert versions.get('two')['source'] == 'two'
+  assert loaded == ['one', 'two']
+
+  # The least recently used version is unloaded when a third one is loaded:
+  versions.get('one')
+  versions.get('three')
+  stats = versions.stats()
+  assert [version['loaded'] for version in stats['versions']] == [True, False, True]
+  assert stats['loads'] == 3 and stats['evictions'] == 1
+  assert stats['bytes'] == sum([version['bytes'] or 0 for version in stats['versions']])
+  versions.get('two')
+  assert loaded == ['one', 'two', 'three', 'two']
+
+  try:
+    versions.get('four')
+    assert False
+  except KeyError:
+    pass
+
+  # Preloaded versions are pinned, as long as they fit within the budget:
+  versions = MapVersions(load, max_bytes=versions.max_bytes)
+  for name in ['one', 'two', 'three']:
+    versions.register(name, name)
+  assert versions.preload() == ['one', 'two']
+  assert [version['pinned'] for version in versions.stats()['versions']] == [True, True, False]
+  assert [version['loaded'] for version in versions.stats()['versions']] == [True, True, False]
+  # A version that is loaded later is kept as the one just asked for, but the pinned versions are
+  # not unloaded to make room for it:
+  assert versions.get('three')['source'] == 'three'
+  assert versions.stats()['evictions'] == 1
+  assert [version['loaded'] for version in versions.stats()['versions']] == [True, True, True]
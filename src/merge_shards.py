@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+#
+# Combine the partial outputs of a sharded batch_validate run into a single output file, identical
+# to the one that a single (unsharded) run would have produced. For example, to validate every
+# Flow Cytometry study using three processes (or three machines sharing the cache directory):
+#
+#   src/batch_validate.py ... build cache --fcsAnalyzed --shard 1/3 &
+#   src/batch_validate.py ... build cache --fcsAnalyzed --shard 2/3 &
+#   src/batch_validate.py ... build cache --fcsAnalyzed --shard 3/3 &
+#   wait
+#   src/merge_shards.py build/fcsAnalyzed.tsv build/fcsAnalyzed.tsv.shard-*-of-3
+
+import argparse
+import os
+import sys
+
+from checkpoint import Checkpoint, concatenate_segments
+from scheduler import update_study_sizes
+from writers import WRITERS, TsvWriter
+
+
+def check_shards(checkpoints):
+  """
+  Check that the given checkpoints are the complete set of partial outputs of a single sharded run,
+  and that every study assigned to a shard has been completed. Returns a list of the problems found,
+  which is empty if there are none.
+  """
+  problems = []
+  if not checkpoints:
+    return ["No partial outputs given"]
+
+  first = checkpoints[0]
+  nshards = first.get_info('shard')[1] if first.get_info('shard') else None
+  shards = {}
+  for checkpoint in checkpoints:
+    shard = checkpoint.get_info('shard')
+    if not shard:
+      problems.append("{} is not the partial output of a sharded run".format(checkpoint.path))
+      continue
+    if shard[1] != nshards:
+      problems.append("{} is shard {} of {}, but {} is shard {} of {}".format(
+        checkpoint.path, shard[0], shard[1], first.path, *first.get_info('shard')))
+    if shard[0] in shards:
+      problems.append("{} and {} are both shard {}".format(
+        shards[shard[0]].path, checkpoint.path, shard[0]))
+    shards[shard[0]] = checkpoint
+    if checkpoint.format_name() != first.format_name():
+      problems.append("{} is in the '{}' format, but {} is in the '{}' format".format(
+        checkpoint.path, checkpoint.format_name(), first.path, first.format_name()))
+    if checkpoint.get_info('order') != first.get_info('order'):
+      problems.append("{} and {} were given different lists of studies".format(
+        checkpoint.path, first.path))
+    # A shard with no data at all has no field names:
+    if (checkpoint.fieldnames() and first.fieldnames() and
+        checkpoint.fieldnames() != first.fieldnames()):
+      problems.append("{} and {} have different fields".format(checkpoint.path, first.path))
+    missing = [sid for sid in checkpoint.get_info('assigned') if not checkpoint.completed(sid)]
+    if missing:
+      problems.append("{} has not completed: {}".format(checkpoint.path, missing))
+
+  if nshards:
+    absent = [i for i in range(1, nshards + 1) if i not in shards]
+    if absent:
+      problems.append("Missing shards {} of {}".format(absent, nshards))
+
+  return problems
+
+
+def merge_shards(checkpoints, outpath):
+  """
+  Write the combined output of the given (checked) shard checkpoints to the file at `outpath`.
+  """
+  # Use the field names of any shard that had data, and read each study only from the shard that
+  # it was assigned to:
+  checkpoints = sorted(checkpoints, key=lambda c: not c.fieldnames())
+  for checkpoint in checkpoints:
+    assigned = set(checkpoint.get_info('assigned'))
+    for sid in list(checkpoint.completed_studies()):
+      if sid not in assigned:
+        del checkpoint.completed_studies()[sid]
+  writer_class = WRITERS[checkpoints[0].format_name()]
+  concatenate_segments(checkpoints, outpath, writer_class, checkpoints[0].get_info('order'))
+
+
+def main():
+  parser = argparse.ArgumentParser(description='''
+  Combine the partial outputs written by batch_validate.py when it is run with --shard into a
+  single output file, the same as that of an unsharded run.''')
+  parser.add_argument('output', type=str,
+                      help='the output file')
+  parser.add_argument('partials', type=str, nargs='+',
+                      help='the partial output directories of all of the shards')
+  args = parser.parse_args()
+
+  checkpoints = []
+  for path in args.partials:
+    checkpoint = Checkpoint(path)
+    checkpoint.load()
+    checkpoints.append(checkpoint)
+
+  problems = check_shards(checkpoints)
+  if problems:
+    for problem in problems:
+      print(problem)
+    sys.exit(1)
+
+  merge_shards(checkpoints, args.output)
+  print("Merged {} shards into {}".format(len(checkpoints), args.output))
+
+  # Record the size of each study for scheduling later runs:
+  sizes_path = os.path.join(os.path.dirname(args.output), 'study-sizes.tsv')
+  for checkpoint in checkpoints:
+    update_study_sizes(sizes_path, checkpoint.completed_studies())
+
+
+if __name__ == "__main__":
+  main()
+
+
+def test_merge_shards(tmpdir):
+  fieldnames = ['study', 'name']
+  order = ['SDY1', 'SDY2', 'SDY3']
+  rows = {'SDY1': [['SDY1', 'T cells']], 'SDY2': [], 'SDY3': [['SDY3', 'B cells']]}
+
+  # The output of an unsharded run:
+  single = Checkpoint(str(tmpdir.join('single')), 'tsv', fieldnames)
+  for sid in order:
+    single.write_segment(sid, TsvWriter, rows[sid])
+  single.finalize(str(tmpdir.join('single.tsv')), TsvWriter, order)
+
+  # The partial outputs of a run with two shards:
+  checkpoints = []
+  for shard, assigned in [(1, ['SDY3']), (2, ['SDY1', 'SDY2'])]:
+    checkpoint = Checkpoint(str(tmpdir.join('shard-{}'.format(shard))), 'tsv', fieldnames)
+    checkpoint.set_info('shard', [shard, 2])
+    checkpoint.set_info('order', order)
+    checkpoint.set_info('assigned', assigned)
+    checkpoints.append(checkpoint)
+  checkpoints[0].write_segment('SDY3', TsvWriter, rows['SDY3'])
+  assert check_shards(checkpoints) == [
+    "{} has not completed: ['SDY1', 'SDY2']".format(checkpoints[1].path)]
+  assert check_shards(checkpoints[:1]) == ["Missing shards [2] of 2"]
+
+  for sid in ['SDY1', 'SDY2']:
+    checkpoints[1].write_segment(sid, TsvWriter, rows[sid])
+  assert check_shards(checkpoints) == []
+  merge_shards(checkpoints, str(tmpdir.join('merged.tsv')))
+  assert tmpdir.join('merged.tsv').read() == tmpdir.join('single.tsv').read()
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+#
+# Request and stage metrics for the server, rendered in the Prometheus text exposition format
+# (https://prometheus.io/docs/instrumenting/exposition_formats/). Counters and latency histograms
+# are kept in memory by the process that serves the requests. Under the pre-forking server, every
+# worker also saves them to a file of its own in a directory shared by the workers, at most once a
+# second, and the master folds the files of the workers that have exited into a file of retired
+# totals. Any worker can then report the totals for the whole server: its own metrics, plus those
+# saved by the other workers and the retired ones. Requests that take longer than a threshold are
+# also kept, together with their inputs, in a bounded log.
+
+import fcntl
+import json
+import os
+import time
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+
+from checkpoint import atomic_write
+
+# The upper bounds, in seconds, of the buckets of the latency histograms:
+BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0]
+
+
+def format_labels(labels):
+  """
+  Format the given (name, value) pairs as Prometheus labels.
+  """
+  if not labels:
+    return ''
+  escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+             for name, value in labels]
+  return '{' + ','.join(['{}="{}"'.format(name, value) for name, value in escaped]) + '}'
+
+
+def format_value(value):
+  if value == float('inf'):
+    return '+Inf'
+  if isinstance(value, float):
+    return repr(round(value, 6))
+  return str(value)
+
+
+class Histogram:
+  """
+  Counts observations (in seconds) in cumulative buckets, along with their sum and count.
+  """
+  def __init__(self):
+    self.counts = [0] * len(BUCKETS)
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, seconds):
+    for i, bound in enumerate(BUCKETS):
+      if seconds <= bound:
+        self.counts[i] += 1
+    self.sum += seconds
+    self.count += 1
+
+  def add(self, counts, sum, count):
+    for i, bucket_count in enumerate(counts):
+      self.counts[i] += bucket_count
+    self.sum += sum
+    self.count += count
+
+
+class Metrics:
+  """
+  A registry of counters and histograms, each identified by a metric name and a tuple of
+  (label, value) pairs, and a log of the slowest requests. If a `directory` is given, the counters
+  and histograms are saved to it by save(), every `save_interval` seconds at most, and rendered
+  together with those saved there by other processes.
+  """
+  def __init__(self, slow_seconds=1.0, slow_log_size=100, directory=None, save_interval=1.0):
+    self.help = OrderedDict()
+    self.counters = OrderedDict()
+    self.histograms = OrderedDict()
+    self.slow_seconds = slow_seconds
+    self.slow_requests = deque(maxlen=slow_log_size)
+    self.directory = directory
+    self.save_interval = save_interval
+    self.saved = 0
+    self.lock = Lock()
+
+  def describe(self, name, kind, help_text):
+    """
+    Register the type ('counter', 'gauge' or 'histogram') and the help text of a metric.
+    """
+    self.help[name] = (kind, help_text)
+
+  def inc(self, name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with self.lock:
+      self.counters[key] = self.counters.get(key, 0) + value
+
+  def observe(self, name, seconds, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with self.lock:
+      if key not in self.histograms:
+        self.histograms[key] = Histogram()
+      self.histograms[key].observe(seconds)
+
+  @contextmanager
+  def time(self, name, **labels):
+    """
+    Observe the time taken by the block in the histogram with the given name and labels.
+    """
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(name, time.perf_counter() - start, **labels)
+
+  def timed(self, name, **labels):
+    """
+    A decorator that observes the time taken by every call of the decorated function.
+    """
+    def decorator(function):
+      @wraps(function)
+      def wrapper(*args, **kwargs):
+        with self.time(name, **labels):
+          return function(*args, **kwargs)
+      return wrapper
+    return decorator
+
+  def log_slow_request(self, seconds, details):
+    """
+    If `seconds` is over the threshold, record the given details of the request in the log of slow
+    requests.
+    """
+    if seconds >= self.slow_seconds:
+      entry = OrderedDict([('time', round(time.time(), 3)), ('seconds', round(seconds, 6))])
+      entry.update(details)
+      with self.lock:
+        self.slow_requests.append(entry)
+      return entry
+
+  def get_slow_requests(self):
+    with self.lock:
+      return list(self.slow_requests)
+
+  def get_state(self):
+    """
+    Return the counters and histograms as a JSON-serializable dictionary.
+    """
+    with self.lock:
+      return get_state(self.counters, self.histograms)
+
+  def get_path(self, name):
+    return os.path.join(self.directory, '{}.json'.format(name))
+
+  @contextmanager
+  def locked(self, operation):
+    """
+    Hold a lock on the directory, shared or exclusive, so that retire() cannot move the metrics of
+    a process from its file to the retired totals while they are being read.
+    """
+    with open(os.path.join(self.directory, 'lock'), 'a') as f:
+      fcntl.flock(f, operation)
+      try:
+        yield
+      finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+  def save(self, force=False):
+    """
+    Save the counters and histograms of this process to its file in the directory, if there is one,
+    unless they have been saved in the last `save_interval` seconds and `force` is not given.
+    """
+    if not self.directory or (not force and time.time() - self.saved < self.save_interval):
+      return
+    self.saved = time.time()
+    os.makedirs(self.directory, exist_ok=True)
+    atomic_write(self.get_path(os.getpid()), json.dumps(self.get_state()).encode('utf-8'))
+
+  def retire(self, pid):
+    """
+    Add the metrics saved by the given process, which has exited, to the retired totals in the
+    directory, and remove its file.
+    """
+    path = self.get_path(pid)
+    if not self.directory or not os.path.exists(path):
+      return
+    with self.locked(fcntl.LOCK_EX):
+      counters, histograms = OrderedDict(), OrderedDict()
+      for name in ['retired', pid]:
+        merge_state(counters, histograms, read_state(self.get_path(name)))
+      atomic_write(self.get_path('retired'), json.dumps(get_state(counters, histograms))
+                   .encode('utf-8'))
+      os.remove(path)
+
+  def get_totals(self):
+    """
+    Return the counters and histograms of this process, added to those saved in the directory by
+    the other processes and the retired totals.
+    """
+    counters, histograms = OrderedDict(), OrderedDict()
+    merge_state(counters, histograms, self.get_state())
+    if self.directory and os.path.isdir(self.directory):
+      with self.locked(fcntl.LOCK_SH):
+        for filename in sorted(os.listdir(self.directory)):
+          name = filename[:-len('.json')]
+          if filename.endswith('.json') and name != str(os.getpid()):
+            merge_state(counters, histograms, read_state(os.path.join(self.directory, filename)))
+    return counters, histograms
+
+  def render(self, gauges=(), labels=()):
+    """
+    Render every counter and histogram (the totals, see get_totals()), followed by the given gauges
+    (a list of (name, labels, value) triples, where labels is a dictionary), in the Prometheus text
+    format. The given labels are added to every gauge.
+    """
+    samples = OrderedDict()
+
+    def add(name, sample_labels, value, suffix=''):
+      samples.setdefault(name, []).append('{}{}{} {}'.format(
+        name, suffix, format_labels(sample_labels), format_value(value)))
+
+    counters, histograms = self.get_totals()
+    for (name, sample_labels), value in counters.items():
+      add(name, sample_labels, value)
+    for (name, sample_labels), histogram in histograms.items():
+      for bound, count in zip(BUCKETS + [float('inf')], histogram.counts + [histogram.count]):
+        add(name, sample_labels + (('le', format_value(bound)),), count, '_bucket')
+      add(name, sample_labels, histogram.sum, '_sum')
+      add(name, sample_labels, histogram.count, '_count')
+    for name, sample_labels, value in gauges:
+      add(name, list(labels) + sorted(sample_labels.items()), value)
+
+    lines = []
+    for name, name_samples in samples.items():
+      if name in self.help:
+        kind, help_text = self.help[name]
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+      lines.extend(name_samples)
+    return '\n'.join(lines) + '\n'
+
+
+def read_state(path):
+  """
+  Read the counters and histograms saved in the given file (see Metrics.save()), or return None if
+  it has gone or is not readable.
+  """
+  try:
+    with open(path) as f:
+      return json.load(f)
+  except (FileNotFoundError, ValueError):
+    return None
+
+
+def merge_state(counters, histograms, state):
+  """
+  Add the counters and histograms of the given state (see Metrics.get_state()) to the given maps.
+  """
+  if not state:
+    return
+  for name, labels, value in state['counters']:
+    key = (name, tuple([tuple(label) for label in labels]))
+    counters[key] = counters.get(key, 0) + value
+  for name, labels, counts, sum, count in state['histograms']:
+    key = (name, tuple([tuple(label) for label in labels]))
+    if key not in histograms:
+      histograms[key] = Histogram()
+    histograms[key].add(counts, sum, count)
+
+
+def get_state(counters, histograms):
+  return {
+    'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+    'histograms': [[name, list(labels), histogram.counts, histogram.sum, histogram.count]
+                   for (name, labels), histogram in histograms.items()]}
+
+
+def test_metrics():
+  metrics = Metrics(slow_seconds=0.5)
+  metrics.describe('requests_total', 'counter', 'Requests served.')
+  metrics.describe('stage_seconds', 'histogram', 'Time taken by each stage.')
+  metrics.inc('requests_total', endpoint='my_app', status=200)
+  metrics.inc('requests_total', endpoint='my_app', status=200)
+  metrics.observe('stage_seconds', 0.003, stage='render')
+
+  @metrics.timed('stage_seconds', stage='parse')
+  def parse(field):
+    return field.split(',')
+
+  assert parse('CD4+,CD8-') == ['CD4+', 'CD8-']
+  assert metrics.log_slow_request(0.1, {'path': '/'}) is None
+  assert metrics.log_slow_request(0.7, {'path': '/', 'cells': 'T "cell"'})['cells'] == 'T "cell"'
+  assert len(metrics.get_slow_requests()) == 1
+
+  text = metrics.render([('map_entries', {'map': 'iri_labels'}, 12)], [('pid', 1)])
+  lines = text.splitlines()
+  assert lines[:3] == [
+    '# HELP requests_total Requests served.',
+    '# TYPE requests_total counter',
+    'requests_total{endpoint="my_app",status="200"} 2']
+  assert '# TYPE stage_seconds histogram' in lines
+  assert 'stage_seconds_bucket{stage="render",le="0.0025"} 0' in lines
+  assert 'stage_seconds_bucket{stage="render",le="0.005"} 1' in lines
+  assert 'stage_seconds_bucket{stage="render",le="+Inf"} 1' in lines
+  assert 'stage_seconds_count{stage="parse"} 1' in lines
+  assert 'map_entries{pid="1",map="iri_labels"} 12' in lines
+  assert format_labels([('q', 'a "b"\\c')]) == '{q="a \\"b\\"\\\\c"}'
+
+
+def test_metrics_directory(tmpdir):
+  directory = str(tmpdir.join('metrics'))
+  metrics = Metrics(directory=directory, save_interval=0)
+  metrics.inc('requests_total', status=200)
+  metrics.observe('request_seconds', 0.003)
+
+  # The metrics saved by other processes, including those that have exited, are added to those of
+  # this one:
+  other = Metrics(directory=directory)
+  other.inc('requests_total', 2, status=200)
+  other.inc('requests_total', status=500)
+  other.observe('request_seconds', 0.3)
+  os.makedirs(directory)
+  for pid in [1, 2]:
+    atomic_write(os.path.join(directory, '{}.json'.format(pid)),
+                 json.dumps(other.get_state()).encode('utf-8'))
+  metrics.retire(1)
+  assert sorted(os.listdir(directory)) == ['2.json', 'lock', 'retired.json']
+
+  counters, histograms = metrics.get_totals()
+  assert counters == {('requests_total', (('status', 200),)): 5,
+                      ('requests_total', (('status', 500),)): 2}
+  histogram = histograms[('request_seconds', ())]
+  assert histogram.count == 3 and round(histogram.sum, 6) == 0.603
+  assert histogram.counts[BUCKETS.index(0.005)] == 1 and histogram.counts[-1] == 3
+  assert 'requests_total{status="200"} 5' in metrics.render().splitlines()
+
+  # This process's own file is not counted twice:
+  metrics.save()
+  assert os.path.exists(os.path.join(directory, '{}.json'.format(os.getpid())))
+  assert metrics.get_totals()[0][('requests_total', (('status', 200),))] == 5
@@ -6,8 +6,8 @@ import csv
 import re
 import xml.etree.ElementTree as ET
 
-from common import get_iri_levels, extract_suffix_syns_symbs_maps, split_gate, tokenize, \
-  update_iri_maps_from_owl
+from common import HierarchyIndex, get_gate_kinds, get_iri_levels, extract_iri_parent_maps, \
+  extract_suffix_syns_symbs_maps, split_gate, tokenize, update_iri_maps_from_owl
 
 
 def normalize(gates, gate_mappings, special_gates, preferred, symbols):
@@ -63,6 +63,37 @@ def normalize(gates, gate_mappings, special_gates, preferred, symbols):
   return preferred_label_gates, ontologized_gates
 
 
+def find_conflicts(cell_gates, cell_kinds, extra_gates, definition_gates, definition_kinds, symbols,
+                   pr_hierarchy):
+  """
+  Compare the gates of a population's cell type (both those of its CL definition and any extra
+  gates in its name) with the gates of its reported definition, given along with their kinds (see
+  get_gate_kinds()). A pair of gates conflict if they have the same label but one is negative and
+  the other is not, or if one of them is negative while the other is on a subtype of its kind
+  (e.g. CD45- and CD45RA+), according to the given PR hierarchy. Returns the list of conflicts and
+  the type of the last of them.
+  """
+  conflict_type = ''
+  conflicts = []
+  for population_gate, population_kind in zip(cell_gates, cell_kinds):
+    pgate, plevel = split_gate(population_gate, symbols)
+    ppos = plevel != '-'
+    for definition_gate, definition_kind in zip(definition_gates, definition_kinds):
+      dgate, dlevel = split_gate(definition_gate, symbols)
+      dpos = dlevel != '-'
+      if pgate == dgate and ppos != dpos:
+        conflicts.append(population_gate + '/' + dlevel)
+      elif pr_hierarchy.contradicts(population_kind, ppos, definition_kind, dpos):
+        conflicts.append(population_gate + '/' + definition_gate)
+      else:
+        continue
+      if population_gate in extra_gates:
+        conflict_type = 'conflict with extra'
+      else:
+        conflict_type = 'conflict with CL definition'
+  return conflicts, conflict_type
+
+
 def main():
   # Define command-line parameters
   parser = argparse.ArgumentParser(description='Normalize cell population descriptions')
@@ -76,6 +107,8 @@ def main():
                       help='a TSV file containing extra information about a subset of gates')
   parser.add_argument('preferred', type=argparse.FileType('r'),
                       help='a TSV file which maps ontology ids to preferred labels')
+  parser.add_argument('parents', type=argparse.FileType('r'),
+                      help='a TSV file which maps PR ontology ids to their parents')
   parser.add_argument('cells', type=argparse.FileType('r'),
                       help='an OWL file for the Cell Ontology')
   parser.add_argument('source', type=argparse.FileType('r'),
@@ -125,6 +158,11 @@ def main():
   for row in rows:
     preferred[row['Ontology ID']] = row['Preferred Label']
 
+  # Load the contents of the file given by the command-line parameter args.parents. This is the PR
+  # hierarchy, which is needed to find conflicts between gates on related proteins.
+  rows = csv.reader(args.parents, delimiter='\t')
+  pr_hierarchy = HierarchyIndex(extract_iri_parent_maps(rows))
+
   # Load the contents of the file given by args.cells. This is an OWL file in XML format. We first
   # parse it using python's xml library, and then call update_iri_maps_from_owl
   # to retrieve the maps: synonym_iris, iri_labels, iri_gates, and iri_parents
@@ -168,6 +206,7 @@ def main():
       tokenized_gates = tokenize('Standard', suffixsymbs, suffixsyns, extra)
       preferized_gates, ontologized_gates = normalize(
         tokenized_gates, gate_mappings, special_gates, preferred, symbols)
+      extra_kinds = get_gate_kinds(ontologized_gates, symbols)
 
       # Determine the population preferred name:
       preferred_name = row['CL term'] or ''
@@ -177,17 +216,20 @@ def main():
 
       # Determine the CL definition:
       population_gates = []
+      population_kinds = []
       cell_type = re.sub('^CL:', 'http://purl.obolibrary.org/obo/CL_', row['CL ID'])
       if cell_type and cell_type in iri_gates:
         for gate in iri_gates[cell_type]:
           preferred_label = preferred.get(gate['kind'])
           if preferred_label:
             population_gates.append(preferred_label + get_iri_levels()[gate['level']])
+            population_kinds.append(gate['kind'])
       row['CL definition'] = ', '.join(population_gates)
 
       # These will be needed later for determining conflicts:
       extra_gates = preferized_gates.copy()
       cell_gates = population_gates + preferized_gates
+      cell_kinds = population_kinds + extra_kinds
 
       # Tokenize and normalize the reported population definition, first removing any surrounding
       # quotation marks:
@@ -200,20 +242,9 @@ def main():
       row['Gating preferred definition'] = ', '.join(preferized_gates)
 
       # Determine the conflicts:
-      conflict_type = ''
-      conflicts = []
-      for population_gate in cell_gates:
-        for definition_gate in preferized_gates:
-          pgate, plevel = split_gate(population_gate, symbols)
-          dgate, dlevel = split_gate(definition_gate, symbols)
-          ppos = plevel != '-'
-          dpos = dlevel != '-'
-          if pgate == dgate and ppos != dpos:
-            conflicts.append(population_gate + '/' + dlevel)
-            if population_gate in extra_gates:
-              conflict_type = 'conflict with extra'
-            else:
-              conflict_type = 'conflict with CL definition'
+      conflicts, conflict_type = find_conflicts(
+        cell_gates, cell_kinds, extra_gates, preferized_gates,
+        get_gate_kinds(ontologized_gates, symbols), symbols, pr_hierarchy)
       if len(conflicts) > 0:
         print(conflicts)
         conflict_count += 1
@@ -491,3 +522,25 @@ def test_normalize():
                                       suffixsymbs.values())
   assert ontologized == ['PR:034++', 'PR:037+-', 'PR:001++', 'PR:014+-']
   assert preferized == ['Michael++', 'Robert+-', 'Axexa350++', 'CD33+-']
+
+
+def test_find_conflicts():
+  symbols = ['++', '+~', '+-', '+', '-']
+  pr = 'http://purl.obolibrary.org/obo/PR_'
+  pr_hierarchy = HierarchyIndex({pr + '045': [pr + '044']})
+  assert get_gate_kinds(['PR:044-', 'PR:045+', '!foo+'], symbols) == [
+    pr + '044', pr + '045', '!foo']
+
+  cell_gates = ['CD4+', 'CD45RA+', 'CD8-']
+  cell_kinds = [pr + '016', pr + '045', pr + '022']
+  conflicts, conflict_type = find_conflicts(
+    cell_gates, cell_kinds, ['CD8-'], ['CD4+', 'CD8++'], [pr + '016', pr + '022'], symbols,
+    pr_hierarchy)
+  assert conflicts == ['CD8-/++'] and conflict_type == 'conflict with extra'
+
+  # CD45RA is an isoform of CD45, so a population with CD45RA cannot lack CD45:
+  conflicts, conflict_type = find_conflicts(
+    cell_gates, cell_kinds, [], ['CD45-'], [pr + '044'], symbols, pr_hierarchy)
+  assert conflicts == ['CD45RA+/CD45-'] and conflict_type == 'conflict with CL definition'
+  assert find_conflicts(cell_gates, cell_kinds, [], ['CD45+'], [pr + '044'], symbols,
+                        pr_hierarchy) == ([], '')
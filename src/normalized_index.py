@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+#
+# An inverted index over the rows of normalized.tsv (see normalize.py), for answering questions like
+# "which studies gate on CXCR5+ within CD4-positive, alpha-beta T cells?" or "where is the marker X
+# not mapped to an ontology?" without scanning the whole file. Each row is posted under every
+# ontologized gate of its reported definition (both with and without its level), its CL ID, every
+# unmapped '!' token, and its study and experiment accessions. A query is a conjunction of such
+# terms, answered by intersecting their posting lists, smallest first.
+#
+# The index is kept in a directory holding a segment file for every study, along with a manifest
+# (manifest.json) recording a hash of the rows of each study. When normalized.tsv changes, only the
+# studies whose rows have changed are indexed again, and the segments of studies that have gone are
+# removed. The segments are combined into sorted NumPy arrays of row numbers when the index is
+# loaded.
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+import re
+import sys
+from collections import defaultdict
+
+import numpy as np
+
+from checkpoint import atomic_write
+from common import get_level_iris, parse_ontologized_gates, split_gate
+
+OBO = 'http://purl.obolibrary.org/obo/'
+
+# The fields of the rows of normalized.tsv that are kept in the index and returned by queries:
+ROW_FIELDS = ['STUDY_ACCESSION', 'EXPERIMENT_ACCESSION', 'POPULATION_NAME_REPORTED',
+              'POPULATION_DEFNITION_REPORTED', 'CL ID']
+
+# The fields whose values make up the hash of a study's rows:
+HASHED_FIELDS = ROW_FIELDS + ['Gating tokenized', 'Gating mapped to ontologies', 'CL term']
+
+
+def get_row_terms(row, gates):
+  """
+  Return the set of the index terms of the given row of normalized.tsv, given along with its parsed
+  gates (see parse_ontologized_gates()). Each term is a tab-separated string starting with the kind
+  of term: 'gate' (with a kind IRI and a level suffix), 'kind', 'cell', 'unmapped' (with the
+  case-folded label of the token) or 'experiment'. Rows are posted under their study by position,
+  so there are no study terms.
+  """
+  terms = set()
+  for kind, suffix in gates:
+    if kind.startswith('!'):
+      terms.add('unmapped\t' + kind[1:].casefold())
+    else:
+      terms.add('kind\t' + kind)
+      terms.add('gate\t{}\t{}'.format(kind, suffix))
+  if row['CL ID']:
+    terms.add('cell\t' + re.sub('^CL:', OBO + 'CL_', row['CL ID']))
+  if row['EXPERIMENT_ACCESSION']:
+    terms.add('experiment\t' + row['EXPERIMENT_ACCESSION'])
+  return terms
+
+
+def get_row_labels(row, gates, symbols, seen=None):
+  """
+  Generate (case-folded label, IRI) pairs for the labels used in the given row of normalized.tsv,
+  given along with its parsed gates: those of the tokens of its reported definition that were mapped
+  to ontology ids, and that of its CL term. These let queries use labels instead of ontology ids.
+  Tokens in the given set of those that have already been seen are skipped, and the others added.
+  """
+  seen = set() if seen is None else seen
+  tokens = re.split(r',\s+', row['Gating tokenized']) if row['Gating tokenized'] else []
+  if len(tokens) == len(gates):
+    for token, (kind, suffix) in zip(tokens, gates):
+      if token not in seen and not kind.startswith('!'):
+        seen.add(token)
+        yield split_gate(token, symbols)[0].casefold(), kind
+  if row['CL term'] and row['CL ID']:
+    yield row['CL term'].casefold(), re.sub('^CL:', OBO + 'CL_', row['CL ID'])
+
+
+def index_study(rows, symbols):
+  """
+  Index the given rows of a single study, and return a segment: a dictionary holding the rows'
+  ROW_FIELDS, the posting lists of the rows (numbered from 0) under every term, and the labels used
+  in the rows (see get_row_labels()).
+  """
+  postings = defaultdict(list)
+  labels = {}
+  # The same gates and tokens tend to be repeated throughout a study, so each is only parsed once:
+  gate_cache = {}
+  seen_tokens = set()
+  for i, row in enumerate(rows):
+    gates = parse_ontologized_gates(row['Gating mapped to ontologies'], symbols, gate_cache)
+    for term in get_row_terms(row, gates):
+      postings[term].append(i)
+    for label, iri in get_row_labels(row, gates, symbols, seen_tokens):
+      labels.setdefault(label, iri)
+  return {
+    'rows': [[row[field] for field in ROW_FIELDS] for row in rows],
+    'postings': postings,
+    'labels': labels
+  }
+
+
+def hash_studies(rows):
+  """
+  Return a map from the studies in the given rows of normalized.tsv to a hash of their rows, in
+  order.
+  """
+  hashes = {}
+  for row in rows:
+    study = row['STUDY_ACCESSION']
+    if study not in hashes:
+      hashes[study] = hashlib.sha1()
+    hashes[study].update(('\t'.join([row[field] for field in HASHED_FIELDS]) + '\n')
+                         .encode('utf-8'))
+  return {study: digest.hexdigest() for study, digest in hashes.items()}
+
+
+class NormalizedIndex:
+  """
+  An index of normalized.tsv, kept in `directory` (see the top of this file).
+  """
+  def __init__(self, directory):
+    self.directory = directory
+    self.symbols = list(get_level_iris().keys())
+    self.manifest = {'studies': {}}
+    self.rows = []
+    self.postings = {}
+    self.labels = {}
+
+  def manifest_path(self):
+    return os.path.join(self.directory, 'manifest.json')
+
+  def segment_path(self, study):
+    return os.path.join(self.directory, self.manifest['studies'][study]['segment'])
+
+  def read_manifest(self):
+    try:
+      with open(self.manifest_path()) as f:
+        self.manifest = json.load(f)
+    except FileNotFoundError:
+      self.manifest = {'studies': {}}
+
+  def update(self, normalized_path):
+    """
+    Bring the index up to date with the given normalized.tsv file, indexing only the studies whose
+    rows have changed since the last update, and return the lists of the studies that were indexed
+    and that were removed. The file is read twice: once to hash the rows of every study, and once
+    to index the rows of the studies that have changed.
+    """
+    self.read_manifest()
+    with open(normalized_path) as f:
+      hashes = hash_studies(csv.DictReader(f, delimiter='\t'))
+    studies = self.manifest['studies']
+    changed = set([study for study, digest in hashes.items()
+                   if study not in studies or studies[study]['hash'] != digest])
+    removed = sorted(set(studies) - set(hashes))
+
+    study_rows = defaultdict(list)
+    if changed:
+      with open(normalized_path) as f:
+        for row in csv.DictReader(f, delimiter='\t'):
+          if row['STUDY_ACCESSION'] in changed:
+            study_rows[row['STUDY_ACCESSION']].append(
+              {field: row[field] for field in HASHED_FIELDS})
+
+    os.makedirs(self.directory, exist_ok=True)
+    for study in sorted(changed):
+      segment = hashlib.sha1(study.encode('utf-8')).hexdigest()[:16] + '.json'
+      data = index_study(study_rows.pop(study), self.symbols)
+      atomic_write(os.path.join(self.directory, segment),
+                   json.dumps(data, separators=(',', ':')).encode('utf-8'))
+      studies[study] = {'segment': segment, 'hash': hashes[study], 'rows': len(data['rows'])}
+    for study in removed:
+      try:
+        os.remove(self.segment_path(study))
+      except FileNotFoundError:
+        pass
+      del studies[study]
+    atomic_write(self.manifest_path(),
+                 json.dumps(self.manifest, indent=2, sort_keys=True).encode('utf-8'))
+    return sorted(changed), removed
+
+  def load(self):
+    """
+    Load every segment of the index, numbering the rows of the studies in order, and combine the
+    posting lists of the segments into a sorted array of row numbers for every term.
+    """
+    self.read_manifest()
+    self.rows = []
+    self.labels = {}
+    postings = defaultdict(list)
+    for study in sorted(self.manifest['studies']):
+      with open(self.segment_path(study)) as f:
+        data = json.load(f)
+      offset = len(self.rows)
+      self.rows.extend(data['rows'])
+      postings['study\t' + study].append(np.arange(offset, len(self.rows), dtype=np.int64))
+      for term, numbers in data['postings'].items():
+        postings[term].append(np.array(numbers, dtype=np.int64) + offset)
+      for label, iri in data['labels'].items():
+        self.labels.setdefault(label, iri)
+    # Studies are added in order, so the concatenated posting lists are already sorted:
+    self.postings = {term: np.concatenate(arrays) for term, arrays in postings.items()}
+    return self
+
+  def parse_term(self, term):
+    """
+    Return the index term for the given query term, which is one of 'study:<accession>',
+    'experiment:<accession>', 'cell:<CL ID or label>', 'unmapped:<token>' (or '!<token>'), or
+    a gate, optionally prefixed with 'gate:', given by its ontology id or by a label used in the
+    normalized rows, either with a level (e.g. 'CD4+') or without one to match any level. Raises an
+    exception for a label that is not used in any row.
+    """
+    term = term.strip()
+    field, sep, value = term.partition(':')
+    field = field.casefold()
+    if sep and field in ['study', 'experiment']:
+      return '{}\t{}'.format(field, value.strip())
+    if sep and field == 'cell':
+      value = value.strip()
+      if re.match('^CL[:_][0-9]+$', value):
+        return 'cell\t' + OBO + 'CL_' + value[3:]
+      if value.casefold() not in self.labels:
+        raise Exception("Unknown cell type: '{}'".format(value))
+      return 'cell\t' + self.labels[value.casefold()]
+    if sep and field == 'unmapped':
+      return 'unmapped\t' + value.strip().casefold()
+    if term.startswith('!'):
+      return 'unmapped\t' + term[1:].casefold()
+    if sep and field == 'gate':
+      term = value.strip()
+
+    name, suffix = split_gate(term, self.symbols)
+    if re.match('^PR:[0-9A-Za-z]+$', name):
+      kind = OBO + 'PR_' + name[3:]
+    elif name.startswith('http'):
+      kind = name
+    elif name.casefold() in self.labels:
+      kind = self.labels[name.casefold()]
+    else:
+      raise Exception("Unknown marker: '{}'".format(name))
+    return 'gate\t{}\t{}'.format(kind, suffix) if suffix else 'kind\t' + kind
+
+  def query(self, terms):
+    """
+    Return the array of the numbers of the rows matching all of the given query terms (see
+    parse_term()), or every row if no terms are given.
+    """
+    keys = [self.parse_term(term) for term in terms]
+    postings = sorted([self.postings.get(key, np.array([], dtype=np.int64)) for key in keys],
+                      key=len)
+    if not postings:
+      return np.arange(len(self.rows))
+    # Every other posting list is at least as long as the first, so none of them is empty unless it
+    # is, and the matches can be looked up in each of them by binary search:
+    matches = postings[0]
+    for posting in postings[1:]:
+      if not len(matches):
+        break
+      positions = np.searchsorted(posting, matches)
+      positions[positions == len(posting)] = 0
+      matches = matches[posting[positions] == matches]
+    return matches
+
+  def get_rows(self, numbers):
+    """
+    Return the rows with the given numbers, as dictionaries of their ROW_FIELDS.
+    """
+    return [dict(zip(ROW_FIELDS, self.rows[i])) for i in numbers]
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='Build an index of a normalized TSV file, and find the rows matching some terms')
+  parser.add_argument('index', type=str, help='the directory holding the index')
+  parser.add_argument('terms', nargs='*',
+                      help='the terms that the rows must match: gates (e.g. CXCR5+ or '
+                      'PR:000001380) with or without a level, study:<accession>, '
+                      'experiment:<accession>, cell:<CL ID or label>, or unmapped:<token>')
+  parser.add_argument('--update', type=str, metavar='NORMALIZED',
+                      help='first bring the index up to date with this normalized TSV file, '
+                      'generated by normalize.py')
+  parser.add_argument('--limit', type=int, default=0,
+                      help='write at most this many matching rows (default: 0, i.e. all of them)')
+  args = parser.parse_args()
+
+  index = NormalizedIndex(args.index)
+  if args.update:
+    changed, removed = index.update(args.update)
+    print('Indexed {} studies and removed {} from {}'.format(
+      len(changed), len(removed), args.index), file=sys.stderr)
+    if not args.terms:
+      return
+
+  index.load()
+  try:
+    matches = index.query(args.terms)
+  except Exception as e:
+    print(e, file=sys.stderr)
+    sys.exit(1)
+  w = csv.writer(sys.stdout, delimiter='\t', lineterminator='\n')
+  w.writerow(ROW_FIELDS)
+  for row in index.get_rows(matches[:args.limit] if args.limit else matches):
+    w.writerow([row[field] for field in ROW_FIELDS])
+  studies = set([index.rows[i][0] for i in matches])
+  print('{} rows in {} studies'.format(len(matches), len(studies)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+  main()
+
+
+# Unit tests for use with the tool `pytest` are defined below. To run these, run
+# `pytest normalized_index.py` from the command line.
+
+def write_normalized(path, rows):
+  with open(str(path), 'w') as f:
+    w = csv.writer(f, delimiter='\t', lineterminator='\n')
+    w.writerow(HASHED_FIELDS)
+    for row in rows:
+      w.writerow(row)
+
+
+def test_normalized_index(tmpdir):
+  rows = [
+    ['SDY1', 'EXP1', 'Tfh', 'CD4+, CXCR5+', 'CL:0000624', 'CD4+, CXCR5+', 'PR:000001004+, PR:1+',
+     'CD4-positive, alpha-beta T cell'],
+    ['SDY1', 'EXP2', 'B cells', 'CD19+, foo-', 'CL:0000236', 'CD19+, foo-', 'PR:2+, !foo-',
+     'B cell'],
+    ['SDY2', 'EXP3', 'CXCR5 cells', 'CXCR5++', '', 'CXCR5++', 'PR:1++', ''],
+    ['SDY3', 'EXP4', 'T cells', 'CD4+, CXCR5-', 'CL:0000624', 'CD4+, CXCR5-',
+     'PR:000001004+, PR:1-', 'CD4-positive, alpha-beta T cell'],
+  ]
+  normalized = tmpdir.join('normalized.tsv')
+  write_normalized(normalized, rows)
+  index = NormalizedIndex(str(tmpdir.join('index')))
+  assert index.update(str(normalized)) == (['SDY1', 'SDY2', 'SDY3'], [])
+  index.load()
+  assert len(index.rows) == 4
+
+  def names(*terms):
+    return [row['POPULATION_NAME_REPORTED'] for row in index.get_rows(index.query(terms))]
+
+  assert names('CXCR5+') == ['Tfh']
+  assert names('CXCR5') == ['Tfh', 'CXCR5 cells', 'T cells']
+  assert names('PR:1', 'cell:CD4-positive, alpha-beta T cell') == ['Tfh', 'T cells']
+  assert names('gate:cxcr5', 'cell:CL:0000624', 'study:SDY3') == ['T cells']
+  assert names('!FOO') == names('unmapped:foo') == ['B cells']
+  assert names('experiment:EXP3') == ['CXCR5 cells']
+  assert names('CD19+', 'CD4+') == [] and len(names()) == 4
+  try:
+    names('CD8+')
+    assert False
+  except Exception as e:
+    assert 'CD8' in str(e)
+
+  # Only the studies that have changed are indexed again, and those that have gone are removed:
+  rows[2][3] = rows[2][5] = 'CXCR5-'
+  rows[2][6] = 'PR:1-'
+  write_normalized(normalized, rows[:3])
+  assert index.update(str(normalized)) == (['SDY2'], ['SDY3'])
+  assert len(os.listdir(str(tmpdir.join('index')))) == 3
+  index.load()
+  assert names('CXCR5-') == ['CXCR5 cells']
+  assert index.update(str(normalized)) == ([], [])
@@ -0,0 +1,505 @@
+#!/usr/bin/env python3
+#
+# A small pre-forking WSGI server for running the validation server in production. The master
+# process binds the listening socket and loads the maps once, then forks the worker processes,
+# which serve requests from the shared socket. Since the workers are forked after the maps have been
+# loaded they share the memory holding the maps with the master, copy-on-write, so adding workers
+# adds throughput without multiplying the memory taken up by the maps. To keep the garbage collector
+# from writing to (and so copying) those pages, the loaded objects are frozen before forking.
+#
+# The master replaces any worker that exits. A worker exits after serving a given number of
+# requests, and on SIGTERM, once it has finished the request it is serving. A worker that has work
+# running in the background (e.g. validation jobs) then stops accepting requests, tells the master
+# that it is draining so that the master can replace it straight away, and only exits once that work
+# has finished. Every worker also records when it started serving its current request in memory
+# shared with the master, which kills and replaces any worker that has been serving one request for
+# longer than the timeout, so that a request that hangs does not tie up a worker for good. Sending
+# SIGTERM or SIGINT to the master shuts every worker down gracefully (work still running in the
+# background after `graceful_timeout` seconds is lost), and SIGHUP makes the master reload the maps
+# (if it has been given a way to) and then replace every worker, so that the new workers share the
+# new maps. The master can also check for changed maps periodically.
+
+import gc
+import mmap
+import os
+import signal
+import socket
+import sys
+import time
+import urllib.request
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+# How often (in seconds) the master checks on its workers, and workers check for a shutdown:
+POLL_INTERVAL = 0.5
+
+
+def freeze():
+  """
+  Move everything that has been loaded so far out of the reach of the garbage collector, so that
+  collections in the workers do not touch (and so copy) the pages that they share with the master.
+  """
+  if hasattr(gc, 'freeze'):
+    gc.collect()
+    gc.freeze()
+
+
+class WorkerServer(WSGIServer):
+  """
+  A WSGIServer that serves from an already bound socket, and counts the requests it has served. If
+  `busy` (an array of floats shared with the master) is given, the time at which the server started
+  serving its current request, or 0 while it is not serving one, is kept in busy[slot].
+  """
+  def __init__(self, sock, handler_class, busy=None, slot=0):
+    super().__init__(sock.getsockname(), handler_class, bind_and_activate=False)
+    self.socket.close()
+    self.socket = sock
+    host, port = sock.getsockname()[:2]
+    self.server_name = socket.getfqdn(host)
+    self.server_port = port
+    self.setup_environ()
+    self.served = 0
+    self.busy = busy
+    self.slot = slot
+
+  def process_request(self, request, client_address):
+    self.served += 1
+    if self.busy is None:
+      super().process_request(request, client_address)
+      return
+    self.busy[self.slot] = time.time()
+    try:
+      super().process_request(request, client_address)
+    finally:
+      self.busy[self.slot] = 0.0
+
+
+class PreforkServer:
+  """
+  Serves the given WSGI app from `workers` forked processes. Each worker is replaced after it has
+  served `max_requests` requests (0 for no limit). Connections that are idle for more than `timeout`
+  seconds are dropped, workers that take more than `timeout` seconds to serve a request are killed
+  and replaced (0 for no limit on either), and on shutdown workers are given `graceful_timeout`
+  seconds to finish the requests they are serving before they are killed. If `drain` is given, it is
+  called by each worker once it has stopped serving requests, and should return once any work that
+  the worker has started in the background has finished. If `exited` is given, it is called by the
+  master with the process id of every worker that has exited (e.g. to collect its metrics).
+  """
+  def __init__(self, app, host='127.0.0.1', port=5000, workers=2, max_requests=1000, timeout=30,
+               graceful_timeout=30, drain=None, exited=None):
+    self.app = app
+    self.host = host
+    self.port = port
+    self.nworkers = workers
+    self.max_requests = max_requests
+    self.timeout = timeout
+    self.graceful_timeout = graceful_timeout
+    self.drain = drain
+    self.exited = exited
+    self.socket = None
+    self.workers = {}
+    # The workers that have stopped serving requests but are waiting for their background work,
+    # and the pipe on which workers tell the master that they are doing so:
+    self.draining = {}
+    self.drain_pipe = None
+    # The slot of each worker serving requests in `busy`, an array of floats shared with the workers
+    # in which each of them records when it started serving its current request (see WorkerServer):
+    self.slots = {}
+    self.busy = None
+    self.slot = 0
+    self.stopping = False
+    self.recycling = False
+
+  def bind(self):
+    """
+    Create the listening socket that will be shared by the workers, and return its address.
+    """
+    if self.socket is None:
+      self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      self.socket.bind((self.host, self.port))
+      self.socket.listen(128)
+      # Every worker waits on the same socket, so a worker may find that another worker has
+      # already accepted the connection it was woken up for. It should not block in that case:
+      self.socket.setblocking(False)
+    return self.socket.getsockname()
+
+  def run(self, preload=None, reload=None, watch_interval=0):
+    """
+    Bind the socket, call `preload` (e.g. to load the maps), and then fork the workers and look
+    after them until the master is asked to shut down. On SIGHUP, and every `watch_interval`
+    seconds if that is given, `reload(force)` is called, with force=True for SIGHUP; it should
+    return True if it has loaded new maps, in which case the workers are replaced.
+    """
+    host, port = self.bind()
+    if preload:
+      preload()
+    self.drain_pipe = os.pipe()
+    os.set_blocking(self.drain_pipe[0], False)
+    self.busy = memoryview(mmap.mmap(-1, 8 * self.nworkers)).cast('d')
+    freeze()
+
+    signal.signal(signal.SIGTERM, self.handle_stop)
+    signal.signal(signal.SIGINT, self.handle_stop)
+    signal.signal(signal.SIGHUP, self.handle_recycle)
+    print("Serving on http://{}:{} with {} workers (master {})".format(
+      host, port, self.nworkers, os.getpid()))
+    sys.stdout.flush()
+
+    next_watch = time.time() + watch_interval
+    while not self.stopping:
+      self.reap_workers()
+      self.read_draining()
+      self.kill_hung_workers()
+      watching = watch_interval and time.time() >= next_watch
+      if reload and (self.recycling or watching):
+        force, self.recycling = self.recycling, False
+        next_watch = time.time() + watch_interval
+        if reload(force):
+          freeze()
+          self.recycling = True
+        elif force:
+          print("Keeping the current workers")
+        sys.stdout.flush()
+      if self.recycling:
+        self.recycling = False
+        self.signal_workers(signal.SIGTERM)
+      while len(self.workers) < self.nworkers and not self.stopping:
+        self.spawn_worker()
+      time.sleep(POLL_INTERVAL)
+
+    self.shutdown()
+
+  def handle_stop(self, signum, frame):
+    self.stopping = True
+
+  def handle_recycle(self, signum, frame):
+    self.recycling = True
+
+  def signal_workers(self, signum):
+    for pid in list(self.workers):
+      try:
+        os.kill(pid, signum)
+      except ProcessLookupError:
+        pass
+
+  def reap_workers(self):
+    """
+    Forget about any workers that have exited.
+    """
+    while self.workers or self.draining:
+      try:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+      except ChildProcessError:
+        self.workers = {}
+        self.draining = {}
+        return
+      if not pid:
+        return
+      self.forget_worker(pid)
+
+  def forget_worker(self, pid):
+    self.workers.pop(pid, None)
+    self.draining.pop(pid, None)
+    self.slots.pop(pid, None)
+    if self.exited:
+      self.exited(pid)
+
+  def read_draining(self):
+    """
+    Move the workers that have said that they are draining out of the workers to be replaced.
+    """
+    try:
+      pids = os.read(self.drain_pipe[0], 4096).split()
+    except BlockingIOError:
+      return
+    for pid in map(int, pids):
+      if pid in self.workers:
+        self.draining[pid] = self.workers.pop(pid)
+        self.slots.pop(pid, None)
+
+  def kill_hung_workers(self):
+    """
+    Kill the workers that have been serving a request for more than `timeout` seconds. They are
+    replaced once they have been reaped.
+    """
+    if not self.timeout:
+      return
+    now = time.time()
+    for pid, slot in self.slots.items():
+      started = self.busy[slot]
+      if started and now - started > self.timeout:
+        print("Killing worker {}, which has been serving a request for {:.0f} seconds".format(
+          pid, now - started), file=sys.stderr)
+        self.busy[slot] = 0.0
+        try:
+          os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+          pass
+
+  def spawn_worker(self):
+    self.slot = min(set(range(self.nworkers)) - set(self.slots.values()))
+    self.busy[self.slot] = 0.0
+    pid = os.fork()
+    if pid:
+      self.workers[pid] = time.time()
+      self.slots[pid] = self.slot
+      return
+    # In the worker:
+    status = 0
+    try:
+      self.serve()
+      if self.drain:
+        # Writes this small to a pipe are atomic, so the pids of different workers cannot mix:
+        os.write(self.drain_pipe[1], '{}\n'.format(os.getpid()).encode('ascii'))
+        self.drain()
+    except BaseException as e:
+      print("Worker {} failed: {}".format(os.getpid(), e), file=sys.stderr)
+      status = 1
+    finally:
+      sys.stdout.flush()
+      sys.stderr.flush()
+      os._exit(status)
+
+  def serve(self):
+    """
+    Serve requests from the shared socket until the worker has served `max_requests` requests or
+    has been asked to stop.
+    """
+    stopping = False
+
+    def stop(signum, frame):
+      nonlocal stopping
+      stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    # The master looks after these:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    class RequestHandler(WSGIRequestHandler):
+      timeout = self.timeout or None
+
+    server = WorkerServer(self.socket, RequestHandler, self.busy, self.slot)
+    server.set_app(self.app)
+    server.timeout = POLL_INTERVAL
+    while not stopping and (not self.max_requests or server.served < self.max_requests):
+      server.handle_request()
+
+  def shutdown(self):
+    """
+    Ask every worker to stop, wait for them to do so, and kill any that are still running after
+    `graceful_timeout` seconds, including those that are draining.
+    """
+    self.signal_workers(signal.SIGTERM)
+    deadline = time.time() + self.graceful_timeout
+    while (self.workers or self.draining) and time.time() < deadline:
+      self.reap_workers()
+      time.sleep(0.05)
+    self.workers.update(self.draining)
+    self.draining = {}
+    self.signal_workers(signal.SIGKILL)
+    while self.workers:
+      pid, status = os.waitpid(-1, 0)
+      self.forget_worker(pid)
+    self.socket.close()
+    if self.drain_pipe:
+      for fd in self.drain_pipe:
+        os.close(fd)
+      self.drain_pipe = None
+
+
+def test_prefork():
+  maps = {'version': 0}
+
+  def load():
+    maps['version'] += 1
+
+  def reload(force):
+    load()
+    return True
+
+  def app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return ['{} {}'.format(os.getpid(), maps['version']).encode('utf-8')]
+
+  def get():
+    with urllib.request.urlopen('http://{}:{}/'.format(host, port), timeout=10) as response:
+      pid, version = response.read().split()
+      return int(pid), int(version)
+
+  server = PreforkServer(app, port=0, workers=2, max_requests=2, timeout=5, graceful_timeout=5)
+  host, port = server.bind()
+  master = os.fork()
+  if not master:
+    try:
+      sys.stdout = open(os.devnull, 'w')
+      sys.stderr = open(os.devnull, 'w')
+      server.run(preload=load, reload=reload)
+    finally:
+      os._exit(0)
+
+  try:
+    responses = [get() for i in range(8)]
+    # Each worker serves two requests before being replaced, so eight requests need four workers:
+    pids = set([pid for pid, version in responses])
+    assert len(pids) >= 4 and master not in pids
+    # The workers were forked after the maps were loaded:
+    assert set([version for pid, version in responses]) == {1}
+
+    # On SIGHUP the master reloads the maps and replaces the workers:
+    os.kill(master, signal.SIGHUP)
+    deadline = time.time() + 10
+    while get()[1] != 2 and time.time() < deadline:
+      time.sleep(0.1)
+    assert get()[1] == 2
+  finally:
+    os.kill(master, signal.SIGTERM)
+    pid, status = os.waitpid(master, 0)
+    server.socket.close()
+  assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+
+def test_prefork_jobs(tmpdir):
+  from jobs import JobStore
+
+  store = JobStore(str(tmpdir), workers=1)
+
+  def process(items):
+    for item in items:
+      time.sleep(item)
+      yield item
+
+  def app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    if environ['PATH_INFO'] == '/submit':
+      return [store.submit([0.2] * 5, process).encode('utf-8')]
+    status = store.status(environ['PATH_INFO'].strip('/'))
+    return ['{} {}'.format(os.getpid(), status['state']).encode('utf-8')]
+
+  def get(path):
+    with urllib.request.urlopen('http://{}:{}{}'.format(host, port, path), timeout=10) as response:
+      return response.read().decode('utf-8')
+
+  server = PreforkServer(app, port=0, workers=1, max_requests=2, timeout=5, graceful_timeout=5,
+                         drain=store.wait)
+  host, port = server.bind()
+  master = os.fork()
+  if not master:
+    try:
+      sys.stdout = open(os.devnull, 'w')
+      sys.stderr = open(os.devnull, 'w')
+      server.run()
+    finally:
+      os._exit(0)
+
+  try:
+    job_id = get('/submit')
+    first, state = get('/' + job_id).split()
+    assert state in ['queued', 'running']
+    # The worker has reached its limit, but is replaced while it finishes the job:
+    second, state = get('/' + job_id).split()
+    assert second != first and state in ['queued', 'running']
+    deadline = time.time() + 10
+    while state in ['queued', 'running'] and time.time() < deadline:
+      time.sleep(0.1)
+      state = get('/' + job_id).split()[1]
+    assert state == 'done'
+    assert len(list(store.results(job_id))) == 5
+  finally:
+    os.kill(master, signal.SIGTERM)
+    pid, status = os.waitpid(master, 0)
+    server.socket.close()
+  assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+
+def test_prefork_timeout():
+  def app(environ, start_response):
+    if environ['PATH_INFO'] == '/hang':
+      time.sleep(30)
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(os.getpid()).encode('utf-8')]
+
+  def get(path):
+    with urllib.request.urlopen('http://{}:{}{}'.format(host, port, path), timeout=10) as response:
+      return int(response.read())
+
+  server = PreforkServer(app, port=0, workers=1, max_requests=0, timeout=1, graceful_timeout=5)
+  host, port = server.bind()
+  master = os.fork()
+  if not master:
+    try:
+      sys.stdout = open(os.devnull, 'w')
+      sys.stderr = open(os.devnull, 'w')
+      server.run()
+    finally:
+      os._exit(0)
+
+  try:
+    first = get('/')
+    # The worker serving the hanging request is killed once it has taken more than the timeout:
+    start = time.time()
+    try:
+      get('/hang')
+      assert False
+    except OSError:
+      pass
+    assert time.time() - start < 5
+    # It is replaced, and the new worker serves requests:
+    second = get('/')
+    assert second != first
+    try:
+      os.kill(first, 0)
+      assert False
+    except ProcessLookupError:
+      pass
+  finally:
+    os.kill(master, signal.SIGTERM)
+    pid, status = os.waitpid(master, 0)
+    server.socket.close()
+  assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+
+def test_prefork_metrics(tmpdir):
+  from metrics import Metrics
+  metrics = Metrics(directory=str(tmpdir), save_interval=0)
+
+  def app(environ, start_response):
+    if environ['PATH_INFO'] != '/metrics':
+      metrics.inc('requests_total', pid=os.getpid())
+      metrics.save()
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [metrics.render().encode('utf-8')]
+
+  def get(path):
+    with urllib.request.urlopen('http://{}:{}{}'.format(host, port, path), timeout=10) as response:
+      return response.read().decode('utf-8')
+
+  # The workers are replaced every few requests, so the counts of exited workers are included too:
+  server = PreforkServer(app, port=0, workers=2, max_requests=3, drain=lambda: metrics.save(True),
+                         exited=metrics.retire)
+  host, port = server.bind()
+  master = os.fork()
+  if not master:
+    try:
+      sys.stdout = open(os.devnull, 'w')
+      sys.stderr = open(os.devnull, 'w')
+      server.run()
+    finally:
+      os._exit(0)
+
+  try:
+    for i in range(12):
+      get('/')
+    counts = {}
+    for line in get('/metrics').splitlines():
+      if line.startswith('requests_total'):
+        name, value = line.rsplit(' ', 1)
+        counts[name] = int(value)
+  finally:
+    os.kill(master, signal.SIGTERM)
+    pid, status = os.waitpid(master, 0)
+    server.socket.close()
+  assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+  # The requests were served by more than one worker, and the counts of all of them are summed:
+  assert len(counts) > 1
+  assert sum(counts.values()) == 12
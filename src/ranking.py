@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+#
+# Ranks the cell types of the Cell Ontology by how closely their logical definitions match a gating
+# definition, for when the gates do not match any definition exactly. The gates of every cell
+# definition are compiled into a matrix of classes by markers (kinds), holding a signed code for the
+# level of each marker in each definition, so that a gating definition can be scored against every
+# class at once with NumPy instead of looping over the classes in Python.
+
+import numpy as np
+
+from common import get_level_iris
+
+# The code stored in the matrix for each level IRI. Negative codes are for markers that must be
+# absent and positive codes for markers that must be present, in increasing amounts. Zero means that
+# the definition does not mention the marker.
+LEVEL_CODES = {
+  'http://purl.obolibrary.org/obo/cl#lacks_plasma_membrane_part': -1,
+  'http://purl.obolibrary.org/obo/cl#has_low_plasma_membrane_amount': 1,
+  'http://purl.obolibrary.org/obo/RO_0002104': 2,
+  'http://purl.obolibrary.org/obo/cl#has_high_plasma_membrane_amount': 3
+}
+
+# How much each marker counts towards the score of a class: a gate at the same level as in the
+# definition, a gate at a different amount of a present marker (e.g. CD4++ for CD4+), a gate that
+# contradicts the definition (e.g. CD4- for CD4+), and a marker of the definition with no gate:
+MATCH_WEIGHT = 1.0
+PARTIAL_WEIGHT = 0.5
+CONFLICT_PENALTY = 2.0
+MISSING_PENALTY = 0.25
+
+
+class CellRanking:
+  """
+  A matrix of the levels of markers in cell definitions, built from a map of cell IRIs to their
+  gates (see update_iri_maps_from_owl()), used to find the cells closest to a gating definition.
+  """
+  def __init__(self, iri_gates={}):
+    self.cells = sorted(iri_gates)
+    self.markers = sorted(set([gate['kind'] for gates in iri_gates.values() for gate in gates]))
+    self.marker_columns = {marker: i for i, marker in enumerate(self.markers)}
+    self.matrix = np.zeros((len(self.cells), len(self.markers)), dtype=np.int8)
+    for i, iri in enumerate(self.cells):
+      for gate in iri_gates[iri]:
+        code = LEVEL_CODES.get(gate['level'])
+        if code:
+          self.matrix[i, self.marker_columns[gate['kind']]] = code
+    # The number of markers in each definition, and the rows of the cells that have any. Cells
+    # without markers would otherwise outrank every cell that matches some of the gates but not all
+    # of its definition, since they have nothing to miss:
+    self.sizes = np.count_nonzero(self.matrix, axis=1)
+    self.defined = np.flatnonzero(self.sizes)
+
+  def __len__(self):
+    return len(self.cells)
+
+  def rank(self, gates, k=10):
+    """
+    Score every cell against the given (kind, level) pairs and return the `k` best cells, from the
+    highest score to the lowest and then by IRI, as a list of dictionaries with the cell's IRI, its
+    score, and the numbers of gates that it matches exactly, matches partially and conflicts with,
+    and of the markers in its definition for which there is no gate. Gates for markers that are not
+    in any definition cannot distinguish between the cells, and are ignored, and so are cells whose
+    definitions have no markers.
+    """
+    columns = []
+    codes = []
+    for kind, level in gates:
+      if kind in self.marker_columns and LEVEL_CODES.get(level):
+        columns.append(self.marker_columns[kind])
+        codes.append(LEVEL_CODES[level])
+    if not len(self.defined) or k <= 0:
+      return []
+
+    # Only the columns of the gates' markers need to be looked at, since every other marker in a
+    # definition is simply missing:
+    levels = self.matrix[np.ix_(self.defined, columns)]
+    query = np.array(codes, dtype=np.int8)
+    signs = levels * np.sign(query)
+    matched = np.count_nonzero(levels == query, axis=1)
+    partial = np.count_nonzero(signs > 0, axis=1) - matched
+    conflicts = np.count_nonzero(signs < 0, axis=1)
+    missing = self.sizes[self.defined] - np.count_nonzero(levels, axis=1)
+    scores = (MATCH_WEIGHT * matched + PARTIAL_WEIGHT * partial -
+              CONFLICT_PENALTY * conflicts - MISSING_PENALTY * missing)
+
+    # Select the best k before sorting them. The rows are in IRI order, so a stable sort of the
+    # selected row numbers by descending score breaks ties by IRI:
+    k = min(k, len(self.defined))
+    best = np.sort(np.argpartition(-scores, k - 1)[:k])
+    threshold = scores[best].min()
+    best = np.union1d(best, np.flatnonzero(scores == threshold))
+    best = best[np.argsort(-scores[best], kind='stable')][:k]
+    return [{
+      'iri': self.cells[self.defined[i]],
+      'score': float(scores[i]),
+      'matched': int(matched[i]),
+      'partial': int(partial[i]),
+      'conflicts': int(conflicts[i]),
+      'missing': int(missing[i])} for i in best]
+
+
+def test_cell_ranking():
+  level_iris = get_level_iris()
+  pos, neg, high = level_iris['+'], level_iris['-'], level_iris['++']
+
+  def gates(*pairs):
+    return [{'kind': kind, 'level': level} for kind, level in pairs]
+
+  ranking = CellRanking({
+    'T cell': gates(('CD3', pos)),
+    'CD4 T cell': gates(('CD3', pos), ('CD4', pos), ('CD8', neg)),
+    'CD8 T cell': gates(('CD3', pos), ('CD8', pos)),
+    'B cell': gates(('CD19', pos), ('CD3', neg)),
+    'cell': []
+  })
+  assert len(ranking) == 5
+  assert ranking.markers == ['CD19', 'CD3', 'CD4', 'CD8']
+
+  assert ranking.rank([('CD3', pos), ('CD4', high), ('foo', pos)], k=3) == [
+    {'iri': 'CD4 T cell', 'score': 1.25, 'matched': 1, 'partial': 1, 'conflicts': 0, 'missing': 1},
+    {'iri': 'T cell', 'score': 1.0, 'matched': 1, 'partial': 0, 'conflicts': 0, 'missing': 0},
+    {'iri': 'CD8 T cell', 'score': 0.75, 'matched': 1, 'partial': 0, 'conflicts': 0, 'missing': 1}]
+
+  ranked = ranking.rank([('CD3', neg)])
+  assert [cell['iri'] for cell in ranked] == ['B cell', 'T cell', 'CD8 T cell', 'CD4 T cell']
+  assert [cell['conflicts'] for cell in ranked] == [0, 1, 1, 1]
+
+  # Cells without markers are not ranked, even above cells that miss some of their markers:
+  ranking = CellRanking({
+    'CD4 T cell': gates(('CD3', pos), ('CD4', pos), ('CD8', neg), ('CD19', neg), ('CD56', neg),
+                        ('CD14', neg)),
+    'cell': [], 'native cell': [{'kind': 'foo', 'level': 'bar'}]})
+  assert [cell['iri'] for cell in ranking.rank([('CD4', pos)])] == ['CD4 T cell']
+  assert CellRanking({'cell': []}).rank([('CD3', pos)]) == []
+
+  # Ties are broken by IRI, including ties at the cut-off:
+  b_and_a = CellRanking({'b': gates(('CD3', pos)), 'a': gates(('CD4', pos))})
+  assert [cell['iri'] for cell in b_and_a.rank([], k=1)] == ['a']
+  assert CellRanking().rank([('CD3', pos)]) == []
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+#
+# A size-bounded, in-process cache of rendered server responses. Responses are kept in least
+# recently used order, and the least recently used ones are evicted once the total size of the
+# cached bodies goes over the limit. The cache also counts its hits and misses.
+
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+
+
+class ResponseCache:
+  """
+  A least recently used cache mapping keys (which must be hashable) to response bodies (bytes),
+  together with a strong ETag for each body.
+  """
+  def __init__(self, max_bytes=64 * 1024 * 1024):
+    self.max_bytes = max_bytes
+    self.entries = OrderedDict()
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.lock = Lock()
+
+  def get(self, key):
+    """
+    Return the (body, etag) pair cached for the given key, or None if there is none.
+    """
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        self.misses += 1
+        return None
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return entry
+
+  def put(self, key, body):
+    """
+    Cache the given body under the given key and return the (body, etag) pair. Bodies larger than
+    the whole cache are not cached.
+    """
+    entry = (body, make_etag(body))
+    if len(body) > self.max_bytes:
+      return entry
+    with self.lock:
+      if key in self.entries:
+        self.size -= len(self.entries.pop(key)[0])
+      self.entries[key] = entry
+      self.size += len(body)
+      while self.size > self.max_bytes:
+        evicted_body, evicted_etag = self.entries.popitem(last=False)[1]
+        self.size -= len(evicted_body)
+        self.evictions += 1
+    return entry
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.size = 0
+
+  def stats(self):
+    """
+    Return a dictionary with the number of entries, their total size, and the hit and miss counts.
+    """
+    with self.lock:
+      lookups = self.hits + self.misses
+      return {
+        'entries': len(self.entries),
+        'bytes': self.size,
+        'max_bytes': self.max_bytes,
+        'hits': self.hits,
+        'misses': self.misses,
+        'evictions': self.evictions,
+        'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+      }
+
+
+def make_etag(body):
+  """
+  Return a strong entity tag (without quotes) for the given response body.
+  """
+  return hashlib.sha1(body).hexdigest()
+
+
+def test_response_cache():
+  cache = ResponseCache(max_bytes=10)
+  assert cache.get(('T cell', 'CD4+')) is None
+  body, etag = cache.put(('T cell', 'CD4+'), b'12345')
+  assert cache.get(('T cell', 'CD4+')) == (b'12345', etag)
+  assert etag == make_etag(b'12345') and etag != make_etag(b'123456')
+
+  cache.put(('B cell', ''), b'6789')
+  # Using the T cell entry makes the B cell entry the least recently used one:
+  cache.get(('T cell', 'CD4+'))
+  cache.put(('NK cell', ''), b'abc')
+  assert cache.get(('B cell', '')) is None
+  assert cache.get(('NK cell', '')) is not None
+  cache.put(('too big', ''), b'x' * 11)
+  assert cache.get(('too big', '')) is None
+
+  assert cache.stats() == {'entries': 2, 'bytes': 8, 'max_bytes': 10, 'hits': 3, 'misses': 3,
+                           'evictions': 1, 'hit_rate': 0.5}
+  cache.clear()
+  assert cache.stats()['entries'] == 0
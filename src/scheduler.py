@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+#
+# Size-aware scheduling of the studies validated by batch_validate.py. The number of records in a
+# study is taken from the study sizes file written by earlier runs if it is there, and is otherwise
+# estimated from the size of the study's cached JSON file. Studies are then bin-packed, largest
+# first, across workers (e.g. the shards of a sharded run), and the runtime and memory use of the
+# run are estimated before it starts.
+
+import csv
+import hashlib
+import os
+
+# Used when there are no earlier runs to calibrate against:
+DEFAULT_BYTES_PER_RECORD = 1000
+DEFAULT_SECONDS_PER_RECORD = 0.001
+# The approximate amount of memory taken up by a record once it has been loaded from JSON and
+# validated:
+MEMORY_PER_RECORD = 4000
+
+
+def read_study_sizes(sizes_file):
+  """
+  Given a TSV file with 'Study' and 'Records' columns, and optionally a 'Seconds' column, return a
+  map from study ids to a dictionary with their number of records and the seconds taken to process
+  them (or None if unknown).
+  """
+  rows = csv.DictReader(sizes_file, delimiter='\t')
+  sizes = {}
+  for row in rows:
+    seconds = row.get('Seconds')
+    sizes[row['Study']] = {
+      'records': int(row['Records']),
+      'seconds': float(seconds) if seconds else None}
+  return sizes
+
+
+def write_study_sizes(path, sizes):
+  """
+  Write the given map from study ids to records and seconds (see read_study_sizes()) to a TSV file.
+  """
+  with open(path, 'w') as f:
+    w = csv.writer(f, delimiter='\t', lineterminator='\n')
+    w.writerow(['Study', 'Records', 'Seconds'])
+    for sid in sorted(sizes):
+      seconds = sizes[sid]['seconds']
+      w.writerow([sid, sizes[sid]['records'], '' if seconds is None else seconds])
+
+
+def update_study_sizes(path, completed):
+  """
+  Update the study sizes file at the given path with the number of records and seconds taken for
+  the given completed studies (as recorded in a checkpoint manifest).
+  """
+  sizes = {}
+  try:
+    with open(path) as f:
+      sizes = read_study_sizes(f)
+  except FileNotFoundError:
+    pass
+  for sid, study in completed.items():
+    if study['records']:
+      sizes[sid] = {'records': study['records'], 'seconds': study['seconds']}
+  write_study_sizes(path, sizes)
+
+
+def get_cache_path(cache_dir, sid):
+  return os.path.normpath('{}/fcsAnalyzed/{}.json'.format(cache_dir, sid))
+
+
+def estimate_study_sizes(sids, known, cache_dir):
+  """
+  Return a map from each of the given study ids to its known or estimated number of records. For a
+  study without a known size but with a cached JSON file, the number of records is estimated using
+  the average number of bytes per record of the studies for which both are available. Any other
+  study is given the average size of the rest. If cache_dir is None, cached files are ignored.
+  """
+  file_sizes = {}
+  for sid in sids if cache_dir is not None else []:
+    try:
+      file_sizes[sid] = os.path.getsize(get_cache_path(cache_dir, sid))
+    except OSError:
+      pass
+
+  calibration = [sid for sid in file_sizes if sid in known and known[sid]['records']]
+  bytes_per_record = DEFAULT_BYTES_PER_RECORD
+  if calibration:
+    bytes_per_record = (sum([file_sizes[sid] for sid in calibration]) /
+                        sum([known[sid]['records'] for sid in calibration]))
+
+  sizes = {}
+  for sid in sids:
+    if sid in known:
+      sizes[sid] = known[sid]['records']
+    elif sid in file_sizes:
+      sizes[sid] = round(file_sizes[sid] / bytes_per_record)
+
+  default = round(sum(sizes.values()) / len(sizes)) if sizes else 0
+  for sid in sids:
+    sizes.setdefault(sid, default)
+  return sizes
+
+
+def study_hash(sid):
+  """
+  Returns a hash of the given study id that, unlike the builtin hash(), is the same in every process
+  and on every machine.
+  """
+  return int(hashlib.sha1(sid.encode('utf-8')).hexdigest(), 16)
+
+
+def largest_first(sids, sizes):
+  """
+  Return the given studies ordered from the largest to the smallest.
+  """
+  return sorted(sids, key=lambda sid: (-sizes.get(sid, 0), study_hash(sid), sid))
+
+
+def schedule(sids, sizes, nworkers):
+  """
+  Bin-pack the given studies across `nworkers` workers using the 'longest processing time first'
+  rule: each study, from the largest to the smallest, goes to the worker with the least work so
+  far. Returns a list containing, for each worker, its studies in the order they should be
+  processed (largest first).
+  """
+  bins = [[] for i in range(nworkers)]
+  loads = [0] * nworkers
+  for sid in largest_first(sids, sizes):
+    lightest = loads.index(min(loads))
+    bins[lightest].append(sid)
+    loads[lightest] += sizes.get(sid, 0)
+  return bins
+
+
+def get_seconds_per_record(known):
+  """
+  Return the average number of seconds taken to process a record in earlier runs.
+  """
+  timed = [size for size in known.values() if size['seconds'] and size['records']]
+  if not timed:
+    return DEFAULT_SECONDS_PER_RECORD
+  return sum([size['seconds'] for size in timed]) / sum([size['records'] for size in timed])
+
+
+def estimate_run(bins, sizes, seconds_per_record):
+  """
+  Estimate the time that the given schedule will take, i.e. the time taken by its busiest worker,
+  and the peak memory used by a single worker, which holds one study in memory at a time. Returns a
+  dictionary with the number of records, seconds and peak bytes.
+  """
+  loads = [sum([sizes[sid] for sid in workload]) for workload in bins]
+  largest = max([sizes[sid] for workload in bins for sid in workload] or [0])
+  return {
+    'records': sum(loads),
+    'seconds': max(loads) * seconds_per_record if loads else 0,
+    'peak_bytes': largest * MEMORY_PER_RECORD
+  }
+
+
+def test_scheduler(tmpdir):
+  tmpdir.mkdir('fcsAnalyzed')
+  tmpdir.join('fcsAnalyzed', 'SDY1.json').write('x' * 5000)
+  tmpdir.join('fcsAnalyzed', 'SDY2.json').write('x' * 20000)
+  known = {'SDY1': {'records': 50, 'seconds': 1.0}, 'SDY9': {'records': 10, 'seconds': None}}
+
+  # SDY1 and SDY9 are known, SDY2 is estimated from its cache file using the 100 bytes per record of
+  # SDY1, and SDY3 gets the average of the others:
+  sizes = estimate_study_sizes(['SDY1', 'SDY2', 'SDY3', 'SDY9'], known, str(tmpdir))
+  assert sizes == {'SDY1': 50, 'SDY2': 200, 'SDY3': 87, 'SDY9': 10}
+
+  bins = schedule(['SDY1', 'SDY2', 'SDY3', 'SDY9'], sizes, 2)
+  assert bins == [['SDY2'], ['SDY3', 'SDY1', 'SDY9']]
+  assert largest_first(['SDY9', 'SDY1', 'SDY2'], sizes) == ['SDY2', 'SDY1', 'SDY9']
+
+  estimate = estimate_run(bins, sizes, get_seconds_per_record(known))
+  assert estimate['records'] == 347
+  assert estimate['seconds'] == 200 * 0.02
+  assert estimate['peak_bytes'] == 200 * MEMORY_PER_RECORD
+
+  path = str(tmpdir.join('study-sizes.tsv'))
+  write_study_sizes(path, known)
+  with open(path) as f:
+    assert read_study_sizes(f) == known
+  update_study_sizes(path, {'SDY2': {'segment': 'SDY2.tsv', 'records': 180, 'seconds': 3.5},
+                            'SDY3': {'segment': None, 'records': 0, 'seconds': 0}})
+  with open(path) as f:
+    assert read_study_sizes(f) == {'SDY1': {'records': 50, 'seconds': 1.0},
+                                   'SDY2': {'records': 180, 'seconds': 3.5},
+                                   'SDY9': {'records': 10, 'seconds': None}}
@@ -2,100 +2,447 @@
 #
 # Use [Flask](http://flask.pocoo.org) to serve a validation page.
 
+import argparse
 import csv
+import hashlib
+import io
+import json
+import os
+import pickle
 import re
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
 import xml.etree.ElementTree as ET
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager, nullcontext
 from copy import deepcopy
-from flask import Flask, request, render_template
+from flask import Flask, g, has_app_context, request, render_template
 from os import path
 
-from common import IriMaps, split_gate, extract_iri_special_label_maps, extract_iri_label_maps, \
-  extract_iri_exact_label_maps, extract_suffix_syns_symbs_maps, update_iri_maps_from_owl
+from checkpoint import atomic_write
+from common import GateIndex, HierarchyIndex, IriMaps, PrefixIndex, split_gate, \
+  extract_iri_special_label_maps, extract_iri_label_maps, extract_iri_exact_label_maps, \
+  extract_iri_parent_maps, extract_suffix_syns_symbs_maps, update_iri_maps_from_owl
+from jobs import JobStore
+from map_versions import MapVersions
+from metrics import Metrics
+from normalized_index import NormalizedIndex
+from prefork import PreforkServer
+from ranking import CellRanking
+from response_cache import ResponseCache
+from writers import TsvWriter
 
 
 pwd = path.dirname(path.realpath(__file__))
 app = Flask(__name__)
+app.config['BUILD_DIR'] = path.normpath(pwd + '/../build')
 
-# Used for managing shared maps:
+# Used for managing shared maps. When the maps are reloaded, a new IriMaps is swapped in for this
+# one, so code that handles requests should get the maps using current_maps():
 irimaps = IriMaps()
 
+# Rendered validation pages, keyed on the request's fields and the version of the maps:
+response_cache = ResponseCache()
 
-def load_maps():
+# Other named versions of the maps (e.g. an older CL and PR release), which requests can select with
+# a `version` parameter. Each is loaded by load_version() when it is first asked for:
+map_versions = MapVersions(lambda source: load_version(source))
+
+# The files in the build directory that the maps are loaded from:
+MAP_FILES = ['value-scale.tsv', 'special-gates.tsv', 'pr-labels.tsv', 'pr-exact-synonyms.tsv',
+             'pr-parents.tsv', 'cl-plus.owl']
+
+# The progress of loading the maps (see load_maps()), and the number of seconds after which clients
+# should retry requests that arrive before the maps are ready:
+load_status = {'state': 'pending', 'tables': OrderedDict()}
+load_status_lock = threading.Lock()
+RETRY_AFTER = 5
+
+# Held while maps are being loaded, so that only one set of new maps is loaded at a time:
+loading_lock = threading.Lock()
+
+# Request counts and the latencies of requests and of the stages of handling them, reported at
+# /metrics. Requests that take longer than SLOW_REQUEST_SECONDS are logged along with their inputs:
+SLOW_REQUEST_SECONDS = 1.0
+metrics = Metrics(slow_seconds=SLOW_REQUEST_SECONDS)
+app.config['METRICS_DIR'] = path.join(tempfile.gettempdir(), 'hipc-validator-metrics')
+metrics.describe('hipc_requests_total', 'counter', 'Requests served, by endpoint and status.')
+metrics.describe('hipc_request_seconds', 'histogram', 'Time taken to serve requests, by endpoint.')
+metrics.describe('hipc_stage_seconds', 'histogram',
+                 'Time taken by each stage of validating cells and gates.')
+metrics.describe('hipc_slow_requests_total', 'counter',
+                 'Requests that took longer than {} seconds.'.format(SLOW_REQUEST_SECONDS))
+
+# Build files that have been modified within this many seconds may still be being written, so they
+# are not reloaded yet:
+SETTLE_SECONDS = 2
+
+
+def get_maps_version(build_dir):
+  """
+  Return a stamp identifying the current versions of the files in the given build directory that
+  the maps are loaded from, based on their sizes and modification times.
+  """
+  stamp = hashlib.sha1()
+  for name in MAP_FILES:
+    stat = os.stat(path.join(build_dir, name))
+    stamp.update('{}\t{}\t{}\n'.format(name, stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+  return stamp.hexdigest()[:16]
+
+
+def set_load_status(table=None, **status):
+  """
+  Update the status of loading the maps, or of loading the given table if one is given.
+  """
+  with load_status_lock:
+    if table:
+      load_status['tables'][table].update(status)
+    else:
+      load_status.update(status)
+
+
+def get_load_status():
+  """
+  Return a copy of the status of loading the maps, which is safe to serialize while the maps are
+  being loaded in another thread.
+  """
+  with load_status_lock:
+    return deepcopy(load_status)
+
+
+@contextmanager
+def loading_table(name):
+  """
+  Record the progress and the time taken of loading the table with the given name within the block.
+  """
+  set_load_status(name, state='loading')
+  start = time.time()
+  try:
+    yield
+  except Exception:
+    set_load_status(name, state='failed')
+    raise
+  set_load_status(name, state='loaded', seconds=round(time.time() - start, 3))
+
+
+def current_maps():
+  """
+  Return the maps to use. During a request, these are the maps that were current when the request
+  started, so that a request that is being handled while the maps are swapped finishes on the old
+  maps.
+  """
+  if has_app_context():
+    if 'irimaps' not in g:
+      g.irimaps = irimaps
+    return g.irimaps
+  return irimaps
+
+
+def swap_maps(maps):
+  """
+  Make the given maps the current maps, and drop the responses that were rendered using the old
+  ones.
+  """
+  global irimaps
+  irimaps = maps
+  response_cache.clear()
+
+
+def load_maps(build_dir=None):
+  """
+  Read data from various files in the build directory into a new set of maps, and then swap them in
+  for the current maps. The progress of loading each table is recorded in load_status. If maps have
+  already been loaded, the server stays ready while the new ones are loaded, and keeps the old ones
+  if loading the new ones fails.
+  """
+  build_dir = build_dir or app.config['BUILD_DIR']
+  with loading_lock:
+    start = time.time()
+    reloading = load_status['state'] == 'ready'
+    set_load_status(state='ready' if reloading else 'loading', reloading=reloading, error=None,
+                    seconds=None,
+                    tables=OrderedDict([(name, {'state': 'pending'}) for name in MAP_FILES]))
+    version = None
+    try:
+      maps = IriMaps()
+      maps.version = version = get_maps_version(build_dir)
+      update_maps(maps, build_dir)
+    except Exception as e:
+      set_load_status(state='ready' if reloading else 'failed', reloading=False, error=str(e),
+                      failed_version=version)
+      raise
+    swap_maps(maps)
+    set_load_status(state='ready', reloading=False, version=maps.version, failed_version=None,
+                    seconds=round(time.time() - start, 3))
+
+
+def save_snapshot(maps, snapshot_path):
+  """
+  Save the given maps to a snapshot file, from which they can be loaded by load_snapshot() much
+  faster than from the build files.
+  """
+  atomic_write(snapshot_path, pickle.dumps(maps, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def load_snapshot(snapshot_path):
+  """
+  Return the maps saved to the given snapshot file by save_snapshot().
+  """
+  with open(snapshot_path, 'rb') as f:
+    maps = pickle.load(f)
+  if not isinstance(maps, IriMaps):
+    raise Exception("{} is not a snapshot of the maps".format(snapshot_path))
+  return maps
+
+
+def load_version(source):
   """
-  Read data from various files in the build directory and use it to populate the maps (dicts)
-  that will be used by the server.
+  Load a named version of the maps (see map_versions) from the given source, which is either a
+  build directory or a snapshot file. Unlike load_maps(), this neither swaps the new maps in for the
+  current ones nor records its progress in load_status.
   """
+  if not path.isdir(source):
+    return load_snapshot(source)
+  maps = IriMaps()
+  maps.version = get_maps_version(source)
+  update_maps(maps, source, report=False)
+  return maps
+
+
+def preload_maps():
+  """
+  Load the maps and the named versions of the maps (see map_versions) that fit within its memory
+  budget, in the master of the pre-forking server, so that they are shared by its workers.
+  """
+  load_maps()
+  if len(map_versions):
+    pinned = map_versions.preload()
+    print("Preloaded {} of {} versions of the maps: {}".format(
+      len(pinned), len(map_versions), ', '.join(pinned) or 'none'))
+
+
+def reload_maps(force=False, build_dir=None):
+  """
+  Load new maps if the build files have changed since the current maps were loaded, or always if
+  `force` is given. Changes to files that were modified in the last SETTLE_SECONDS seconds are
+  left for later, and files that have already failed to load are not tried again unless `force` is
+  given. Returns True if new maps were loaded.
+  """
+  build_dir = build_dir or app.config['BUILD_DIR']
+  try:
+    if not force:
+      version = get_maps_version(build_dir)
+      if version in [irimaps.version, load_status.get('failed_version')]:
+        return False
+      modified = max([os.stat(path.join(build_dir, name)).st_mtime for name in MAP_FILES])
+      if time.time() - modified < SETTLE_SECONDS:
+        return False
+    print("Loading new maps from {}".format(build_dir))
+    load_maps(build_dir)
+  except Exception as e:
+    print("Failed to load new maps: {}".format(e), file=sys.stderr)
+    return False
+  return True
+
+
+def start_loading_maps(build_dir=None):
+  """
+  Load the maps in a background thread, so that the server can start responding (with 503s) while
+  the maps are being loaded. Returns the thread.
+  """
+  def load():
+    try:
+      load_maps(build_dir)
+    except Exception as e:
+      # This has already been recorded in load_status:
+      print("Failed to load the maps: {}".format(e), file=sys.stderr)
+
+  thread = threading.Thread(target=load, name='load_maps', daemon=True)
+  thread.start()
+  return thread
+
+
+def start_watching_maps(interval, build_dir=None):
+  """
+  Check the build files for changes every `interval` seconds in a background thread, and load new
+  maps when they have changed (see reload_maps()). Returns the thread.
+  """
+  def watch():
+    while True:
+      time.sleep(interval)
+      if load_status['state'] == 'ready':
+        reload_maps(build_dir=build_dir)
+
+  thread = threading.Thread(target=watch, name='watch_maps', daemon=True)
+  thread.start()
+  return thread
+
+
+def update_maps(maps, build_dir, report=True):
+  """
+  Populate the given maps from the files in the given build directory, recording the progress of
+  loading each table in load_status unless `report` is False.
+  """
+  loading = loading_table if report else lambda name: nullcontext()
+
   def update_main_maps(to_iris={}, from_iris={}):
     # This inner function updates the synonyms_iris map with the contents of to_iris, and the
     # iri_labels map with the contents of from_iris.
-    irimaps.iri_labels.update(from_iris)
+    maps.iri_labels.update(from_iris)
     # to_iris maps labels to lists of iris, so flatten the lists here:
     for key in to_iris:
-      # irimaps.synonym_iris.update({'{}'.format(key): '{}'.format(','.join(to_iris[key]))})
-      irimaps.synonym_iris.update({'{}'.format(key): '{}'.format(to_iris[key][0])})
+      # maps.synonym_iris.update({'{}'.format(key): '{}'.format(','.join(to_iris[key]))})
+      maps.synonym_iris.update({'{}'.format(key): '{}'.format(to_iris[key][0])})
 
   # Read suffix symbols and suffix synonyms:
-  with open(pwd + '/../build/value-scale.tsv') as f:
+  with loading('value-scale.tsv'), open(build_dir + '/value-scale.tsv') as f:
     rows = csv.DictReader(f, delimiter='\t')
     tmp_1, tmp_2 = extract_suffix_syns_symbs_maps(rows)
-    irimaps.suffixsymbs.update(tmp_1)
-    irimaps.suffixsyns.update(tmp_2)
+    maps.suffixsymbs.update(tmp_1)
+    maps.suffixsyns.update(tmp_2)
 
   # Read special gates and update the synonym_iris and iris_labels maps
-  with open(pwd + '/../build/special-gates.tsv') as f:
+  with loading('special-gates.tsv'), open(build_dir + '/special-gates.tsv') as f:
     rows = csv.DictReader(f, delimiter='\t')
     to_iris, from_iris = extract_iri_special_label_maps(rows)
     update_main_maps(to_iris, from_iris)
 
   # Read PR labels and update the synonym_iris and iris_labels maps
-  with open(pwd + '/../build/pr-labels.tsv') as f:
+  with loading('pr-labels.tsv'), open(build_dir + '/pr-labels.tsv') as f:
     rows = csv.reader(f, delimiter='\t')
     to_iris, from_iris = extract_iri_label_maps(rows)
     update_main_maps(to_iris, from_iris)
 
   # Read PR synonyms and update the synonym_iris and iris_labels maps
-  with open(pwd + '/../build/pr-exact-synonyms.tsv') as f:
+  with loading('pr-exact-synonyms.tsv'), open(build_dir + '/pr-exact-synonyms.tsv') as f:
     rows = csv.reader(f, delimiter='\t')
     to_iris = extract_iri_exact_label_maps(rows)
     update_main_maps(to_iris)
 
-  with open(pwd + '/../build/cl-plus.owl') as f:
+  # Read the PR hierarchy, so that gates on related proteins can be compared:
+  with loading('pr-parents.tsv'), open(build_dir + '/pr-parents.tsv') as f:
+    rows = csv.reader(f, delimiter='\t')
+    maps.pr_hierarchy = HierarchyIndex(extract_iri_parent_maps(rows))
+
+  with loading('cl-plus.owl'), open(build_dir + '/cl-plus.owl') as f:
     source = f.read().strip()
     root = ET.fromstring(source)
-    update_iri_maps_from_owl(root, irimaps.iri_gates, irimaps.iri_parents, irimaps.iri_labels,
-                             irimaps.synonym_iris)
+    update_iri_maps_from_owl(root, maps.iri_gates, maps.iri_parents, maps.iri_labels,
+                             maps.synonym_iris)
+    maps.iri_cells = get_cells_info(maps)
+    maps.gate_cells = GateIndex(maps.iri_gates)
+    maps.cell_ranking = CellRanking(maps.iri_gates)
+    maps.cell_index, maps.gate_index = get_prefix_indexes(maps)
 
 
-def decorate_gate(kind, level):
+class Gate:
   """
-  Create and return a dictionary with information on the supplied gate type and level
+  A gate, either requested or part of a cell's definition, together with information about its
+  kind and level. Only the fields that have been set are included in as_dict(), which returns the
+  same dictionary that was used to represent the gate before these records were introduced.
   """
-  gate = {
-    'kind': kind,
-    'kind_recognized': False,
-    'level': level,
-    'level_recognized': False,
-  }
+  __slots__ = ('kind', 'kind_recognized', 'level', 'level_recognized', 'kind_label', 'level_label',
+               'gate', 'kind_name', 'level_name', 'conflict')
+
+  def __init__(self, **fields):
+    for name, value in fields.items():
+      # This also works for the read-only SharedGate:
+      object.__setattr__(self, name, value)
+
+  def as_dict(self):
+    return {name: getattr(self, name) for name in Gate.__slots__ if hasattr(self, name)}
+
+  def copy(self):
+    return Gate(**self.as_dict())
+
+  # Pickle gates by their fields, so that a SharedGate can be restored in a snapshot of the maps:
+  def __getstate__(self):
+    return self.as_dict()
+
+  def __setstate__(self, state):
+    for name, value in state.items():
+      object.__setattr__(self, name, value)
+
+
+class SharedGate(Gate):
+  """
+  A Gate in the precomputed definition of a cell (see get_cells_info()), which is shared by every
+  request for that cell and so cannot be changed. Use copy() to get a Gate that can be.
+  """
+  __slots__ = ()
+
+  def __setattr__(self, name, value):
+    raise AttributeError("A SharedGate cannot be changed; copy() it first")
+
+
+class Conflict:
+  """
+  A requested gate that conflicts with a gate in a cell's definition. The requested gate is held
+  by reference, and its fields can be read from the conflict directly.
+  """
+  __slots__ = ('record', 'cell_level', 'cell_level_name')
+
+  def __init__(self, record, cell_level, cell_level_name):
+    self.record = record
+    self.cell_level = cell_level
+    self.cell_level_name = cell_level_name
+
+  def __getattr__(self, name):
+    return getattr(self.record, name)
+
+  def as_dict(self):
+    conflict = self.record.as_dict()
+    conflict['cell_level'] = self.cell_level
+    conflict['cell_level_name'] = self.cell_level_name
+    return conflict
+
+
+def as_plain(value):
+  """
+  Return a copy of the given value in which every Gate and Conflict has been replaced by the
+  equivalent dictionary, e.g. for serializing it as JSON.
+  """
+  if isinstance(value, (Gate, Conflict)):
+    return value.as_dict()
+  if isinstance(value, dict):
+    return {key: as_plain(item) for key, item in value.items()}
+  if isinstance(value, list):
+    return [as_plain(item) for item in value]
+  return value
+
+
+def decorate_gate(kind, level, irimaps=None):
+  """
+  Create and return a Gate with information on the supplied gate type and level, using the given
+  maps or else the current maps
+  """
+  irimaps = irimaps or current_maps()
+  gate = Gate(kind=kind, kind_recognized=False, level=level, level_recognized=False)
 
   if kind in irimaps.iri_labels:
-    gate['kind_recognized'] = True
-    gate['kind_label'] = irimaps.iri_labels[kind]
+    gate.kind_recognized = True
+    gate.kind_label = irimaps.iri_labels[kind]
   if kind and not kind.startswith('http'):
-    gate['kind'] = '?gate=' + kind
+    gate.kind = '?gate=' + kind
 
   if level in irimaps.iri_labels:
-    gate['level_recognized'] = True
-    gate['level_label'] = irimaps.iri_labels[level]
+    gate.level_recognized = True
+    gate.level_label = irimaps.iri_labels[level]
 
   return gate
 
 
+@metrics.timed('hipc_stage_seconds', stage='process_gate')
 def process_gate(gate_string):
   """
   In the given gate, replace any suffix synonym with the standard suffix, decorate the
   gate, and then add the gate string, kind, and level information.
   """
+  irimaps = current_maps()
   # If the gate string has a suffix which is a synonym of one of the standard suffixes, then replace
   # it with the standard suffix:
   for suffix in irimaps.suffixsyns.keys():
@@ -116,20 +463,33 @@ def process_gate(gate_string):
     level_name = '+'
   if level_name in irimaps.level_iris:
     level = irimaps.level_iris[level_name]
-  gate = {}
-
   has_errors = False
   gate = decorate_gate(kind, level)
   if not kind:
     has_errors = True
-  gate['gate'] = gate_string
-  gate['kind_name'] = kind_name
-  gate['level_name'] = irimaps.level_names[level_name]
+  gate.gate = gate_string
+  gate.kind_name = kind_name
+  gate.level_name = irimaps.level_names[level_name]
 
   return gate, has_errors
 
 
-def get_cell_name_and_gates(cells_field):
+def process_gate_cached(gate_string, gate_cache=None):
+  """
+  Like process_gate(), but if a gate_cache dictionary is given, then the result for each distinct
+  gate string is only computed once and reused. Each caller gets its own copy of the gate, since the
+  gate is later marked with any conflicts that are found.
+  """
+  if gate_cache is None:
+    return process_gate(gate_string)
+  if gate_string not in gate_cache:
+    gate_cache[gate_string] = process_gate(gate_string)
+  gate, has_errors = gate_cache[gate_string]
+  return gate.copy(), has_errors
+
+
+@metrics.timed('hipc_stage_seconds', stage='get_cell_name_and_gates')
+def get_cell_name_and_gates(cells_field, gate_cache=None):
   """
   Parse out the name and gate list from the given cells field
   """
@@ -146,7 +506,7 @@ def get_cell_name_and_gates(cells_field):
       gate_strings = list(csv.reader([cell_gating], quotechar='"', delimiter=',',
                                      quoting=csv.QUOTE_ALL, skipinitialspace=True)).pop()
       for gate_string in gate_strings:
-        gate, has_errors = process_gate(gate_string.strip("'"))
+        gate, has_errors = process_gate_cached(gate_string.strip("'"), gate_cache)
         cell_gates.append(gate)
   else:
     cell_name = cells_field.strip().strip('"\'')
@@ -154,50 +514,87 @@ def get_cell_name_and_gates(cells_field):
   return cell_name, cell_gates
 
 
-def get_cell_core_info(cell_gates, cell_iri):
+def get_cells_info(irimaps):
   """
-  Initialise a dictionary which will contain information about this cell
+  For every cell in the given maps, compute its core information (its IRI, label, and parent) and
+  the decorated gates of its definition, which depend only on the maps. Returns a map from cell
+  IRIs to dictionaries with the 'core_info' and the 'results' for the cell, which must not be
+  changed since they are shared by every request.
   """
-  cell = {'recognized': False, 'conflicts': False, 'has_cell_gates': len(cell_gates) > 0,
-          'cell_gates': cell_gates}
-  if cell_iri in irimaps.iri_gates:
-    # If the cell IRI is in the IRI->Gates map, then add its IRI and flag it as recognised.
-    cell['recognized'] = True
-    cell['iri'] = cell_iri
+  cells = {}
+  for cell_iri, gates in irimaps.iri_gates.items():
+    core_info = {'recognized': True, 'iri': cell_iri}
     if cell_iri in irimaps.iri_labels:
       # If the cell is in the IRI->Labels map, then add its label
-      cell['label'] = irimaps.iri_labels[cell_iri]
+      core_info['label'] = irimaps.iri_labels[cell_iri]
     if cell_iri in irimaps.iri_parents:
       # It it is in the IRI->Parents map, then add its parent's IRI
-      cell['parent'] = irimaps.iri_parents[cell_iri]
-      if cell['parent'] in irimaps.iri_labels:
+      core_info['parent'] = irimaps.iri_parents[cell_iri]
+      if core_info['parent'] in irimaps.iri_labels:
         # If its parent's IRI is in the IRI->Labels map, then add its parent's label
-        cell['parent_label'] = irimaps.iri_labels[cell['parent']]
+        core_info['parent_label'] = irimaps.iri_labels[core_info['parent']]
 
-  return cell
+    results = []
+    for gate in gates:
+      gate = decorate_gate(gate['kind'], gate['level'], irimaps)
+      if gate.level in irimaps.iri_levels:
+        gate.level_name = irimaps.level_names[irimaps.iri_levels[gate.level]]
+      results.append(SharedGate(**gate.as_dict()))
 
+    cells[cell_iri] = {'core_info': core_info, 'results': tuple(results)}
+  return cells
 
-def get_gate_info_for_cell(cell_iri):
+
+def get_prefix_indexes(irimaps):
   """
-  For each gate associated with the cell IRI, create a dictionary with information about it
-  and append it to a list which is eventually returned.
+  Build prefix indexes for autocompleting the names of cells and of gates that are recognized using
+  the given maps: the labels and synonyms of CL classes, and of PR terms and special gates,
+  respectively. Returns the index of cells and the index of gates.
   """
-  cell_results = []
+  cell_prefix = 'http://purl.obolibrary.org/obo/CL_'
+  cells = []
+  gates = []
+  for name, iri in irimaps.synonym_iris.items():
+    (cells if iri.startswith(cell_prefix) else gates).append((name, iri))
+  for iri, label in irimaps.iri_labels.items():
+    if iri.startswith(cell_prefix):
+      cells.append((label, iri))
+    elif label.casefold() in irimaps.synonym_iris:
+      gates.append((label, iri))
+  return PrefixIndex(cells), PrefixIndex(gates)
 
-  if cell_iri:
-    for gate in irimaps.iri_gates[cell_iri]:
-      gate = decorate_gate(gate['kind'], gate['level'])
-      if gate['level'] in irimaps.iri_levels:
-        gate['level_name'] = irimaps.level_names[irimaps.iri_levels[gate['level']]]
-      cell_results.append(gate)
 
-  return cell_results
+def get_cell_core_info(cell_gates, cell_iri):
+  """
+  Initialise a dictionary which will contain information about this cell
+  """
+  irimaps = current_maps()
+  cell = {'recognized': False, 'conflicts': False, 'has_cell_gates': len(cell_gates) > 0,
+          'cell_gates': cell_gates}
+  if cell_iri in irimaps.iri_cells:
+    # If the cell IRI is in the IRI->Gates map, then add its IRI, label, and parent, and flag it as
+    # recognised.
+    cell.update(irimaps.iri_cells[cell_iri]['core_info'])
 
+  return cell
+
+
+def get_gate_info_for_cell(cell_iri):
+  """
+  Return a list of the (shared) decorated gates in the definition of the cell with the given IRI.
+  """
+  irimaps = current_maps()
+  if cell_iri in irimaps.iri_cells:
+    return list(irimaps.iri_cells[cell_iri]['results'])
+  return []
 
+
+@metrics.timed('hipc_stage_seconds', stage='get_cell_iri')
 def get_cell_iri(cell_name):
   """
   Find the IRI for the cell based on cell_name, which can be a: label/synonym, ID, or IRI.
   """
+  irimaps = current_maps()
   if cell_name.casefold() in irimaps.synonym_iris:
     cell_iri = irimaps.synonym_iris[cell_name.casefold()]
   elif cell_name in irimaps.iri_labels:
@@ -209,14 +606,16 @@ def get_cell_iri(cell_name):
   return cell_iri
 
 
-def parse_cells_field(cells_field):
+@metrics.timed('hipc_stage_seconds', stage='parse_cells_field')
+def parse_cells_field(cells_field, gate_cache=None):
   """
   Create and return a dictionary with information about the cell extracted from the given
   cells_field: its name, its associated gates, its IRI, and other core information about the cell.
+  Parsed gates are shared through gate_cache, if it is given (see process_gate_cached()).
   """
   cell = {}
   # Extract the cell name and the gates specified in the cells field of the request string
-  cell_name, cell_gates = get_cell_name_and_gates(cells_field)
+  cell_name, cell_gates = get_cell_name_and_gates(cells_field, gate_cache)
   # Get the cell and gate information for the gates specified in the cells field
   cell_iri = get_cell_iri(cell_name)
   cell['core_info'] = get_cell_core_info(cell_gates, cell_iri)
@@ -226,40 +625,184 @@ def parse_cells_field(cells_field):
   return cell
 
 
-def parse_gates_field(gates_field, cell):
+@metrics.timed('hipc_stage_seconds', stage='parse_gates_field')
+def parse_gates_field(gates_field, cell, gate_cache=None):
   """
   Parses the gates field submitted through the web form for a given cell.
   The gates field should be a list of gates separated by commas.
   Also check for and indicate any discrepancies between the gates information and the extracted
-  cell info.
+  cell info. Parsed gates are shared through gate_cache, if it is given (see process_gate_cached()).
   """
+  irimaps = current_maps()
+  absent = irimaps.level_iris['-']
   gating = {'results': [], 'conflicts': [], 'has_errors': False}
+  # Index the gates of the cell by kind, so that each gate is only compared with those of its kind
+  # or of a related kind. The related kinds of a gate are its ancestors among the cell's kinds, and
+  # the cell's kinds that it is an ancestor of, so the cell's kinds are also indexed by ancestor:
+  cell_results_by_kind = defaultdict(list)
+  for i, cell_result in enumerate(cell['results']):
+    cell_results_by_kind[cell_result.kind].append(i)
+  kind_order = {kind: i for i, kind in enumerate(cell_results_by_kind)}
+  kinds_by_ancestor = defaultdict(set)
+  for kind in cell_results_by_kind:
+    for ancestor in irimaps.pr_hierarchy.ancestors(kind):
+      kinds_by_ancestor[ancestor].add(kind)
+
   # Assume gates are separated by commas
   gate_strings = list(csv.reader([gates_field], quotechar='"', delimiter=',', quoting=csv.QUOTE_ALL,
                                  skipinitialspace=True)).pop()
   for gate_string in gate_strings:
-    gate, has_errors = process_gate(gate_string)
+    gate, has_errors = process_gate_cached(gate_string, gate_cache)
     if has_errors and not gating['has_errors']:
       gating['has_errors'] = True
 
     # Check for any discrepancies between what has been given through the request and the gate info
     # that has been extracted (cell_results) based on a lookup of the cell IRIs. Indicate any such
     # in the info for the gate, and append the gate info to a list of gates with conflicts. Either
-    # way, append the gate into to the gate_results list.
-    for cell_result in cell['results']:
-      if gate['kind'] == cell_result['kind'] and gate['level'] != cell_result['level']:
-        gate['conflict'] = True
-        cell_result['conflict'] = True
+    # way, append the gate into to the gate_results list. A gate conflicts with a gate of the same
+    # kind at a different level, and with a gate of a related kind if one of them is absent while a
+    # subtype of it (e.g. one of its isoforms) is present.
+    related = kinds_by_ancestor.get(gate.kind, set()).union(
+      [kind for kind in irimaps.pr_hierarchy.ancestors(gate.kind) if kind in kind_order])
+    for kind in sorted(related, key=kind_order.get):
+      for i in cell_results_by_kind[kind]:
+        cell_result = cell['results'][i]
+        if kind == gate.kind:
+          if gate.level == cell_result.level:
+            continue
+        elif not (gate.level_recognized and irimaps.pr_hierarchy.contradicts(
+                  gate.kind, gate.level != absent, kind, cell_result.level != absent)):
+          continue
+        if isinstance(cell_result, SharedGate):
+          # Mark a copy of the shared gate instead of the gate itself:
+          cell_result = cell['results'][i] = cell_result.copy()
+        gate.conflict = True
+        cell_result.conflict = True
         cell['core_info']['conflicts'] = True
-        conflict = deepcopy(gate)
-        conflict['cell_level'] = cell_result['level']
-        conflict['cell_level_name'] = cell_result['level_name']
-        gating['conflicts'].append(conflict)
+        gating['conflicts'].append(Conflict(gate, cell_result.level, cell_result.level_name))
     gating['results'].append(gate)
 
   return gating
 
 
+# The number of cells listed in the "closest cell types" panel:
+CLOSEST_CELLS = 10
+
+
+@metrics.timed('hipc_stage_seconds', stage='rank_cells')
+def get_closest_cells(gate_results, k=CLOSEST_CELLS):
+  """
+  Return the k cells whose definitions are closest to the given parsed gates (see ranking.py), each
+  with its label.
+  """
+  irimaps = current_maps()
+  gates = [(gate.kind, gate.level) for gate in gate_results
+           if gate.kind_recognized and gate.level_recognized]
+  closest = irimaps.cell_ranking.rank(gates, k)
+  for cell in closest:
+    cell['label'] = irimaps.iri_labels.get(cell['iri'], cell['iri'])
+  return closest
+
+
+def clean_field(field):
+  """
+  Strip the given field submitted by the user and replace any curly single quotes with straight
+  ones.
+  """
+  return field.strip().replace("‘", "'").replace("’", "'")
+
+
+@app.before_request
+def start_timing():
+  g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+  """
+  Count the request and record the time it took, logging it, along with its inputs, if it was slow.
+  """
+  if 'request_start' not in g:
+    return response
+  seconds = time.perf_counter() - g.request_start
+  endpoint = request.endpoint or 'none'
+  metrics.inc('hipc_requests_total', endpoint=endpoint, status=response.status_code)
+  metrics.observe('hipc_request_seconds', seconds, endpoint=endpoint)
+  metrics.save()
+  # Only slow requests are logged, so the details (in particular the body, which may be a large
+  # upload) are only looked at for those:
+  if seconds < metrics.slow_seconds:
+    return response
+  slow = metrics.log_slow_request(seconds, OrderedDict([
+    ('method', request.method),
+    ('path', request.path),
+    ('args', request.args.to_dict()),
+    ('body', request.get_data()[:10000].decode('utf-8', errors='replace'))]))
+  if slow:
+    metrics.inc('hipc_slow_requests_total')
+    print("Slow request ({:.3f}s): {} {} {}".format(
+      seconds, request.method, request.full_path, slow['body'][:200]), file=sys.stderr)
+  return response
+
+
+@app.before_request
+def require_maps():
+  """
+  Until the maps have been loaded, respond to every request other than the health checks, the
+  metrics, and requests for other versions of the maps, with a 503 and the loading status.
+  """
+  if request.path in ['/healthz', '/readyz', '/metrics'] or load_status['state'] == 'ready' \
+     or request.args.get('version'):
+    return None
+  response = json_response(get_load_status(), 503)
+  response.headers['Retry-After'] = str(RETRY_AFTER)
+  return response
+
+
+@app.before_request
+def select_maps():
+  """
+  Handle a request that has a `version` parameter using that version of the maps (see
+  map_versions), loading it first if need be.
+  """
+  name = request.args.get('version')
+  if not name:
+    return None
+  if name not in map_versions:
+    return json_response({'error': "No version of the maps named '{}'".format(name)}, 404)
+  try:
+    with metrics.time('hipc_stage_seconds', stage='select_maps'):
+      g.irimaps = map_versions.get(name)
+  except Exception as e:
+    print("Failed to load the '{}' version of the maps: {}".format(name, e), file=sys.stderr)
+    return json_response({'error': "Failed to load the '{}' version of the maps".format(name)}, 500)
+  return None
+
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+  """
+  Report whether the server is alive, which it is unless loading the maps has failed.
+  """
+  if load_status['state'] == 'failed':
+    return json_response({'status': 'failed', 'error': load_status['error']}, 500)
+  return json_response({'status': 'ok'})
+
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+  """
+  Report whether the maps have been loaded, along with the progress and timings of loading each of
+  the tables.
+  """
+  status = get_load_status()
+  if status['state'] != 'ready':
+    response = json_response(status, 503)
+    response.headers['Retry-After'] = str(RETRY_AFTER)
+    return response
+  return json_response(status)
+
+
 @app.route('/', methods=['GET'])
 def my_app():
   if 'gate' in request.args:
@@ -270,43 +813,578 @@ def my_app():
   # initialised to the following default value. Otherwise we get it from the request
   cells_field = 'CD4-positive, alpha-beta T cell & CD19-'
   if 'cells' in request.args:
-    cells_field = request.args['cells'].strip().replace("‘", "'").replace("’", "'")
-
-  # Parse the cells_field
-  cell = parse_cells_field(cells_field)
+    cells_field = clean_field(request.args['cells'])
 
   # gates_field holds gate names from the protein ontology database; if not specified, it gets
   # initialised to the following default value, otherwise get it from the request.
   gates_field = 'CD4-, CD19+, CD20-, CD27++, CD38+-, CD56[glycosylated]+'
   if 'gates' in request.args:
-    gates_field = request.args['gates'].strip().replace("‘", "'").replace("’", "'")
+    gates_field = clean_field(request.args['gates'])
 
-  # Parse the gates_field
-  gating = parse_gates_field(gates_field, cell)
+  # The page depends only on the two fields and the maps, so serve it from the cache if we can:
+  version = request.args.get('version', '')
+  key = (cells_field, gates_field, version, current_maps().version)
+  cached = response_cache.get(key)
+  if cached is None:
+    # Parse the cells_field and the gates_field
+    cell = parse_cells_field(cells_field)
+    gating = parse_gates_field(gates_field, cell)
+    closest = get_closest_cells(gating['results'])
 
-  # Serve the web page back with the generated info
-  return render_template(
-    '/index.html',
-    cells=cells_field,
-    gates=gates_field,
-    cell=cell['core_info'],
-    cell_results=cell['results'],
-    gate_results=gating['results'],
-    gate_errors=gating['has_errors'],
-    conflicts=gating['conflicts'])
+    # Render the web page with the generated info
+    with metrics.time('hipc_stage_seconds', stage='render'):
+      page = render_template(
+        '/index.html',
+        cells=cells_field,
+        gates=gates_field,
+        cell=cell['core_info'],
+        cell_results=cell['results'],
+        gate_results=gating['results'],
+        gate_errors=gating['has_errors'],
+        conflicts=gating['conflicts'],
+        closest=closest,
+        version=version)
+    cached = response_cache.put(key, page.encode('utf-8'))
+
+  # Serve the page back with a strong ETag, or just a 304 if the client already has this version:
+  body, etag = cached
+  response = app.response_class(body, mimetype='text/html')
+  response.set_etag(etag)
+  response.headers['Cache-Control'] = 'no-cache'
+  return response.make_conditional(request)
+
+
+def json_response(data, status=200):
+  """
+  Return a response with the given data serialized as compact JSON.
+  """
+  return app.response_class(json.dumps(data, separators=(',', ':')), status=status,
+                            mimetype='application/json')
+
+
+def check_items(items):
+  """
+  Return an error message if the given items are not a list of {"cells": ..., "gates": ...} objects
+  with string values, or else None.
+  """
+  if not isinstance(items, list):
+    return 'Expected a JSON array of {"cells": ..., "gates": ...} objects'
+  for i, item in enumerate(items):
+    if not isinstance(item, dict) or not all([isinstance(item.get(key, ''), str)
+                                              for key in ['cells', 'gates']]):
+      return 'Item {} is not a {{"cells": ..., "gates": ...}} object with string values'.format(i)
+
+
+def validate_item(item, gate_cache=None):
+  """
+  Validate the 'cells' and 'gates' fields of the given item like those of the web form, and return
+  a dictionary containing the cell's core info, the results for the cell and for the gates, whether
+  there were errors, and the conflicts between the two.
+  """
+  cell = parse_cells_field(clean_field(item.get('cells', '')), gate_cache)
+  gating = parse_gates_field(clean_field(item.get('gates', '')), cell, gate_cache)
+  return as_plain({
+    'cell': cell['core_info'],
+    'cell_results': cell['results'],
+    'gate_results': gating['results'],
+    'gate_errors': gating['has_errors'],
+    'conflicts': gating['conflicts']})
+
+
+@app.route('/api/validate', methods=['POST'])
+def api_validate():
+  """
+  Validate a batch of cell populations in one request. The request body should be a JSON array of
+  objects, each with a 'cells' and a 'gates' field like those of the web form. The response is a
+  JSON array with the validation of each of them (see validate_item()). Gates that are repeated
+  within the batch are only parsed once.
+  """
+  items = request.get_json(force=True, silent=True)
+  error = check_items(items)
+  if error:
+    return json_response({'error': error}, 400)
+
+  gate_cache = {}
+  return json_response([validate_item(item, gate_cache) for item in items])
+
+
+@app.route('/api/cells', methods=['GET'])
+def api_cells():
+  """
+  Find the cell types whose definitions are consistent with the gates given in the 'gates'
+  parameter (like the gates field of the web form): those whose definitions include none of the
+  gates' kinds at a different level, and that include at least 'minimum' (default 1) of the gates.
+  Returns the parsed gates, and up to 'limit' (default 100) cells, with those that include the most
+  gates first.
+  """
+  irimaps = current_maps()
+  try:
+    minimum = int(request.args.get('minimum', 1))
+    limit = int(request.args.get('limit', 100))
+  except ValueError:
+    return json_response({'error': 'The minimum and the limit must be numbers'}, 400)
+  if limit < 0:
+    return json_response({'error': 'The limit must not be negative'}, 400)
+
+  gates_field = clean_field(request.args.get('gates', ''))
+  gate_strings = list(csv.reader([gates_field], quotechar='"', delimiter=',', quoting=csv.QUOTE_ALL,
+                                 skipinitialspace=True)).pop()
+  gates = [process_gate(gate_string)[0] for gate_string in gate_strings]
+  recognized = [(gate.kind, gate.level) for gate in gates if gate.kind and gate.level]
+  matches = irimaps.gate_cells.match(recognized, minimum)
+  return json_response({
+    'gates': [gate.as_dict() for gate in gates],
+    'total': len(matches),
+    'cells': [{'iri': iri, 'label': irimaps.iri_labels.get(iri), 'matched': matched,
+               'defined': defined} for iri, matched, defined in matches[:limit]]})
+
+
+# The largest number of matches that /api/complete will return:
+MAX_COMPLETIONS = 100
+
+
+@app.route('/api/complete', methods=['GET'])
+def api_complete():
+  """
+  Suggest completions for the start of the name of a cell (kind=cell) or of a gate (kind=gate),
+  given in the 'q' parameter. Returns a JSON list of up to 'limit' (default 10) matches, each with
+  the matching name, the IRI it is recognized as, and that IRI's label.
+  """
+  irimaps = current_maps()
+  indexes = {'cell': irimaps.cell_index, 'gate': irimaps.gate_index}
+  kind = request.args.get('kind', 'cell')
+  if kind not in indexes:
+    return json_response({'error': "The kind must be one of: {}".format(', '.join(indexes))}, 400)
+  try:
+    limit = min(int(request.args.get('limit', 10)), MAX_COMPLETIONS)
+  except ValueError:
+    return json_response({'error': 'The limit must be a number'}, 400)
+
+  prefix = request.args.get('q', '').strip()
+  if not prefix:
+    return json_response([])
+  return json_response([{'name': name, 'iri': iri, 'label': irimaps.iri_labels.get(iri)}
+                        for name, iri in indexes[kind].complete(prefix, limit)])
+
+
+# The index of build/normalized.tsv (see normalized_index.py), which is loaded when it is first
+# queried, and again whenever it has been updated since:
+app.config['NORMALIZED_INDEX'] = path.join(app.config['BUILD_DIR'], 'normalized-index')
+normalized_index = None
+normalized_index_lock = threading.Lock()
+
+
+def get_normalized_index():
+  """
+  Return the loaded index of normalized.tsv, loading it first if it has not been loaded or has been
+  updated since it was, or None if it has not been built.
+  """
+  global normalized_index
+  directory = app.config['NORMALIZED_INDEX']
+  try:
+    stamp = os.stat(path.join(directory, 'manifest.json')).st_mtime_ns
+  except FileNotFoundError:
+    return None
+  with normalized_index_lock:
+    index = normalized_index
+    if index is None or index.directory != directory or index.stamp != stamp:
+      index = NormalizedIndex(directory).load()
+      index.stamp = stamp
+      normalized_index = index
+  return index
+
+
+@app.route('/api/populations', methods=['GET'])
+def api_populations():
+  """
+  Find the rows of normalized.tsv that match every one of the 'term' parameters (see
+  NormalizedIndex.parse_term()), e.g. ?term=CXCR5%2B&term=cell:CL:0000624. Returns the number of
+  matching rows, the number of them in each study, and up to 'limit' (default 100) of the rows,
+  from 'offset' (default 0).
+  """
+  try:
+    limit = int(request.args.get('limit', 100))
+    offset = int(request.args.get('offset', 0))
+  except ValueError:
+    return json_response({'error': 'The limit and the offset must be numbers'}, 400)
+  if limit < 0 or offset < 0:
+    return json_response({'error': 'The limit and the offset must not be negative'}, 400)
+  index = get_normalized_index()
+  if index is None:
+    return json_response({'error': 'normalized.tsv has not been indexed'}, 404)
+
+  terms = request.args.getlist('term')
+  try:
+    with metrics.time('hipc_stage_seconds', stage='query_populations'):
+      matches = index.query(terms)
+  except Exception as e:
+    return json_response({'error': str(e)}, 400)
+  studies = defaultdict(int)
+  for i in matches:
+    studies[index.rows[i][0]] += 1
+  return json_response({
+    'terms': terms,
+    'total': len(matches),
+    'studies': studies,
+    'rows': index.get_rows(matches[offset:offset + limit])})
+
+
+# Jobs for validating tables that are too large to validate in a single request (see jobs.py):
+app.config['JOBS_DIR'] = path.join(tempfile.gettempdir(), 'hipc-validator-jobs')
+MAX_JOB_ROWS = 100000
+job_store = None
+
+# The names of the columns of an uploaded table that can hold the cells and the gates fields:
+CELLS_COLUMNS = ['cells', 'populationnamereported']
+GATES_COLUMNS = ['gates', 'populationdefnitionreported', 'populationdefinitionreported']
+
+# The columns of the TSV version of the results of a job:
+JOB_RESULT_HEADERS = ['Cells', 'Gates', 'Cell IRI', 'Cell Label', 'Cell Recognized', 'Gate IRIs',
+                      'Gate Errors', 'Conflicts']
+
+
+def get_job_store():
+  global job_store
+  if job_store is None or job_store.directory != app.config['JOBS_DIR']:
+    job_store = JobStore(app.config['JOBS_DIR'])
+  return job_store
+
+
+def wait_for_jobs():
+  """
+  Wait for the jobs that this process is running to finish, e.g. before a pre-fork worker exits,
+  and then save its metrics for the master to collect.
+  """
+  if job_store is not None:
+    job_store.wait()
+  metrics.save(force=True)
+
+
+def read_job_items():
+  """
+  Read the cell populations to validate from the request, which may contain a JSON array like that
+  accepted by /api/validate, or a table with a header row, either uploaded as 'file' or as the body
+  of the request. Tables may be tab or comma separated, and must have a column for the cells field
+  and may have one for the gates field (see CELLS_COLUMNS and GATES_COLUMNS). Returns the list of
+  items and an error message, one of which is None.
+  """
+  if request.is_json:
+    items = request.get_json(silent=True)
+    return (None, check_items(items)) if check_items(items) else (items, None)
+
+  if 'file' in request.files:
+    text = request.files['file'].read().decode('utf-8-sig')
+  else:
+    text = request.get_data(as_text=True)
+  lines = text.splitlines()
+  if not lines:
+    return None, 'No table was given'
+  delimiter = '\t' if '\t' in lines[0] else ','
+  rows = csv.DictReader(lines, delimiter=delimiter)
+  columns = {name.strip().casefold(): name for name in rows.fieldnames or []}
+  cells_column = next((columns[name] for name in CELLS_COLUMNS if name in columns), None)
+  gates_column = next((columns[name] for name in GATES_COLUMNS if name in columns), None)
+  if not cells_column:
+    return None, 'The table has no cells column (one of: {})'.format(', '.join(CELLS_COLUMNS))
+  items = [{'cells': row[cells_column] or '',
+            'gates': (row[gates_column] or '') if gates_column else ''} for row in rows]
+  return items, None
+
+
+def get_job_result_row(validation):
+  """
+  Summarize the given validation (see validate_item()) of a job's item as a row of the TSV version
+  of the job's results.
+  """
+  cell = validation['cell']
+  return [
+    validation['cells'],
+    validation['gates'],
+    cell.get('iri', ''),
+    cell.get('label', ''),
+    'Y' if cell['recognized'] else 'N',
+    ', '.join([gate['kind'] for gate in validation['gate_results'] if gate['kind_recognized']]),
+    ', '.join([gate['gate'] for gate in validation['gate_results'] if not gate['kind_recognized']]),
+    ', '.join([conflict['gate'] for conflict in validation['conflicts']])]
+
+
+@app.route('/api/jobs', methods=['POST'])
+def api_submit_job():
+  """
+  Queue a job that validates every cell population in the request (see read_job_items()) in the
+  background, and return its id, along with the URLs of its status and of its results.
+  """
+  items, error = read_job_items()
+  if not error and len(items) > MAX_JOB_ROWS:
+    error = 'A job can have at most {} rows'.format(MAX_JOB_ROWS)
+  if error:
+    return json_response({'error': error}, 400)
+
+  # Use the maps of this request for every item, even if new maps are loaded while it is running:
+  maps = current_maps()
+
+  def validate_items(items):
+    with app.app_context():
+      g.irimaps = maps
+      gate_cache = {}
+      for item in items:
+        validation = validate_item(item, gate_cache)
+        validation['cells'] = item.get('cells', '')
+        validation['gates'] = item.get('gates', '')
+        yield validation
+
+  job_id = get_job_store().submit(items, validate_items)
+  response = json_response({
+    'id': job_id,
+    'status': '/api/jobs/{}'.format(job_id),
+    'results': '/api/jobs/{}/results'.format(job_id)}, 202)
+  response.headers['Location'] = '/api/jobs/{}'.format(job_id)
+  return response
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def api_job_status(job_id):
+  """
+  Report the state and progress of the given job.
+  """
+  status = get_job_store().status(job_id)
+  if not status:
+    return json_response({'error': 'No such job: {}'.format(job_id)}, 404)
+  return json_response(status)
+
+
+@app.route('/api/jobs/<job_id>/results', methods=['GET'])
+def api_job_results(job_id):
+  """
+  Return the results of the given job so far as JSON, a page at a time, starting from 'offset'
+  (default 0) and with up to 'limit' (default 100) results per page. With format=tsv, return a TSV
+  file summarizing every result instead, once the job is done.
+  """
+  store = get_job_store()
+  status = store.status(job_id)
+  if not status:
+    return json_response({'error': 'No such job: {}'.format(job_id)}, 404)
+
+  if request.args.get('format') == 'tsv':
+    if status['state'] != 'done':
+      return json_response({'error': 'The job is {}'.format(status['state'])}, 409)
+
+    def generate():
+      writer = TsvWriter(None, JOB_RESULT_HEADERS)
+      yield writer.format_rows([JOB_RESULT_HEADERS])
+      batch = []
+      for validation in store.results(job_id):
+        batch.append(get_job_result_row(validation))
+        if len(batch) >= 1000:
+          yield writer.format_rows(batch)
+          batch = []
+      yield writer.format_rows(batch)
+
+    response = app.response_class(generate(), mimetype='text/tab-separated-values')
+    response.headers['Content-Disposition'] = 'attachment; filename=job-{}.tsv'.format(job_id)
+    return response
+
+  try:
+    offset = max(0, int(request.args.get('offset', 0)))
+    limit = max(1, min(int(request.args.get('limit', 100)), 1000))
+  except ValueError:
+    return json_response({'error': 'The offset and the limit must be numbers'}, 400)
+  return json_response({
+    'state': status['state'],
+    'total': status['total'],
+    'processed': status['processed'],
+    'offset': offset,
+    'limit': limit,
+    'results': list(store.results(job_id, offset, limit))})
+
+
+@app.route('/api/versions', methods=['GET'])
+def api_versions():
+  """
+  Report the named versions of the maps, whether each is loaded and its estimated size, and the
+  memory budget for them.
+  """
+  return json_response(map_versions.stats())
+
+
+@app.route('/api/cache', methods=['GET'])
+def api_cache():
+  """
+  Report the size and the hit and miss counts of the response cache.
+  """
+  return json_response(response_cache.stats())
+
+
+def get_gauges():
+  """
+  Return the current sizes of the maps, the times taken to load them, and the state of the response
+  cache, as (name, labels, value) triples for Metrics.render().
+  """
+  irimaps = current_maps()
+  status = get_load_status()
+  cache = response_cache.stats()
+  versions = map_versions.stats()
+  gauges = [('hipc_maps_ready', {}, int(status['state'] == 'ready'))]
+  for name in ['synonym_iris', 'iri_labels', 'iri_parents', 'iri_gates', 'pr_hierarchy',
+               'iri_cells', 'gate_cells', 'cell_index', 'gate_index']:
+    gauges.append(('hipc_map_entries', {'map': name}, len(getattr(irimaps, name))))
+  if status.get('seconds') is not None:
+    gauges.append(('hipc_map_load_seconds', {'table': 'all'}, status['seconds']))
+  for table, table_status in status['tables'].items():
+    if table_status.get('seconds') is not None:
+      gauges.append(('hipc_map_load_seconds', {'table': table}, table_status['seconds']))
+  for name in ['hits', 'misses', 'evictions']:
+    gauges.append(('hipc_response_cache_{}_total'.format(name), {}, cache[name]))
+  for name in ['entries', 'bytes', 'hit_rate']:
+    gauges.append(('hipc_response_cache_{}'.format(name), {}, cache[name]))
+  gauges.append(('hipc_map_versions_loaded', {},
+                 len([version for version in versions['versions'] if version['loaded']])))
+  gauges.append(('hipc_map_versions_bytes', {}, versions['bytes']))
+  for name in ['loads', 'evictions']:
+    gauges.append(('hipc_map_versions_{}_total'.format(name), {}, versions[name]))
+  return gauges
+
+
+metrics.describe('hipc_maps_ready', 'gauge', 'Whether the maps have been loaded.')
+metrics.describe('hipc_map_entries', 'gauge', 'The number of entries in each of the maps.')
+metrics.describe('hipc_map_load_seconds', 'gauge',
+                 'Time taken to load each table of the current maps, and all of them.')
+for name in ['hits', 'misses', 'evictions']:
+  metrics.describe('hipc_response_cache_{}_total'.format(name), 'counter',
+                   'Response cache {}.'.format(name))
+metrics.describe('hipc_response_cache_entries', 'gauge', 'Responses in the response cache.')
+metrics.describe('hipc_response_cache_bytes', 'gauge', 'Size of the responses in the cache.')
+metrics.describe('hipc_response_cache_hit_rate', 'gauge', 'Fraction of cache lookups that hit.')
+metrics.describe('hipc_map_versions_loaded', 'gauge', 'Named versions of the maps that are loaded.')
+metrics.describe('hipc_map_versions_bytes', 'gauge',
+                 'Estimated size of the named versions of the maps that are loaded.')
+metrics.describe('hipc_map_versions_loads_total', 'counter', 'Named versions of the maps loaded.')
+metrics.describe('hipc_map_versions_evictions_total', 'counter',
+                 'Named versions of the maps unloaded to stay within the memory budget.')
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+  """
+  Report the metrics in the Prometheus text format. The counters and histograms are totals across
+  the pre-fork workers, including those that have exited, while the gauges are those of the worker
+  that serves the request.
+  """
+  text = metrics.render(get_gauges(), [('pid', os.getpid())])
+  return app.response_class(text, mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/metrics/slow', methods=['GET'])
+def slow_requests():
+  """
+  Report the most recent requests that took longer than SLOW_REQUEST_SECONDS, with their inputs.
+  """
+  return json_response(metrics.get_slow_requests())
+
+
+@app.route('/admin/reload', methods=['POST'])
+def admin_reload():
+  """
+  Load new maps from the build files in the background, whether or not they have changed. Only
+  requests from the local host are accepted. Under the pre-forking server, the master process is
+  asked to load the new maps and then replace its workers.
+  """
+  if request.remote_addr not in ['127.0.0.1', '::1']:
+    return json_response({'error': 'Reloading is only allowed from the local host'}, 403)
+  master = app.config.get('PREFORK_MASTER')
+  if master and master != os.getpid():
+    os.kill(master, signal.SIGHUP)
+  else:
+    threading.Thread(target=reload_maps, kwargs={'force': True}, daemon=True).start()
+  return json_response({'status': 'reloading'}, 202)
 
 
 if __name__ == '__main__':
   """
   At startup, the main function reads information from files in the build directory and uses it to
-  populate our global dictionaries. It then starts the Flask application.
+  populate our global dictionaries, and starts the Flask application, either in the development
+  server (loading the maps in the background) or, if a number of workers is given, in a pre-forking
+  production server (see prefork.py).
   """
-  load_maps()
-  app.debug = True
-  app.run()
+  parser = argparse.ArgumentParser(description='Serve the validation page')
+  parser.add_argument('--host', type=str, default='127.0.0.1',
+                      help='the address to listen on (default: 127.0.0.1)')
+  parser.add_argument('--port', type=int, default=5000,
+                      help='the port to listen on (default: 5000)')
+  parser.add_argument('--workers', type=int, default=0,
+                      help='the number of worker processes to fork, sharing the maps loaded by the '
+                      'master process, whose metrics are added up at /metrics (default: 0, i.e. '
+                      'use the development server)')
+  parser.add_argument('--max-requests', type=int, default=1000,
+                      help='replace each worker after it has served this many requests, or 0 for '
+                      'never; a worker running jobs finishes them first (default: 1000)')
+  parser.add_argument('--timeout', type=int, default=30,
+                      help='drop connections that are idle for this many seconds, and replace '
+                      'workers that take longer than this to serve a request (default: 30)')
+  parser.add_argument('--graceful-timeout', type=int, default=30,
+                      help='on shutdown, give workers this many seconds to finish the requests '
+                      'and jobs they are running (default: 30)')
+  parser.add_argument('--watch', type=int, default=0,
+                      help='check the build files for changes every this many seconds, and load '
+                      'new maps when they have changed (default: 0, i.e. never)')
+  parser.add_argument('--version', action='append', default=[], metavar='NAME=PATH',
+                      help='also serve the maps in PATH (a build directory or a snapshot) to '
+                      'requests with version=NAME, loading them when they are first asked for (or, '
+                      'under --workers, in the master before forking); can be given more than once')
+  parser.add_argument('--versions-memory', type=int, default=4096, metavar='MB',
+                      help='unload the least recently used versions when the loaded versions take '
+                      'up more than this many megabytes (default: 4096). Under --workers, the '
+                      'versions that fit are loaded by the master and shared by the workers, and '
+                      'are never unloaded; any others are loaded by each worker that is asked for '
+                      'them, and may take up to this much memory in every worker')
+  parser.add_argument('--save-snapshot', type=str, metavar='PATH',
+                      help='load the maps from the build directory, save them to a snapshot file '
+                      'that can be given to --version, and exit')
+  args = parser.parse_args()
 
+  if args.save_snapshot:
+    maps = load_version(app.config['BUILD_DIR'])
+    save_snapshot(maps, args.save_snapshot)
+    print("Saved the maps to {}".format(args.save_snapshot))
+    sys.exit(0)
 
-def test_server():
+  map_versions.max_bytes = args.versions_memory * 1024 * 1024
+  for version in args.version:
+    name, sep, source = version.partition('=')
+    if not name or not sep or not path.exists(source):
+      print("Invalid version '{}': expected NAME=PATH, where PATH is a build directory or a "
+            "snapshot".format(version), file=sys.stderr)
+      sys.exit(1)
+    map_versions.register(name, source)
+
+  if args.workers > 0:
+    # The master binds the socket before loading the maps, so connections made in the meantime wait
+    # to be accepted by the workers instead of being refused:
+    # Each worker saves its metrics to a directory of this master's, for /metrics to add up:
+    metrics.directory = path.join(app.config['METRICS_DIR'], str(os.getpid()))
+    shutil.rmtree(metrics.directory, ignore_errors=True)
+    server = PreforkServer(app, args.host, args.port, args.workers, args.max_requests,
+                           args.timeout, args.graceful_timeout, drain=wait_for_jobs,
+                           exited=metrics.retire)
+    app.config['PREFORK_MASTER'] = os.getpid()
+    server.run(preload=preload_maps, reload=reload_maps, watch_interval=args.watch)
+  else:
+    app.debug = True
+    # Only load the maps in the process that serves requests, not in the parent process that
+    # watches for code changes and restarts it:
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+      start_loading_maps()
+      if args.watch:
+        start_watching_maps(args.watch)
+    app.run(args.host, args.port)
+
+
+def set_test_maps():
+  """
+  Populate the shared maps with a small subset of the real data, for use in tests.
+  """
+  response_cache.clear()
+  set_load_status(state='ready')
   irimaps.synonym_iris = {
     'b-cell differentiation antigen ly-44': 'http://purl.obolibrary.org/obo/PR_000001289',
     'b-cell surface antigen cd20': 'http://purl.obolibrary.org/obo/PR_000001289',
@@ -327,6 +1405,7 @@ def test_server():
     'cd3e': 'http://purl.obolibrary.org/obo/PR_000001020',
     'cd4': 'http://purl.obolibrary.org/obo/PR_000001004',
     'cd4 molecule': 'http://purl.obolibrary.org/obo/PR_000001004',
+    'cd45': 'http://purl.obolibrary.org/obo/PR_000001006',
     'cd45ra': 'http://purl.obolibrary.org/obo/PR_000001015',
     'cd56': 'http://purl.obolibrary.org/obo/PR_000001024',
     'cd8alphabeta': 'http://purl.obolibrary.org/obo/PR_000025402',
@@ -385,6 +1464,7 @@ def test_server():
     'http://purl.obolibrary.org/obo/RO_0002104': 'has plasma membrane part',
     'http://purl.obolibrary.org/obo/PR_000001203': 'C-C chemokine receptor type 7',
     'http://purl.obolibrary.org/obo/PR_000001015': 'receptor-type tyrosine-protein phosphatase C isoform CD45RA',
+    'http://purl.obolibrary.org/obo/PR_000001006': 'receptor-type tyrosine-protein phosphatase C',
     'http://purl.obolibrary.org/obo/cl#lacks_plasma_membrane_part': 'lacks plasma membrane part',
     'http://purl.obolibrary.org/obo/PR_000025402': 'T cell receptor co-receptor CD8',
     'http://purl.obolibrary.org/obo/CL_0002461': 'CD103-positive dendritic cell',
@@ -400,6 +1480,10 @@ def test_server():
 
   irimaps.iri_parents = {}
 
+  irimaps.pr_hierarchy = HierarchyIndex({
+    'http://purl.obolibrary.org/obo/PR_000001015': ['http://purl.obolibrary.org/obo/PR_000001006']
+  })
+
   irimaps.iri_gates = {
     'http://purl.obolibrary.org/obo/CL_0001044': [
       {'kind': 'http://purl.obolibrary.org/obo/PR_000001004',
@@ -452,12 +1536,20 @@ def test_server():
     ('neg', 'negative')]
   )
 
+  irimaps.iri_cells = get_cells_info(irimaps)
+  irimaps.gate_cells = GateIndex(irimaps.iri_gates)
+  irimaps.cell_ranking = CellRanking(irimaps.iri_gates)
+  irimaps.cell_index, irimaps.gate_index = get_prefix_indexes(irimaps)
+
+
+def test_server():
+  set_test_maps()
   cells_field = 'effector CD4-positive, alpha-beta T cell & CD19-'
   gates_field = 'CD3e+, CD20++, CD103-, itgax[This is a comment]++, ncam1+~'
   cell = parse_cells_field(cells_field)
   gating = parse_gates_field(gates_field, cell)
 
-  assert cell == {
+  assert as_plain(cell) == {
     'core_info': {
       'cell_gates': [
         {'gate': 'CD19-',
@@ -514,7 +1606,7 @@ def test_server():
        'level_name': 'negative',
        'level_recognized': True}]}
 
-  assert gating == {
+  assert as_plain(gating) == {
     'conflicts': [],
     'has_errors': False,
     'results': [
@@ -563,3 +1655,431 @@ def test_server():
        'level_label': 'has plasma membrane part',
        'level_name': 'medium',
        'level_recognized': True}]}
+
+
+def test_related_conflicts():
+  set_test_maps()
+  cells_field = 'effector CD4-positive, alpha-beta T cell'
+
+  # The cell has CD45RA, an isoform of CD45, so it cannot lack CD45:
+  cell = parse_cells_field(cells_field)
+  gating = parse_gates_field('CD45-, CD4+', cell)
+  assert [(conflict.gate, conflict.cell_level_name) for conflict in gating['conflicts']] == [
+    ('CD45-', 'positive')]
+  assert [result.kind_label for result in cell['results'] if hasattr(result, 'conflict')] == [
+    'receptor-type tyrosine-protein phosphatase C isoform CD45RA']
+  # Only a copy of the cell's shared gate is marked:
+  assert not hasattr(parse_cells_field(cells_field)['results'][1], 'conflict')
+
+  # But it may have CD45 at any level:
+  for gates_field in ['CD45+', 'CD45++']:
+    cell = parse_cells_field(cells_field)
+    assert parse_gates_field(gates_field, cell)['conflicts'] == []
+
+
+def test_closest_cells():
+  set_test_maps()
+  cell = parse_cells_field('effector CD4-positive, alpha-beta T cell')
+  gating = parse_gates_field('CD4++, CCR7-, CD19-, foo+', cell)
+  closest = get_closest_cells(gating['results'], k=1)
+  assert closest == [{
+    'iri': 'http://purl.obolibrary.org/obo/CL_0001044',
+    'label': 'effector CD4-positive, alpha-beta T cell',
+    'score': 1.0,
+    'matched': 1,
+    'partial': 1,
+    'conflicts': 0,
+    'missing': 2}]
+
+  page = app.test_client().get('/', query_string={'gates': 'CD4+'}).get_data(as_text=True)
+  assert 'Closest Cell Types' in page
+  assert '?cells=CD103-positive%20dendritic%20cell&amp;gates=CD4%2B' in page
+
+
+def test_shared_cell_info():
+  set_test_maps()
+  cell_iri = 'http://purl.obolibrary.org/obo/CL_0002461'
+  shared = irimaps.iri_cells[cell_iri]['results']
+  assert [gate.as_dict() for gate in shared] == [
+    {'kind': gate['kind'],
+     'kind_recognized': True,
+     'level': gate['level'],
+     'level_recognized': True,
+     'kind_label': irimaps.iri_labels[gate['kind']],
+     'level_label': irimaps.iri_labels[gate['level']],
+     'level_name': irimaps.level_names[irimaps.iri_levels[gate['level']]]}
+    for gate in irimaps.iri_gates[cell_iri]]
+
+  # Conflicts are marked on copies of the shared gates:
+  cell = parse_cells_field(cell_iri)
+  gating = parse_gates_field('CD103-', cell)
+  assert gating['conflicts'] and cell['results'][0].conflict
+  assert cell['results'][0] is not shared[0] and cell['results'][1] is shared[1]
+  assert not any([hasattr(gate, 'conflict') for gate in shared])
+  assert not any([hasattr(gate, 'conflict') for gate in parse_cells_field(cell_iri)['results']])
+
+  error = None
+  try:
+    shared[0].conflict = True
+  except AttributeError as e:
+    error = e
+  assert error
+
+
+def test_api_validate():
+  set_test_maps()
+  client = app.test_client()
+  items = [
+    {'cells': 'effector CD4-positive, alpha-beta T cell & CD19-', 'gates': 'CD4-, CD103-'},
+    {'cells': 'CD103-positive dendritic cell', 'gates': 'CD103-, CD3e+'},
+    {'cells': 'CD103-positive dendritic cell'}]
+  response = client.post('/api/validate', json=items)
+  assert response.status_code == 200
+  validations = response.get_json()
+  assert len(validations) == 3
+
+  # Each validation should be the same as that of the web form:
+  for item, validation in zip(items, validations):
+    cell = parse_cells_field(item['cells'])
+    gating = parse_gates_field(item.get('gates', ''), cell)
+    assert validation == as_plain({
+      'cell': cell['core_info'],
+      'cell_results': cell['results'],
+      'gate_results': gating['results'],
+      'gate_errors': gating['has_errors'],
+      'conflicts': gating['conflicts']})
+
+  # The CD103- gate is shared between the first two items, but conflicts only with the second cell:
+  assert [c['gate'] for c in validations[0]['conflicts']] == ['CD4-']
+  assert [c['gate'] for c in validations[1]['conflicts']] == ['CD103-', 'CD3e+']
+  assert 'conflict' not in validations[0]['gate_results'][1]
+
+  assert client.post('/api/validate', json={'cells': 'B cell'}).status_code == 400
+  assert client.post('/api/validate', json=[{'cells': 1}]).status_code == 400
+
+
+def test_api_cells():
+  set_test_maps()
+  client = app.test_client()
+  response = client.get('/api/cells', query_string={'gates': 'CD4+, CCR7-, foo+'})
+  result = response.get_json()
+  assert [gate['gate'] for gate in result['gates']] == ['CD4+', 'CCR7-', 'foo+']
+  assert result['cells'] == [{
+    'iri': 'http://purl.obolibrary.org/obo/CL_0001044',
+    'label': 'effector CD4-positive, alpha-beta T cell',
+    'matched': 2,
+    'defined': 4}]
+
+  # The dendritic cell lacks CD3e:
+  result = client.get('/api/cells?gates=CD3e%2B&minimum=0').get_json()
+  assert [cell['iri'] for cell in result['cells']] == ['http://purl.obolibrary.org/obo/CL_0001044']
+  assert client.get('/api/cells?gates=CD4%2B&limit=x').status_code == 400
+  assert client.get('/api/cells?gates=CD4%2B&limit=-1').status_code == 400
+
+
+def test_api_complete():
+  set_test_maps()
+  client = app.test_client()
+
+  def complete(kind, q, limit=10):
+    response = client.get('/api/complete', query_string={'kind': kind, 'q': q, 'limit': limit})
+    return [(match['name'], match['label']) for match in response.get_json()]
+
+  assert complete('cell', 'Effector CD4') == [
+    ('effector CD4-positive, alpha-beta T cell', 'effector CD4-positive, alpha-beta T cell')]
+  # Labels come before the casefolded synonyms that they are the same as:
+  assert complete('cell', 'cd1') == [
+    ('CD103-positive dendritic cell', 'CD103-positive dendritic cell')]
+  # Each IRI is only suggested once, under its first matching name:
+  assert complete('gate', 'CD1') == [
+    ('cd103', 'integrin alpha-E'), ('cd11 antigen-like family member c', 'integrin alpha-X'),
+    ('cd19', 'CD19 molecule'), ('cd197', 'C-C chemokine receptor type 7')]
+  assert complete('gate', 'cd1', 2) == complete('gate', 'CD1')[:2]
+  assert complete('gate', 'integrin alpha-e') == [('integrin alpha-E', 'integrin alpha-E')]
+  assert complete('gate', 'cd103-positive') == []
+  assert complete('gate', '') == []
+
+  assert client.get('/api/complete?kind=study&q=SDY').status_code == 400
+  assert client.get('/api/complete?q=cd&limit=all').status_code == 400
+
+
+def test_jobs(tmpdir):
+  set_test_maps()
+  app.config['JOBS_DIR'], jobs_dir = str(tmpdir), app.config['JOBS_DIR']
+  client = app.test_client()
+
+  def wait(job_id):
+    for i in range(500):
+      status = client.get('/api/jobs/{}'.format(job_id)).get_json()
+      if status['state'] in ['done', 'failed']:
+        return status
+      time.sleep(0.01)
+
+  try:
+    items = [{'cells': 'CD103-positive dendritic cell', 'gates': 'CD103-, CD3e-'}] * 3 + \
+      [{'cells': 'effector CD4-positive, alpha-beta T cell', 'gates': 'CD4+, foo+'}]
+    response = client.post('/api/jobs', json=items)
+    assert response.status_code == 202
+    job_id = response.get_json()['id']
+    status = wait(job_id)
+    assert status['state'] == 'done' and status['processed'] == 4
+
+    page = client.get('/api/jobs/{}/results?offset=2&limit=10'.format(job_id)).get_json()
+    assert page['total'] == 4 and len(page['results']) == 2
+    validation = validate_item(items[3])
+    validation.update(items[3])
+    assert page['results'][1] == validation
+
+    table = ('Study\tpopulationNameReported\tpopulationDefnitionReported\n'
+             'SDY1\teffector CD4-positive, alpha-beta T cell\tCD4+, foo+\n'
+             'SDY1\tCD103-positive dendritic cell\tCD103-\n')
+    response = client.post('/api/jobs', data={'file': (io.BytesIO(table.encode('utf-8')), 't.tsv')})
+    job_id = response.get_json()['id']
+    assert wait(job_id)['state'] == 'done'
+    response = client.get('/api/jobs/{}/results?format=tsv'.format(job_id))
+    rows = list(csv.reader(response.data.decode('utf-8').splitlines(), delimiter='\t'))
+    assert rows == [
+      JOB_RESULT_HEADERS,
+      ['effector CD4-positive, alpha-beta T cell', 'CD4+, foo+',
+       'http://purl.obolibrary.org/obo/CL_0001044', 'effector CD4-positive, alpha-beta T cell', 'Y',
+       'http://purl.obolibrary.org/obo/PR_000001004', 'foo+', ''],
+      ['CD103-positive dendritic cell', 'CD103-', 'http://purl.obolibrary.org/obo/CL_0002461',
+       'CD103-positive dendritic cell', 'Y', 'http://purl.obolibrary.org/obo/PR_000001010', '',
+       'CD103-']]
+
+    assert client.post('/api/jobs', data='name\tgates\nB cell\tCD19+').status_code == 400
+    assert client.get('/api/jobs/nosuchjob').status_code == 404
+  finally:
+    app.config['JOBS_DIR'] = jobs_dir
+
+
+def test_metrics_endpoint():
+  set_test_maps()
+  client = app.test_client()
+  client.get('/?cells=CD103-positive dendritic cell&gates=CD103-, CD3e+')
+  metrics.slow_seconds, slow_seconds = 0, metrics.slow_seconds
+  try:
+    client.post('/api/validate', json=[{'cells': 'B cell', 'gates': 'CD19+'}])
+  finally:
+    metrics.slow_seconds = slow_seconds
+
+  response = client.get('/metrics')
+  assert response.status_code == 200
+  lines = response.data.decode('utf-8').splitlines()
+  assert '# TYPE hipc_request_seconds histogram' in lines
+  # The counters and histograms are totals across processes, while the gauges are per process:
+  assert any([line.startswith('hipc_requests_total{endpoint="my_app",status="200"}')
+              for line in lines])
+  for stage in ['process_gate', 'get_cell_name_and_gates', 'get_cell_iri', 'parse_cells_field',
+                'parse_gates_field', 'render']:
+    assert any([line.startswith('hipc_stage_seconds_count{{stage="{}"}}'.format(stage))
+                for line in lines])
+  assert 'hipc_map_entries{{pid="{}",map="iri_gates"}} 2'.format(os.getpid()) in lines
+
+  slow = client.get('/metrics/slow').get_json()
+  assert slow[-1]['path'] == '/api/validate' and 'CD19+' in slow[-1]['body']
+
+
+def test_response_cache():
+  set_test_maps()
+  client = app.test_client()
+  url = '/?cells=CD103-positive dendritic cell&gates=CD103-, CD3e+'
+  misses = response_cache.stats()['misses']
+
+  first = client.get(url)
+  assert first.status_code == 200 and first.headers['ETag']
+  assert b'integrin alpha-E' in first.data
+  # Differences that disappear when the fields are normalized should still hit the cache:
+  second = client.get(url.replace('gates=', 'gates=  '))
+  assert second.data == first.data and second.headers['ETag'] == first.headers['ETag']
+  assert response_cache.stats()['misses'] == misses + 1
+
+  conditional = client.get(url, headers={'If-None-Match': first.headers['ETag']})
+  assert conditional.status_code == 304 and conditional.data == b''
+
+  # A new version of the maps should not be served from the cache:
+  irimaps.version = 'new'
+  client.get(url)
+  irimaps.version = None
+  assert response_cache.stats()['misses'] == misses + 2
+  assert client.get('/api/cache').get_json()['hits'] >= 2
+
+
+def write_test_build(build_dir):
+  """
+  Write a tiny version of each of the build files that the maps are loaded from to the given
+  directory, for use in tests.
+  """
+  build_dir.join('value-scale.tsv').write(
+    'Name\tSymbol\tSynonyms\npositive\t+\tpos\nnegative\t-\tneg\nhigh\t++\thi, bright\n')
+  build_dir.join('special-gates.tsv').write(
+    'Label\tOntology ID\tSynonyms\nsinglets\thttp://example.com/singlets\tsing\n')
+  build_dir.join('pr-labels.tsv').write(
+    'http://purl.obolibrary.org/obo/PR_000001004\tCD4 molecule\n')
+  build_dir.join('pr-exact-synonyms.tsv').write(
+    'http://purl.obolibrary.org/obo/PR_000001004\tCD4\n')
+  build_dir.join('pr-parents.tsv').write(
+    'http://purl.obolibrary.org/obo/PR_000001004\thttp://purl.obolibrary.org/obo/PR_000000001\n')
+  build_dir.join('cl-plus.owl').write('''<?xml version="1.0"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+         xmlns:rdfs="http://www.w3.org/2000/01/rdf-schema#"
+         xmlns:owl="http://www.w3.org/2002/07/owl#">
+  <owl:Class rdf:about="http://purl.obolibrary.org/obo/CL_0000624">
+    <rdfs:label>CD4-positive, alpha-beta T cell</rdfs:label>
+    <rdfs:subClassOf>
+      <owl:Restriction>
+        <owl:onProperty rdf:resource="http://purl.obolibrary.org/obo/RO_0002104"/>
+        <owl:someValuesFrom rdf:resource="http://purl.obolibrary.org/obo/PR_000001004"/>
+      </owl:Restriction>
+    </rdfs:subClassOf>
+  </owl:Class>
+</rdf:RDF>
+''')
+
+
+def test_reload_maps(tmpdir):
+  write_test_build(tmpdir)
+  load_maps(str(tmpdir))
+  client = app.test_client()
+  url = '/?cells=CD4-positive, alpha-beta T cell&gates=CD4-'
+  assert b'CD4 molecule' in client.get(url).data
+  old_maps = current_maps()
+
+  # Nothing has changed, and recent changes are left until they have settled:
+  assert not reload_maps(build_dir=str(tmpdir))
+  tmpdir.join('pr-labels.tsv').write('http://purl.obolibrary.org/obo/PR_000001004\tT4\n')
+  assert not reload_maps(build_dir=str(tmpdir))
+  settled = time.time() - SETTLE_SECONDS - 1
+  for name in MAP_FILES:
+    os.utime(str(tmpdir.join(name)), (settled, settled))
+
+  # A request that is being handled while the maps are swapped finishes on the old maps:
+  with app.test_request_context(url):
+    assert current_maps() is old_maps
+    assert reload_maps(build_dir=str(tmpdir))
+    assert current_maps() is old_maps
+  assert current_maps() is not old_maps
+  assert current_maps().iri_labels['http://purl.obolibrary.org/obo/PR_000001004'] == 'T4'
+  assert b'T4' in client.get(url).data
+
+  # Broken files are not loaded, and the old maps are kept:
+  tmpdir.join('cl-plus.owl').write('<rdf:RDF>')
+  os.utime(str(tmpdir.join('cl-plus.owl')), (settled - 1, settled - 1))
+  new_maps = current_maps()
+  assert not reload_maps(build_dir=str(tmpdir))
+  assert current_maps() is new_maps
+  assert client.get('/readyz').get_json()['error']
+  assert client.get('/healthz').status_code == 200
+
+  app.config['BUILD_DIR'], build_dir = str(tmpdir), app.config['BUILD_DIR']
+  write_test_build(tmpdir)
+  try:
+    assert client.post('/admin/reload').status_code == 202
+    deadline = time.time() + 10
+    while current_maps() is new_maps and time.time() < deadline:
+      time.sleep(0.05)
+    labels = current_maps().iri_labels
+    assert labels['http://purl.obolibrary.org/obo/PR_000001004'] == 'CD4 molecule'
+  finally:
+    app.config['BUILD_DIR'] = build_dir
+
+
+def test_load_maps(tmpdir):
+  client = app.test_client()
+  set_load_status(state='loading')
+  response = client.get('/?cells=CD4-positive, alpha-beta T cell')
+  assert response.status_code == 503 and response.headers['Retry-After'] == str(RETRY_AFTER)
+  assert client.get('/healthz').status_code == 200
+  assert client.get('/readyz').status_code == 503
+
+  write_test_build(tmpdir)
+  start_loading_maps(str(tmpdir)).join()
+  readiness = client.get('/readyz')
+  assert readiness.status_code == 200
+  status = readiness.get_json()
+  assert list(status['tables']) == MAP_FILES
+  assert all([table['state'] == 'loaded' for table in status['tables'].values()])
+  assert irimaps.synonym_iris['cd4'] == 'http://purl.obolibrary.org/obo/PR_000001004'
+  assert client.get('/?cells=CD4-positive, alpha-beta T cell&gates=CD4-').status_code == 200
+
+  # Failures to load the first maps are reported by the table that failed:
+  tmpdir.join('pr-labels.tsv').remove()
+  set_load_status(state='pending')
+  error = None
+  try:
+    load_maps(str(tmpdir))
+  except Exception as e:
+    error = e
+  assert error and client.get('/readyz').status_code == 503
+  status = client.get('/healthz').get_json()
+  assert status['status'] == 'failed' and 'pr-labels.tsv' in status['error']
+
+
+def test_map_versions(tmpdir):
+  global map_versions
+  set_test_maps()
+  old_dir = tmpdir.mkdir('old')
+  write_test_build(old_dir)
+  old_dir.join('pr-labels.tsv').write('http://purl.obolibrary.org/obo/PR_000001004\tT4\n')
+  map_versions, default_versions = MapVersions(load_version), map_versions
+  map_versions.register('old', str(old_dir))
+  client = app.test_client()
+  url = '/?cells=CD4-positive, alpha-beta T cell&gates=CD4-'
+
+  try:
+    # The old version is only loaded when it is asked for, and the default maps are left alone:
+    assert client.get('/api/versions').get_json()['versions'][0]['loaded'] is False
+    page = client.get(url + '&version=old').get_data(as_text=True)
+    assert 'T4' in page and 'name="version" value="old"' in page
+    assert b'T4' not in client.get(url).data
+    stats = client.get('/api/versions').get_json()
+    assert stats['loads'] == 1 and stats['versions'][0]['loaded'] and stats['bytes'] > 0
+    assert client.get(url + '&version=new').status_code == 404
+
+    result = client.post('/api/validate?version=old', json=[{'cells': 'B cell', 'gates': 'CD4+'}])
+    assert result.get_json()[0]['gate_results'][0]['kind_label'] == 'T4'
+
+    # A snapshot of the maps, including their shared gates, loads as a version of its own:
+    snapshot = str(tmpdir.join('old.pickle'))
+    save_snapshot(map_versions.get('old'), snapshot)
+    map_versions.register('snapshot', snapshot)
+    maps = map_versions.get('snapshot')
+    assert maps is not map_versions.get('old') and maps.version == map_versions.get('old').version
+    cell = maps.iri_cells['http://purl.obolibrary.org/obo/CL_0000624']
+    assert isinstance(cell['results'][0], SharedGate) and cell['results'][0].kind_label == 'T4'
+    assert b'T4' in client.get(url + '&version=snapshot').data
+
+    # Versions that fail to load are reported, and not kept:
+    tmpdir.join('broken.pickle').write('not a snapshot')
+    map_versions.register('broken', str(tmpdir.join('broken.pickle')))
+    assert client.get(url + '&version=broken').status_code == 500
+    assert not map_versions.stats()['versions'][2]['loaded']
+
+    # The pre-fork master preloads and pins the versions that load, leaving out the broken one:
+    assert map_versions.preload() == ['old', 'snapshot']
+  finally:
+    map_versions = default_versions
+
+
+def test_api_populations(tmpdir):
+  normalized = tmpdir.join('normalized.tsv')
+  normalized.write('\n'.join([
+    'STUDY_ACCESSION\tEXPERIMENT_ACCESSION\tPOPULATION_NAME_REPORTED\t'
+    'POPULATION_DEFNITION_REPORTED\tCL ID\tGating tokenized\tGating mapped to ontologies\tCL term',
+    'SDY1\tEXP1\tTfh\tCD4+, CXCR5+\tCL:0000624\tCD4+, CXCR5+\tPR:000001004+, PR:1+\tT cell',
+    'SDY2\tEXP2\tB cells\tCD19+\t\tCD19+\tPR:2+\t']) + '\n')
+  app.config['NORMALIZED_INDEX'], index_dir = str(tmpdir), app.config['NORMALIZED_INDEX']
+  client = app.test_client()
+  try:
+    assert client.get('/api/populations?term=CD4%2B').status_code == 404
+    NormalizedIndex(app.config['NORMALIZED_INDEX']).update(str(normalized))
+    result = client.get('/api/populations?term=CXCR5&term=cell:CL:0000624').get_json()
+    assert result['total'] == 1 and result['studies'] == {'SDY1': 1}
+    assert result['rows'][0]['POPULATION_NAME_REPORTED'] == 'Tfh'
+    result = client.get('/api/populations?limit=1&offset=1').get_json()
+    assert result['total'] == 2 and result['rows'][0]['STUDY_ACCESSION'] == 'SDY2'
+    assert client.get('/api/populations?term=CD8%2B').status_code == 400
+    assert client.get('/api/populations?offset=-1').status_code == 400
+    assert client.get('/api/populations?limit=-1').status_code == 400
+  finally:
+    app.config['NORMALIZED_INDEX'] = index_dir
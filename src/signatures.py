@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+#
+# Finds the populations in normalized.tsv (see normalize.py) that are equivalent across studies,
+# although their reported definitions may use different token orders, synonyms or suffix spellings.
+# After normalization these differ only in the order of their ontologized gates, so every row is
+# given a canonical signature: its CL ID together with the sorted set of its (ontology id, level)
+# gates, hashed into a stable key. The rows are grouped by signature in a single pass over the file,
+# and every signature is written out along with the number of rows and the studies that share it.
+
+import argparse
+import csv
+import hashlib
+import re
+from collections import OrderedDict
+
+from common import get_level_iris, parse_ontologized_gates
+
+PR = 'http://purl.obolibrary.org/obo/PR_'
+
+# The greatest number of distinct population names listed for a signature:
+MAX_NAMES = 10
+
+
+def get_signature(row, symbols, gate_cache=None):
+  """
+  Return the signature of the given row of normalized.tsv, as a pair of a stable key (a hash) and
+  the canonical form that it is the hash of: the row's CL ID and its sorted, distinct ontologized
+  gates. Gates that were not mapped to an ontology id are included, case-folded, since they are part
+  of the definition too. Rows with neither a CL ID nor any gates have nothing to be equivalent by,
+  and get no signature: (None, None).
+  """
+  gates = set()
+  for kind, suffix in parse_ontologized_gates(row['Gating mapped to ontologies'], symbols,
+                                              gate_cache):
+    kind = kind.casefold() if kind.startswith('!') else re.sub('^' + PR, 'PR:', kind)
+    gates.add((kind, suffix))
+  if not row['CL ID'] and not gates:
+    return None, None
+  gates = ', '.join([kind + suffix for kind, suffix in sorted(gates)])
+  canonical = '{} & {}'.format(row['CL ID'], gates)
+  return hashlib.sha1(canonical.encode('utf-8')).hexdigest()[:16], canonical
+
+
+def group_signatures(rows, symbols, row_writer=None):
+  """
+  Group the given rows of normalized.tsv by their signatures, and return an ordered map from each
+  signature's key to its canonical form, the number of rows, and the sets of studies and reported
+  population names that have it (up to MAX_NAMES of the latter). Rows without a signature are left
+  out. If a row_writer is given, the study, experiment, name and signature of every row is written
+  with it as well, with an empty signature for rows that have none.
+  """
+  signatures = OrderedDict()
+  gate_cache = {}
+  for row in rows:
+    key, canonical = get_signature(row, symbols, gate_cache)
+    if row_writer:
+      row_writer.writerow([row['STUDY_ACCESSION'], row['EXPERIMENT_ACCESSION'],
+                           row['POPULATION_NAME_REPORTED'], key or ''])
+    if key is None:
+      continue
+    group = signatures.get(key)
+    if group is None:
+      group = {'canonical': canonical, 'rows': 0, 'studies': set(), 'names': set()}
+      signatures[key] = group
+    group['rows'] += 1
+    group['studies'].add(row['STUDY_ACCESSION'])
+    if len(group['names']) < MAX_NAMES:
+      group['names'].add(row['POPULATION_NAME_REPORTED'])
+  return signatures
+
+
+def get_signature_rows(signatures):
+  """
+  Generate a row for each of the given signatures (see group_signatures()), those shared by the
+  most studies and then by the most rows first: its key, canonical form, numbers of studies and
+  rows, and its studies and population names.
+  """
+  ordered = sorted(signatures.items(),
+                   key=lambda item: (-len(item[1]['studies']), -item[1]['rows'], item[0]))
+  for key, group in ordered:
+    yield [key, group['canonical'], len(group['studies']), group['rows'],
+           ' '.join(sorted(group['studies'])), ' | '.join(sorted(group['names']))]
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='Group the populations in a normalized TSV file by their gating signatures')
+  parser.add_argument('normalized', type=argparse.FileType('r'),
+                      help='a normalized TSV file, generated by normalize.py')
+  parser.add_argument('output', type=str, help='the output TSV file of signatures')
+  parser.add_argument('--rows', type=argparse.FileType('w'),
+                      help='a TSV file to write the signature of every row to')
+  args = parser.parse_args()
+
+  row_writer = None
+  if args.rows:
+    row_writer = csv.writer(args.rows, delimiter='\t', lineterminator='\n')
+    row_writer.writerow(['STUDY_ACCESSION', 'EXPERIMENT_ACCESSION', 'POPULATION_NAME_REPORTED',
+                         'Signature'])
+  rows = csv.DictReader(args.normalized, delimiter='\t')
+  signatures = group_signatures(rows, get_level_iris().keys(), row_writer)
+
+  with open(args.output, 'w') as output:
+    w = csv.writer(output, delimiter='\t', lineterminator='\n')
+    w.writerow(['Signature', 'Canonical definition', 'Studies', 'Rows', 'Study accessions',
+                'Population names'])
+    shared = 0
+    for row in get_signature_rows(signatures):
+      w.writerow(row)
+      shared += row[2] > 1
+  print('Found {} signatures, {} of them shared by more than one study'.format(
+    len(signatures), shared))
+
+
+if __name__ == "__main__":
+  main()
+
+
+# Unit tests for use with the tool `pytest` are defined below. To run these, run
+# `pytest signatures.py` from the command line.
+
+def test_signatures():
+  symbols = get_level_iris().keys()
+
+  def row(study, name, cl_id, ontologized):
+    return {'STUDY_ACCESSION': study, 'EXPERIMENT_ACCESSION': 'EXP' + study[3:],
+            'POPULATION_NAME_REPORTED': name, 'CL ID': cl_id,
+            'Gating mapped to ontologies': ontologized}
+
+  rows = [
+    row('SDY1', 'CD4 T cells', 'CL:0000624', 'PR:000001004+, PR:000001020+'),
+    row('SDY2', 'T4 cells', 'CL:0000624', 'PR:000001020+, PR:000001004+, PR:000001020+'),
+    row('SDY2', 'Tfh', 'CL:0000624', 'PR:000001004+, PR:000001020+, !CXCR5+'),
+    row('SDY3', 'Tfh cells', 'CL:0000624', 'PR:000001020+, !cxcr5+, PR:000001004+'),
+    row('SDY3', 'CD4-', 'CL:0000624', 'PR:000001004-, PR:000001020+'),
+    row('SDY3', 'CD4 T', 'CL:0000624', 'PR:000001004+, PR:000001020+'),
+    # Populations that were not recognized at all are not equivalent to each other:
+    row('SDY1', 'Live', '', ''),
+    row('SDY2', 'Singlets', '', ''),
+  ]
+  key, canonical = get_signature(rows[0], symbols)
+  assert canonical == 'CL:0000624 & PR:000001004+, PR:000001020+'
+  assert key == hashlib.sha1(canonical.encode('utf-8')).hexdigest()[:16]
+  assert get_signature(rows[1], symbols)[0] == key
+  assert get_signature(rows[4], symbols)[0] != key
+  assert get_signature(rows[6], symbols) == (None, None)
+
+  signatures = group_signatures(rows, symbols)
+  assert list(get_signature_rows(signatures)) == [
+    [key, canonical, 3, 3, 'SDY1 SDY2 SDY3', 'CD4 T | CD4 T cells | T4 cells'],
+    [get_signature(rows[2], symbols)[0], 'CL:0000624 & !cxcr5+, PR:000001004+, PR:000001020+', 2,
+     2, 'SDY2 SDY3', 'Tfh | Tfh cells'],
+    [get_signature(rows[4], symbols)[0], 'CL:0000624 & PR:000001004-, PR:000001020+', 1, 1, 'SDY3',
+     'CD4-']]
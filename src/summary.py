@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+#
+# Summarizes how well the populations of every study and project have been normalized: the numbers
+# and rates of gating tokens that were mapped to ontology ids and of those that were not ('!'
+# tokens) in normalized.tsv (see normalize.py), of rows with conflicts by conflict type, and, if
+# given the output of batch_validate.py, of the fcsAnalyzed records whose validated reported and
+# preferred population names and definitions match.
+#
+# The files are read once, keeping only the columns that are needed. Every string column is
+# dictionary-encoded into a NumPy array of integer codes, so that the tokens of each distinct
+# definition are counted only once, and the counts are grouped by study and by project with
+# np.bincount() rather than by looping over the rows.
+
+import argparse
+import csv
+
+import numpy as np
+
+from batch_validate import get_study_projects
+
+# The conflict types assigned by normalize.py, in the order of their columns in the summary:
+CONFLICT_TYPES = ['conflict with extra', 'conflict with CL definition']
+
+# The columns of fcsAnalyzed.tsv that record whether two validations match, and their names in the
+# summary:
+MATCH_COLUMNS = [('Population name validations match', 'Name'),
+                 ('Population definition validations match', 'Definition')]
+
+
+def read_columns(rows, fieldnames):
+  """
+  Read the given rows of a TSV file, the first of which is its header, and return a map from each
+  of the given fieldnames to the list of its values. Fieldnames that are not in the header get an
+  empty list.
+  """
+  rows = iter(rows)
+  header = next(rows, [])
+  indexes = [(fieldname, header.index(fieldname)) for fieldname in fieldnames
+             if fieldname in header]
+  columns = {fieldname: [] for fieldname in fieldnames}
+  appends = [(columns[fieldname].append, index) for fieldname, index in indexes]
+  for row in rows:
+    for append, index in appends:
+      append(row[index] if index < len(row) else '')
+  return columns
+
+
+def encode(*columns):
+  """
+  Dictionary-encode the given lists of strings together, returning the sorted array of their
+  distinct values and, for every list, an array of the codes of its values in that array.
+  """
+  values = sorted(set().union(*columns))
+  index = {value: code for code, value in enumerate(values)}
+  return np.array(values, dtype=object), [
+    np.fromiter(map(index.__getitem__, column), dtype=np.int64, count=len(column))
+    for column in columns]
+
+
+def count_tokens(values):
+  """
+  Given an array of distinct 'Gating mapped to ontologies' values, return two arrays with the
+  numbers of mapped and of unmapped ('!') tokens in each of them.
+  """
+  mapped = np.zeros(len(values), dtype=np.int64)
+  unmapped = np.zeros(len(values), dtype=np.int64)
+  for i, value in enumerate(values):
+    tokens = [token for token in value.split(', ') if token.strip()]
+    unmapped[i] = sum(token.startswith('!') for token in tokens)
+    mapped[i] = len(tokens) - unmapped[i]
+  return mapped, unmapped
+
+
+def group_counts(groups, ngroups, weights=None):
+  """
+  Sum the given weights (or count the rows, if there are none) within each of the given group codes.
+  """
+  return np.bincount(groups, weights=weights, minlength=ngroups).astype(np.int64)
+
+
+def rate(numerator, denominator):
+  """
+  Return the ratio of the given counts, formatted to three decimal places, or '' if the denominator
+  is zero.
+  """
+  return '{:.3f}'.format(numerator / denominator) if denominator else ''
+
+
+def summarize(normalized, fcs_analyzed=None, study_projects={}):
+  """
+  Given the columns of normalized.tsv and optionally of fcsAnalyzed.tsv (see read_columns()), and a
+  map from study ids to projects for the fcsAnalyzed records, return the header and the rows of the
+  summary: one row for every project and every study, followed by one for all of them.
+  """
+  fcs_analyzed = fcs_analyzed or {'studyAccession': []}
+  fcs_studies = fcs_analyzed['studyAccession']
+  studies, (study_codes, fcs_study_codes) = encode(normalized['STUDY_ACCESSION'], fcs_studies)
+
+  # The project of a normalized row is its NAME. Every study is listed under the project of its
+  # first normalized row, if it has one, or else under its project in the given map, and that is
+  # also the project of its fcsAnalyzed records:
+  first_rows = np.full(len(studies), len(study_codes), dtype=np.int64)
+  np.minimum.at(first_rows, study_codes, np.arange(len(study_codes)))
+  study_project = [normalized['NAME'][row] if row < len(study_codes)
+                   else study_projects.get(study, '') for study, row in zip(studies, first_rows)]
+  fcs_projects = np.array(study_project, dtype=object)[fcs_study_codes]
+  projects, (project_codes, fcs_project_codes) = encode(normalized['NAME'], fcs_projects)
+
+  # Count the tokens of each distinct definition, and look up the counts of every row:
+  definitions, (definition_codes,) = encode(normalized['Gating mapped to ontologies'])
+  mapped, unmapped = count_tokens(definitions)
+  mapped, unmapped = mapped[definition_codes], unmapped[definition_codes]
+  conflicted = np.array([bool(value) for value in normalized['Conflicts']], dtype=np.int64)
+  conflict_types, (conflict_type_codes,) = encode(normalized['Conflict type'])
+  conflict_type_codes = np.array([CONFLICT_TYPES.index(value) if value in CONFLICT_TYPES else -1
+                                  for value in conflict_types], dtype=np.int64)[conflict_type_codes]
+  matches = [np.array(fcs_analyzed.get(column) or [''] * len(fcs_studies), dtype=str)
+             for column, name in MATCH_COLUMNS]
+
+  def get_counts(codes, fcs_codes, ngroups):
+    # Return an array with a column of counts for every numeric column of the summary:
+    counts = [group_counts(codes, ngroups), group_counts(codes, ngroups, mapped),
+              group_counts(codes, ngroups, unmapped), group_counts(codes, ngroups, conflicted)]
+    for i in range(len(CONFLICT_TYPES)):
+      selected = conflict_type_codes == i
+      counts.append(group_counts(codes[selected], ngroups))
+    counts.append(group_counts(fcs_codes, ngroups))
+    for match in matches:
+      counts.append(group_counts(fcs_codes[match == 'Y'], ngroups))
+      counts.append(group_counts(fcs_codes[match == 'N'], ngroups))
+    return np.stack(counts, axis=1) if ngroups else np.zeros((0, len(counts)), dtype=np.int64)
+
+  header = ['Level', 'ID', 'Project', 'Rows', 'Mapped tokens', 'Unmapped tokens',
+            'Mapped token rate', 'Rows with conflicts', 'Conflict rate']
+  header += [conflict_type[0].upper() + conflict_type[1:] for conflict_type in CONFLICT_TYPES]
+  header += ['fcsAnalyzed records']
+  for column, name in MATCH_COLUMNS:
+    header += [name + ' matches', name + ' mismatches', name + ' match rate']
+
+  def get_row(level, name, project, counts):
+    rows, mapped, unmapped, conflicted = counts[:4]
+    row = [level, name, project, rows, mapped, unmapped, rate(mapped, mapped + unmapped),
+           conflicted, rate(conflicted, rows)]
+    row += list(counts[4:5 + len(CONFLICT_TYPES)])
+    for i in range(len(MATCH_COLUMNS)):
+      yes, no = counts[5 + len(CONFLICT_TYPES) + 2 * i:7 + len(CONFLICT_TYPES) + 2 * i]
+      row += [yes, no, rate(yes, yes + no)]
+    return [int(value) if isinstance(value, np.integer) else value for value in row]
+
+  summary = []
+  project_counts = get_counts(project_codes, fcs_project_codes, len(projects))
+  for project, counts in zip(projects, project_counts):
+    summary.append(get_row('project', project, project, counts))
+  study_counts = get_counts(study_codes, fcs_study_codes, len(studies))
+  for study, project, counts in zip(studies, study_project, study_counts):
+    summary.append(get_row('study', study, project, counts))
+  summary.append(get_row('all', '', '', study_counts.sum(axis=0)))
+  return header, summary
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='Summarize the normalization and validation of populations by study and project')
+  parser.add_argument('normalized', type=argparse.FileType('r'),
+                      help='a normalized TSV file, generated by normalize.py')
+  parser.add_argument('output', type=str, help='the output TSV file')
+  parser.add_argument('--fcsAnalyzed', type=argparse.FileType('r'),
+                      help='a TSV file of validated fcsAnalyzed records, generated by '
+                      'batch_validate.py')
+  parser.add_argument('--studies', type=argparse.FileType('r'),
+                      help='a TSV file containing information on the various HIPC studies, used to '
+                      'find the projects of the fcsAnalyzed records')
+  args = parser.parse_args()
+
+  normalized = read_columns(
+    csv.reader(args.normalized, delimiter='\t'),
+    ['NAME', 'STUDY_ACCESSION', 'Gating mapped to ontologies', 'Conflicts', 'Conflict type'])
+  fcs_analyzed = None
+  if args.fcsAnalyzed:
+    fcs_analyzed = read_columns(csv.reader(args.fcsAnalyzed, delimiter='\t'),
+                                ['studyAccession'] + [column for column, name in MATCH_COLUMNS])
+  study_projects = {}
+  if args.studies:
+    study_projects = get_study_projects(csv.DictReader(args.studies, delimiter='\t'))
+
+  header, summary = summarize(normalized, fcs_analyzed, study_projects)
+  with open(args.output, 'w') as output:
+    w = csv.writer(output, delimiter='\t', lineterminator='\n')
+    w.writerow(header)
+    w.writerows(summary)
+  print('Summarized {} rows and {} fcsAnalyzed records of {} studies'.format(
+    summary[-1][3], summary[-1][header.index('fcsAnalyzed records')],
+    sum(row[0] == 'study' for row in summary)))
+
+
+if __name__ == "__main__":
+  main()
+
+
+# Unit tests for use with the tool `pytest` are defined below. To run these, run
+# `pytest summary.py` from the command line.
+
+def test_summary():
+  normalized = read_columns([
+    ['NAME', 'STUDY_ACCESSION', 'Gating mapped to ontologies', 'Conflicts', 'Conflict type'],
+    ['P1', 'SDY2', 'PR:000001004+, !foo-', '', ''],
+    ['P1', 'SDY1', 'PR:000001004+, PR:000001020+', 'CD4-/+', 'conflict with extra'],
+    ['P2', 'SDY3', '!bar+', '', ''],
+    ['P1', 'SDY1', 'PR:000001004+, !foo-', 'CD8-/++', 'conflict with CL definition'],
+    ['P1', 'SDY2', '', '', ''],
+  ], ['NAME', 'STUDY_ACCESSION', 'Gating mapped to ontologies', 'Conflicts', 'Conflict type'])
+  assert normalized['STUDY_ACCESSION'] == ['SDY2', 'SDY1', 'SDY3', 'SDY1', 'SDY2']
+
+  fcs_analyzed = read_columns([
+    ['populationNameReported', 'studyAccession', 'Population name validations match',
+     'Population definition validations match'],
+    ['a', 'SDY1', 'Y', 'N'],
+    ['b', 'SDY1', 'Y', 'Y'],
+    ['c', 'SDY4', 'N', ''],
+  ], ['studyAccession'] + [column for column, name in MATCH_COLUMNS])
+
+  header, summary = summarize(normalized, fcs_analyzed, {'SDY4': 'P3'})
+  assert header[:9] == ['Level', 'ID', 'Project', 'Rows', 'Mapped tokens', 'Unmapped tokens',
+                        'Mapped token rate', 'Rows with conflicts', 'Conflict rate']
+  assert summary == [
+    ['project', 'P1', 'P1', 4, 4, 2, '0.667', 2, '0.500', 1, 1, 2, 2, 0, '1.000', 1, 1, '0.500'],
+    ['project', 'P2', 'P2', 1, 0, 1, '0.000', 0, '0.000', 0, 0, 0, 0, 0, '', 0, 0, ''],
+    ['project', 'P3', 'P3', 0, 0, 0, '', 0, '', 0, 0, 1, 0, 1, '0.000', 0, 0, ''],
+    ['study', 'SDY1', 'P1', 2, 3, 1, '0.750', 2, '1.000', 1, 1, 2, 2, 0, '1.000', 1, 1, '0.500'],
+    ['study', 'SDY2', 'P1', 2, 1, 1, '0.500', 0, '0.000', 0, 0, 0, 0, 0, '', 0, 0, ''],
+    ['study', 'SDY3', 'P2', 1, 0, 1, '0.000', 0, '0.000', 0, 0, 0, 0, 0, '', 0, 0, ''],
+    ['study', 'SDY4', 'P3', 0, 0, 0, '', 0, '', 0, 0, 1, 0, 1, '0.000', 0, 0, ''],
+    ['all', '', '', 5, 4, 3, '0.571', 2, '0.400', 1, 1, 3, 2, 1, '0.667', 1, 1, '0.500']]
+
+  # Without fcsAnalyzed records, only the normalized rows are summarized:
+  header, summary = summarize(normalized)
+  assert [row[:4] for row in summary] == [
+    ['project', 'P1', 'P1', 4], ['project', 'P2', 'P2', 1], ['study', 'SDY1', 'P1', 2],
+    ['study', 'SDY2', 'P1', 2], ['study', 'SDY3', 'P2', 1], ['all', '', '', 5]]
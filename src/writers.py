@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+#
+# Output writers for the rows generated by batch_validate.py. Every writer is given a binary file
+# object to write to, and is called once to write the header and then once for every batch of rows
+# (normally one batch per study). Each batch is formatted in memory and handed to the underlying
+# file in a single write call.
+
+import csv
+import io
+import json
+import struct
+import sys
+from array import array
+
+
+class TsvWriter:
+  """
+  Writes rows as tab-separated values in which every field is quoted. Embedded quotes are escaped by
+  doubling them, so fields containing quotes or tabs survive a round trip through a CSV reader.
+  """
+  extension = 'tsv'
+
+  def __init__(self, outfile, fieldnames):
+    self.outfile = outfile
+    self.fieldnames = fieldnames
+
+  def format_rows(self, rows):
+    buf = io.StringIO()
+    w = csv.writer(buf, delimiter='\t', quoting=csv.QUOTE_ALL, lineterminator='\n')
+    w.writerows(rows)
+    return buf.getvalue().encode('utf-8')
+
+  def write_header(self):
+    self.outfile.write(self.format_rows([self.fieldnames]))
+
+  def write_rows(self, rows):
+    self.outfile.write(self.format_rows(rows))
+
+
+class JsonLinesWriter:
+  """
+  Writes each row as a JSON object, keyed by field name, on a line of its own. There is no header.
+  """
+  extension = 'jsonl'
+
+  def __init__(self, outfile, fieldnames):
+    self.outfile = outfile
+    self.fieldnames = fieldnames
+
+  def write_header(self):
+    pass
+
+  def write_rows(self, rows):
+    lines = [json.dumps(dict(zip(self.fieldnames, row)), ensure_ascii=False) for row in rows]
+    if lines:
+      self.outfile.write(('\n'.join(lines) + '\n').encode('utf-8'))
+
+
+# The binary format begins with the magic bytes below, followed by the number of fields and the
+# length-prefixed UTF-8 field names. After that the file is a sequence of chunks, one per batch of
+# rows. Each chunk holds its own dictionary of distinct strings followed by the rows, encoded as
+# little-endian unsigned 32 bit indexes into that dictionary. Since no chunk refers to the
+# dictionary of any other chunk, chunks can be read independently, and a file can be extended by
+# simply appending the bytes of further chunks.
+BINARY_MAGIC = b'HIPCFCS1'
+
+
+def pack_strings(strings):
+  """
+  Encode the given list of strings as a count followed by length-prefixed UTF-8 byte strings.
+  """
+  parts = [struct.pack('<I', len(strings))]
+  for string in strings:
+    encoded = string.encode('utf-8')
+    parts.append(struct.pack('<I', len(encoded)))
+    parts.append(encoded)
+  return b''.join(parts)
+
+
+def unpack_strings(infile):
+  """
+  Read a list of strings encoded by pack_strings() from the given binary file, returning None if
+  the end of the file has been reached.
+  """
+  header = infile.read(4)
+  if not header:
+    return None
+  (count,) = struct.unpack('<I', header)
+  strings = []
+  for i in range(count):
+    (length,) = struct.unpack('<I', infile.read(4))
+    strings.append(infile.read(length).decode('utf-8'))
+  return strings
+
+
+class BinaryWriter:
+  """
+  Writes rows in a compact, dictionary-encoded binary format (see BINARY_MAGIC above). Since many
+  fields repeat across the records of a study (accessions, population names, validation results),
+  every distinct string is stored only once per chunk. None is stored as the empty string.
+  """
+  extension = 'bin'
+
+  def __init__(self, outfile, fieldnames):
+    self.outfile = outfile
+    self.fieldnames = fieldnames
+
+  def write_header(self):
+    self.outfile.write(BINARY_MAGIC + pack_strings(self.fieldnames))
+
+  def write_rows(self, rows):
+    if not rows:
+      return
+    codes = {}
+    indexes = array('I')
+    for row in rows:
+      for value in row:
+        value = '' if value is None else str(value)
+        code = codes.get(value)
+        if code is None:
+          code = codes[value] = len(codes)
+        indexes.append(code)
+    if sys.byteorder == 'big':
+      indexes.byteswap()
+    self.outfile.write(b''.join([
+      pack_strings(list(codes)),
+      struct.pack('<I', len(rows)),
+      indexes.tobytes()]))
+
+
+def read_binary(infile):
+  """
+  Generate the rows, as dictionaries keyed by field name, from a binary file written by
+  BinaryWriter.
+  """
+  if infile.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+    raise ValueError("Not a binary fcsAnalyzed file")
+  fieldnames = unpack_strings(infile)
+  width = len(fieldnames)
+  while True:
+    strings = unpack_strings(infile)
+    if strings is None:
+      return
+    (count,) = struct.unpack('<I', infile.read(4))
+    indexes = array('I')
+    indexes.frombytes(infile.read(4 * count * width))
+    if sys.byteorder == 'big':
+      indexes.byteswap()
+    for i in range(0, count * width, width):
+      yield dict(zip(fieldnames, [strings[j] for j in indexes[i:i + width]]))
+
+
+# Map from the names accepted on the command line to writer classes:
+WRITERS = {
+  'tsv': TsvWriter,
+  'jsonl': JsonLinesWriter,
+  'binary': BinaryWriter
+}
+
+
+def test_writers():
+  fieldnames = ['name', 'definition', 'match']
+  rows = [
+    ['CD4 "helper" T cells', 'CD3+\tCD4+', 'Y'],
+    ['B cells', None, 'N'],
+    ['B cells', 'CD19+', 'Y'],
+  ]
+
+  outfile = io.BytesIO()
+  writer = TsvWriter(outfile, fieldnames)
+  writer.write_header()
+  writer.write_rows(rows[:1])
+  writer.write_rows(rows[1:])
+  outfile.seek(0)
+  parsed = list(csv.reader(io.TextIOWrapper(outfile, encoding='utf-8'), delimiter='\t'))
+  assert parsed == [fieldnames, rows[0], ['B cells', '', 'N'], rows[2]]
+
+  outfile = io.BytesIO()
+  writer = JsonLinesWriter(outfile, fieldnames)
+  writer.write_header()
+  writer.write_rows(rows)
+  lines = outfile.getvalue().decode('utf-8').splitlines()
+  assert [json.loads(line) for line in lines] == [dict(zip(fieldnames, row)) for row in rows]
+
+  outfile = io.BytesIO()
+  writer = BinaryWriter(outfile, fieldnames)
+  writer.write_header()
+  writer.write_rows(rows[:2])
+  writer.write_rows([])
+  writer.write_rows(rows[2:])
+  outfile.seek(0)
+  assert list(read_binary(outfile)) == [
+    {'name': 'CD4 "helper" T cells', 'definition': 'CD3+\tCD4+', 'match': 'Y'},
+    {'name': 'B cells', 'definition': '', 'match': 'N'},
+    {'name': 'B cells', 'definition': 'CD19+', 'match': 'Y'}]